@@ -1,16 +1,25 @@
+import asyncio
+import html
+import random
+import re
+import time
+from contextlib import aclosing
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 from fastapi import HTTPException
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import AIMessage, BaseMessage
 
 from constants import (
     model_provider,
     model,
     api_key,
     max_tokens,
-    max_conversation_tokens,
+    history_token_budget,
+    conversation_compaction,
+    compaction_trigger_tokens,
+    compaction_keep_tokens,
     temperature,
     top_p,
     frequency_penalty,
@@ -21,24 +30,109 @@ from constants import (
     ibm_url,
     SSR_MAX_ITERATIONS,
     SSR_CONTENT_SIZE_LIMIT_TOKENS,
-    BYTES_PER_TOKEN_ESTIMATE,
     SSR_CONTENT_DIRECTORY,
     SSR_XML_RESPONSE_TAG,
     SSR_REQUEST_TAG,
+    prompt_log_mode,
+    llm_max_concurrency,
+    llm_pool_max_connections,
+    llm_pool_max_keepalive,
+    llm_keepalive_seconds,
+    llm_warmup_connections,
+    ssr_fetch_concurrency,
+    ssr_manifest_refresh_seconds,
+    ssr_prefetch,
+    ssr_prefetch_max_keys,
+    ssr_prefetch_min_score,
+    ssr_prefetch_holdout,
+    ssr_route_cache_enabled,
+    ssr_route_min_observations,
+    ssr_route_min_confidence,
+    ssr_route_max_entries,
+    ssr_route_holdout,
+    ssr_corequests_enabled,
+    ssr_corequest_min_count,
+    ssr_corequest_min_confidence,
+    ssr_corequest_max_keys,
+    ssr_corequest_holdout,
+    ssr_corequest_stats_file,
+    ssr_corequest_save_seconds,
+    ssr_early_abort,
+    ssr_early_abort_holdout,
+    prompt_layout,
+    prompt_pack_ttl,
+    prompt_pack_max_entries,
+    response_cache_classes,
+    response_cache_ttl,
+    response_cache_max_entries,
 )
 from utils.types import PyMessage
-from utils.llm import get_llm_file
+from utils.llm import get_llm_file_async
 from utils.logger import get_logger
-from bs4 import BeautifulSoup, Tag
+from utils.metrics import (
+    LLM_CACHE_CREATION_TOKENS,
+    LLM_CACHE_READ_TOKENS,
+    LLM_INPUT_TOKENS,
+    LLM_INVOKE_SECONDS,
+    LLM_OUTPUT_TOKENS,
+    SSR_EARLY_ABORT_SAVED_SECONDS,
+    SSR_EARLY_ABORT_SAVED_TOKENS,
+    SSR_EARLY_ABORTS,
+    SSR_ITERATIONS,
+    SSR_DEFERRED_KEYS,
+    SSR_MISSING_KEYS,
+    SSR_PREFETCHES,
+    SSR_ROUTE_LOOKUPS,
+    SSR_ROUTE_PRELOADS,
+    SSR_COMPANION_KEYS,
+    SSR_RETRIEVAL_TAIL_SECONDS,
+    SSR_RETRIEVAL_TAIL_TOKENS,
+)
+from utils.prompt_audit import PromptAuditLogger
+from utils.prompt_pack import PromptPack, PromptPackCache, PromptPackKey, prompt_pack_version
+from utils.response_cache import CachedResponse, ResponseCache, response_cache_key
+from utils.ssr_manifest import ManifestEntry, SSRContentManifest
+from utils.ssr_parser import extract_ssr_content_request
+from utils.ssr_retrieval import SSRContentRetriever
+from utils.ssr_corequests import SSRCoRequestStats
+from utils.ssr_routes import SSRRouteCache, ssr_route
+from utils.tokens import count_tokens
+from utils.tracing import start_span
 
 # Import for type annotations only
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from SessionCache import SessionCache
+    import httpx
+
+    from SessionCache import SessionCache, Summarizer
 
 logger = get_logger()
 
+prompt_audit = PromptAuditLogger(prompt_log_mode)
+
+# Bounds LLM calls in flight; requests beyond the limit wait without holding a thread
+llm_semaphore = asyncio.Semaphore(max(1, llm_max_concurrency))
+
+# Started by the server at startup
+ssr_manifest = SSRContentManifest(ssr_manifest_refresh_seconds)
+
+ssr_retriever = SSRContentRetriever(ssr_manifest)
+if ssr_prefetch:
+    ssr_manifest.add_listener(ssr_retriever.refresh)
+
+ssr_route_cache = SSRRouteCache(
+    ssr_route_min_observations, ssr_route_min_confidence, ssr_route_max_entries
+)
+
+# Started by the server at startup when enabled
+ssr_corequests = SSRCoRequestStats(
+    ssr_corequest_stats_file,
+    ssr_corequest_save_seconds,
+    ssr_corequest_min_count,
+    ssr_corequest_min_confidence,
+)
+
 
 def extract_message_content(message: BaseMessage) -> str:
     """Safely extract content from BaseMessage, handling both string and list content."""
@@ -54,13 +148,6 @@ def extract_message_content(message: BaseMessage) -> str:
 LastResponse = ""
 
 
-def calculate_conversation_size_exceeds_limit(
-    conversation_size_bytes: int, max_tokens: int
-) -> bool:
-    """Check if conversation exceeds token limit using byte estimation."""
-    return conversation_size_bytes > max_tokens * BYTES_PER_TOKEN_ESTIMATE
-
-
 def format_token_usage_message(
     input_tokens: int, output_tokens: int, iterations: int
 ) -> str:
@@ -68,44 +155,23 @@ def format_token_usage_message(
     return f"Total Input Tokens ({input_tokens}), Total Output Tokens ({output_tokens}) over ({iterations}) passes\n"
 
 
-def extract_ssr_content_request(
-    llm_response_content: str,
-) -> Tuple[bool, List[str], str]:
-    """
-    Extract SSR content request from LLM response.
-    Returns: (has_ssr_request, requested_keys, answer_text)
-    """
-    soup = BeautifulSoup(llm_response_content, "lxml-xml")
-    ssr_response = soup.find(SSR_XML_RESPONSE_TAG)
-
-    if not isinstance(ssr_response, Tag):
-        return False, [], ""
-
-    content_request = ssr_response.find(SSR_REQUEST_TAG)
-    if not isinstance(content_request, Tag):
-        answer = ssr_response.find("answer")
-        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
-        return False, [], answer_text
-
-    primary_keys = content_request.find("PrimaryKeys")
-    if not isinstance(primary_keys, Tag):
-        answer = ssr_response.find("answer")
-        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
-        return False, [], answer_text
-
-    primary_keys_text = primary_keys.get_text().strip()
-    if not primary_keys_text:
-        answer = ssr_response.find("answer")
-        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
-        return False, [], answer_text
-
-    keys = [key.strip() for key in primary_keys_text.split(",")]
-    return True, keys, ""
+def cache_breakpoint(text: str) -> List[Dict[str, Any]]:
+    """Wrap text in a content block marking the end of a cacheable prompt prefix (Anthropic)."""
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
 
 
 class PromptBuilder:
     """Strategy pattern for different LLM provider prompt formats."""
 
+    @staticmethod
+    def build_system_prefix(scenario: str, conundrum: str, action_plan: str) -> str:
+        """Static system text for the configured layout; the per-pass additional content follows it."""
+        if prompt_layout == "cache_stable":
+            return f"{scenario}\n{conundrum}\nFollow these instructions when responding to the user ({action_plan})"
+        if model_provider == "ANTHROPIC":
+            return f"{scenario}\n{conundrum}\n"
+        return conundrum
+
     @staticmethod
     def build_anthropic_prompt(
         scenario: str,
@@ -115,9 +181,12 @@ class PromptBuilder:
         user_request: str,
         action_plan: str,
         loaded_content_message: str = "",
+        system_prefix: Optional[str] = None,
     ) -> List[Tuple[str, str]]:
         """Build prompt format optimized for Anthropic models."""
-        system_content = f"{scenario}\n{conundrum}\n{additional_content}"
+        if system_prefix is None:
+            system_prefix = PromptBuilder.build_system_prefix(scenario, conundrum, action_plan)
+        system_content = system_prefix + additional_content
         user_content = f"Respond to User's Request = ({loaded_content_message + user_request}) following these instructions ({action_plan})"
         return [
             ("system", system_content),
@@ -134,14 +203,17 @@ class PromptBuilder:
         user_request: str,
         action_plan: str,
         loaded_content_message: str = "",
+        system_prefix: Optional[str] = None,
     ) -> List[Tuple[str, str]]:
         """Build standard prompt format for other LLM providers."""
+        if system_prefix is None:
+            system_prefix = PromptBuilder.build_system_prefix(scenario, conundrum, action_plan)
         messages = []
         if scenario:
             messages.append(("system", scenario))
         messages.extend(
             [
-                ("system", conundrum + additional_content),
+                ("system", system_prefix + additional_content),
                 *conversation_history,
                 ("user", loaded_content_message + user_request),
                 ("system", action_plan),
@@ -149,6 +221,49 @@ class PromptBuilder:
         )
         return messages
 
+    @staticmethod
+    def build_cache_stable_prompt(
+        scenario: str,
+        conundrum: str,
+        additional_content: str,
+        conversation_history: List[Tuple[str, str]],
+        user_request: str,
+        action_plan: str,
+        loaded_content_message: str = "",
+        system_prefix: Optional[str] = None,
+    ) -> List[Tuple[str, Any]]:
+        """Build a prompt whose prefix is identical across passes and turns.
+
+        Scenario, conundrum and action plan come first, then the conversation
+        history, then the parts that change on every pass (date, SSR content
+        and the user's request), so provider prompt caches can reuse the
+        prefix. Anthropic gets explicit cache breakpoints after the static
+        content and after the history; OpenAI caches matching prefixes
+        automatically.
+        """
+        if system_prefix is None:
+            system_prefix = PromptBuilder.build_system_prefix(scenario, conundrum, action_plan)
+        stable_content = system_prefix
+        user_content = f"Respond to User's Request = ({loaded_content_message + user_request})"
+
+        if model_provider != "ANTHROPIC":
+            return [
+                ("system", stable_content),
+                *conversation_history,
+                ("system", additional_content),
+                ("user", user_content),
+            ]
+
+        history: List[Tuple[str, Any]] = list(conversation_history)
+        if history and history[-1][1]:
+            role, content = history[-1]
+            history[-1] = (role, cache_breakpoint(content))
+        return [
+            ("system", cache_breakpoint(stable_content)),
+            *history,
+            ("user", f"{additional_content}\n{user_content}"),
+        ]
+
     @staticmethod
     def build_prompt(
         scenario: str,
@@ -158,9 +273,25 @@ class PromptBuilder:
         user_request: str,
         action_plan: str,
         loaded_content_message: str = "",
-    ) -> List[Tuple[str, str]]:
-        """Build prompt using appropriate strategy based on model provider."""
-        if model_provider == "ANTHROPIC":
+        system_prefix: Optional[str] = None,
+    ) -> List[Tuple[str, Any]]:
+        """Build prompt using appropriate strategy based on model provider.
+
+        system_prefix is the static system text from build_system_prefix, when
+        the caller already has it compiled (see PromptPack).
+        """
+        if prompt_layout == "cache_stable":
+            return PromptBuilder.build_cache_stable_prompt(
+                scenario,
+                conundrum,
+                additional_content,
+                conversation_history,
+                user_request,
+                action_plan,
+                loaded_content_message,
+                system_prefix,
+            )
+        elif model_provider == "ANTHROPIC":
             return PromptBuilder.build_anthropic_prompt(
                 scenario,
                 conundrum,
@@ -169,6 +300,7 @@ class PromptBuilder:
                 user_request,
                 action_plan,
                 loaded_content_message,
+                system_prefix,
             )
         else:
             return PromptBuilder.build_standard_prompt(
@@ -179,6 +311,7 @@ class PromptBuilder:
                 user_request,
                 action_plan,
                 loaded_content_message,
+                system_prefix,
             )
 
 
@@ -207,78 +340,332 @@ class SSRIterationState:
         return self.iteration_count > SSR_MAX_ITERATIONS
 
 
+def pack_by_priority(
+    keys: List[str], sizes: Dict[str, int], budget: int
+) -> Tuple[List[str], List[str]]:
+    """
+    Split keys, highest priority first, into (selected, deferred) within budget.
+
+    Each key is taken if it still fits, so a large key no longer blocks smaller
+    ones after it. With strict priorities this greedy pass is the optimal
+    knapsack packing: no set of keys that fits is preferred over it. The first
+    key is always taken, even if it alone is over the budget.
+    """
+    selected: List[str] = []
+    deferred: List[str] = []
+    used = 0
+    for key in keys:
+        if not selected or used + sizes[key] <= budget:
+            selected.append(key)
+            used += sizes[key]
+        else:
+            deferred.append(key)
+    return selected, deferred
+
+
+class LoadedContent(NamedTuple):
+    xml: str
+    status_message: str
+    # Keys included in xml, stubs for missing keys included
+    loaded_keys: List[str]
+    # Keys left out because of the size limit
+    deferred_keys: List[str]
+
+
 class SSRContentLoader:
     """Handles loading and size management of SSR content files."""
 
-    def __init__(self, max_size_tokens: int = SSR_CONTENT_SIZE_LIMIT_TOKENS) -> None:
-        self.max_size_bytes = max_size_tokens * BYTES_PER_TOKEN_ESTIMATE
+    def __init__(
+        self,
+        max_size_tokens: int = SSR_CONTENT_SIZE_LIMIT_TOKENS,
+        fetch_concurrency: int = ssr_fetch_concurrency,
+        manifest: SSRContentManifest = ssr_manifest,
+    ) -> None:
+        self.max_size_tokens = max_size_tokens
+        self.fetch_concurrency = max(1, fetch_concurrency)
+        self.manifest = manifest
+
+    def priority_order(
+        self, content_keys: List[str], catalog: Optional[Dict[str, ManifestEntry]]
+    ) -> List[str]:
+        """Requested order, with keys given a higher manifest priority moved ahead."""
+        if not catalog:
+            return content_keys
+        return sorted(content_keys, key=lambda key: -catalog[key].priority)
+
+    async def fetch_content_files(
+        self, request: PyMessage, content_keys: List[str]
+    ) -> Dict[str, str]:
+        """Fetch the files for all keys concurrently, at most fetch_concurrency at a time."""
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+        unique_keys = list(dict.fromkeys(content_keys))
+
+        async def fetch(content_key: str) -> str:
+            async with semaphore:
+                return await get_llm_file_async(
+                    request.classSelection, SSR_CONTENT_DIRECTORY, f"{content_key}.txt"
+                )
 
-    def load_content_files(
-        self, request: PyMessage, session_key: str, content_keys: List[str]
-    ) -> Tuple[str, str]:
-        """Load content files with size management."""
-        loaded_contents = []
-        loaded_file_names = []
-        running_size = 0
-
-        for content_key in content_keys:
-            content = get_llm_file(
-                request.classSelection,
-                SSR_CONTENT_DIRECTORY,
-                f"{content_key}.txt",
-                session_key,
-                request.classSelection or "",
-                request.lesson or "",
-                request.actionPlan or "",
+        contents = await asyncio.gather(*(fetch(key) for key in unique_keys))
+        return dict(zip(unique_keys, contents))
+
+    async def load_content_files(
+        self,
+        request: PyMessage,
+        content_keys: List[str],
+        companion_keys: Sequence[str] = (),
+    ) -> LoadedContent:
+        """
+        Load content files with size management.
+
+        Keys are packed into the size limit in priority order (see pack_by_priority),
+        using manifest sizes to decide what to fetch and exact token counts once
+        fetched. Keys that do not fit are reported as deferred. Companion keys,
+        which were not requested, are packed after all requested keys and are
+        only loaded when they exist and fit.
+        """
+        catalog = self.manifest.entries(request.classSelection)
+        content_keys = list(dict.fromkeys(content_keys))
+        companion_keys = [
+            key
+            for key in dict.fromkeys(companion_keys)
+            if catalog is not None
+            and key in catalog
+            and key not in content_keys
+            and catalog[key].tokens <= self.max_size_tokens
+        ]
+
+        missing_keys = [
+            key for key in content_keys if catalog is not None and key not in catalog
+        ]
+        for content_key in missing_keys:
+            SSR_MISSING_KEYS.inc(
+                provider=model_provider,
+                model=model,
+                class_selection=request.classSelection or "",
+            )
+            logger.info(
+                "SSR content key not in manifest",
+                extra={
+                    "content_key": content_key,
+                },
+            )
+
+        ordered_keys = self.priority_order(
+            [key for key in content_keys if key not in missing_keys], catalog
+        ) + self.priority_order(companion_keys, catalog)
+        deferred_keys: List[str] = []
+        if catalog is not None:
+            # Plan on the manifest sizes so files that will not fit are not fetched
+            ordered_keys, deferred_keys = pack_by_priority(
+                ordered_keys,
+                {key: catalog[key].tokens for key in ordered_keys},
+                self.max_size_tokens,
             )
 
-            if not content:
+        fetched = await self.fetch_content_files(request, ordered_keys)
+
+        for content_key in ordered_keys:
+            if not fetched[content_key] and content_key not in companion_keys:
                 logger.error(
                     "Failed to load SSR content",
                     extra={
-                        "session_key": session_key,
                         "content_key": content_key,
-                        "class_selection": request.classSelection or "",
-                        "lesson": request.lesson or "",
-                        "action_plan": request.actionPlan or "",
                     },
                 )
-                loaded_contents.append(f"<" + content_key + ">No Content by this name Exists</" + content_key + ">\n")
-                loaded_file_names.append(content_key)
-
-                continue
+                missing_keys.append(content_key)
+
+        sizes = {}
+        for content_key in ordered_keys:
+            if fetched[content_key]:
+                sizes[content_key] = count_tokens(fetched[content_key])
+                self.manifest.record_tokens(
+                    request.classSelection, content_key, sizes[content_key]
+                )
+        selected_keys, over_limit_keys = pack_by_priority(
+            [key for key in ordered_keys if key in sizes], sizes, self.max_size_tokens
+        )
+        deferred_keys += over_limit_keys
+        deferred_keys = [key for key in content_keys if key in deferred_keys]
 
-            content_size = len(content.encode("utf-8"))
+        if deferred_keys:
+            SSR_DEFERRED_KEYS.inc(
+                len(deferred_keys),
+                provider=model_provider,
+                model=model,
+                class_selection=request.classSelection or "",
+            )
+            logger.info(
+                "SSR content limit exceeded",
+                extra={
+                    "deferred_keys": deferred_keys,
+                },
+            )
 
-            if (
-                not loaded_contents
-                or running_size + content_size <= self.max_size_bytes
-            ):
-                loaded_contents.append(f"<" + content_key + ">" + content + "</" + content_key + ">\n")
+        # Content is given in the requested order, companions last
+        loaded_contents = []
+        loaded_file_names = []
+        for content_key in content_keys + companion_keys:
+            if content_key in missing_keys:
+                loaded_contents.append(f"<" + content_key + ">No Content by this name Exists</" + content_key + ">\n")
+                loaded_file_names.append(content_key)
+            elif content_key in selected_keys:
+                loaded_contents.append(f"<" + content_key + ">" + fetched[content_key] + "</" + content_key + ">\n")
                 loaded_file_names.append(content_key)
-                running_size += content_size
-            else:
-                logger.info(
-                    "SSR content limit exceeded",
-                    extra={
-                        "session_key": session_key,
-                        "content_key": content_key,
-                        "class_selection": request.classSelection or "",
-                        "lesson": request.lesson or "",
-                        "action_plan": request.actionPlan or "",
-                    },
-                )
-                break
 
         xml_content = f"<ssrcontent>{', '.join(loaded_contents)}</ssrcontent>"
         status_message = (
             f"Loaded SSR Content {','.join(loaded_file_names)} for this request only."
         )
+        if deferred_keys:
+            status_message += (
+                f" Deferred {','.join(deferred_keys)} because of the content size limit;"
+                " request only those again if still needed."
+            )
+
+        return LoadedContent(xml_content, status_message, loaded_file_names, deferred_keys)
+
+
+class AnswerStreamFilter:
+    """Pick the user-visible answer out of an LLM response as it streams in.
+
+    Plain text responses are passed through unchanged. For SSR XML responses
+    only the text inside <answer> is emitted, with tags dropped and entities
+    decoded. The final response text remains authoritative; this only drives
+    the streamed preview.
+    """
+
+    _ANSWER_OPEN = "<answer>"
+    _ANSWER_CLOSE = "</answer>"
+    _XML_PREFIXES = ("<?xml", "<" + SSR_XML_RESPONSE_TAG)
+    # Longest entity (e.g. &#x1F600;) or partial closing tag held back between chunks
+    _MAX_HOLD = 10
+    _TAG_PATTERN = re.compile(r"<[^>]*>")
+
+    def __init__(self) -> None:
+        self.mode: Optional[str] = None  # "plain" or "xml" once known
+        self.emitted = False
+        self._buffer = ""
+        self._in_answer = False
+        self._done = False
+
+    def feed(self, text: str) -> str:
+        """Add the next chunk of response text, returning answer text ready to show."""
+        if self.mode is None:
+            self._buffer += text
+            start = self._buffer.lstrip()
+            if not start:
+                return ""
+            if any(start.startswith(prefix) for prefix in self._XML_PREFIXES):
+                self.mode = "xml"
+            elif any(prefix.startswith(start) for prefix in self._XML_PREFIXES):
+                # Could still become an SSR response, wait for more
+                return ""
+            else:
+                self.mode = "plain"
+            text, self._buffer = self._buffer, ""
+
+        if self.mode == "plain":
+            return self._emit(text)
+        return self._feed_xml(text)
+
+    def _emit(self, text: str) -> str:
+        if text:
+            self.emitted = True
+        return text
+
+    def _feed_xml(self, text: str) -> str:
+        if self._done:
+            return ""
+        self._buffer += text
+
+        if not self._in_answer:
+            start = self._buffer.find(self._ANSWER_OPEN)
+            if start < 0:
+                # Keep only what could be the start of the opening tag
+                self._buffer = self._buffer[-(len(self._ANSWER_OPEN) - 1):]
+                return ""
+            self._buffer = self._buffer[start + len(self._ANSWER_OPEN):]
+            self._in_answer = True
+
+        end = self._buffer.find(self._ANSWER_CLOSE)
+        if end >= 0:
+            ready, self._buffer = self._buffer[:end], ""
+            self._done = True
+        else:
+            # Hold back a trailing partial tag or entity until it is complete
+            cut = len(self._buffer)
+            for opener, closer in (("<", ">"), ("&", ";")):
+                index = self._buffer.rfind(opener)
+                if (
+                    index >= 0
+                    and closer not in self._buffer[index:]
+                    and len(self._buffer) - index <= self._MAX_HOLD
+                ):
+                    cut = min(cut, index)
+            ready, self._buffer = self._buffer[:cut], self._buffer[cut:]
+
+        return self._emit(html.unescape(self._TAG_PATTERN.sub("", ready)))
+
+
+class SSRRequestDetector:
+    """Spot a complete SSR content request while an LLM response streams in.
+
+    The request is complete once </PrimaryKeys> arrives inside an
+    <SSR_requesting_content> element, so anything generated afterwards can be
+    skipped.
+    """
+
+    _KEYS_CLOSE = "</PrimaryKeys>"
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.request_end = -1
+        self._scanned = 0
+
+    def feed(self, text: str) -> bool:
+        """Add the next chunk of response text, returning True once a request is complete."""
+        self.text += text
+        if self.request_end < 0:
+            start = max(0, self._scanned - len(self._KEYS_CLOSE) + 1)
+            self._scanned = len(self.text)
+            end = self.text.find(self._KEYS_CLOSE, start)
+            if end >= 0 and "<" + SSR_REQUEST_TAG in self.text[:end]:
+                self.request_end = end + len(self._KEYS_CLOSE)
+        return self.request_end >= 0
+
+    def truncated_response(self) -> str:
+        """The response up to the end of the content request, with the open elements closed."""
+        return (
+            self.text[: self.request_end]
+            + f"</{SSR_REQUEST_TAG}></{SSR_XML_RESPONSE_TAG}>"
+        )
+
+
+class EarlyAbortBaseline:
+    """Running estimate of what a retrieval pass generates after its content request.
+
+    Updated from holdout passes that run to completion, and used to estimate
+    the output tokens and seconds saved by passes that are stopped early.
+    """
 
-        return xml_content, status_message
+    def __init__(self, alpha: float = 0.2) -> None:
+        self.alpha = alpha
+        self.tail_tokens: Optional[float] = None
+        self.tail_seconds: Optional[float] = None
 
+    def observe(self, tail_tokens: float, tail_seconds: float) -> None:
+        if self.tail_tokens is None or self.tail_seconds is None:
+            self.tail_tokens, self.tail_seconds = tail_tokens, tail_seconds
+            return
+        self.tail_tokens += self.alpha * (tail_tokens - self.tail_tokens)
+        self.tail_seconds += self.alpha * (tail_seconds - self.tail_seconds)
 
-def initialize_llm() -> BaseChatModel:
+
+early_abort_baseline = EarlyAbortBaseline()
+
+
+def initialize_llm(http_async_client: Optional["httpx.AsyncClient"] = None) -> BaseChatModel:
 
     match model_provider:
         case "OPENAI":
@@ -294,6 +681,8 @@ def initialize_llm() -> BaseChatModel:
                 frequency_penalty=frequency_penalty,
                 presence_penalty=presence_penalty,
                 api_key=api_key,
+                stream_usage=True,
+                http_async_client=http_async_client,
             )
         case "GOOGLE":
             from langchain_google_vertexai import ChatVertexAI
@@ -327,7 +716,7 @@ def initialize_llm() -> BaseChatModel:
         case "ANTHROPIC":
             from langchain_anthropic import ChatAnthropic
 
-            return ChatAnthropic(
+            chat_model = ChatAnthropic(
                 model_name=model,
                 max_tokens=max_tokens,
                 max_retries=max_retries,
@@ -341,6 +730,18 @@ def initialize_llm() -> BaseChatModel:
                 api_key=api_key,
                 stop=None,
             )
+            if http_async_client is not None:
+                import anthropic
+
+                # ChatAnthropic has no setting for its HTTP client, so this sets the
+                # cached _async_client property it would otherwise fill on first use,
+                # built from its private _client_params. That relies on the internals
+                # of the langchain-anthropic version pinned in requirements-unix.txt;
+                # if a bump changes them, LLMClient.initialize fails readiness
+                chat_model.__dict__["_async_client"] = anthropic.AsyncClient(
+                    **chat_model._client_params, http_client=http_async_client
+                )
+            return chat_model
         case "OLLAMA":
             from langchain_ollama import ChatOllama
 
@@ -349,25 +750,178 @@ def initialize_llm() -> BaseChatModel:
             raise ValueError("Invalid model provider")
 
 
-try:
-    llm = initialize_llm()
-except Exception as e:
-    logger.critical("Failed to initialize LLM", extra={"error": str(e)})
+# Providers called through LLMClient's pooled HTTP client, with their default base URL
+POOLED_PROVIDERS = {
+    "OPENAI": "https://api.openai.com/v1",
+    "ANTHROPIC": "https://api.anthropic.com",
+}
+
+
+def uses_http_client(chat_model: BaseChatModel, http_client: "httpx.AsyncClient") -> bool:
+    """Whether the model's async SDK client sends its requests through http_client."""
+    sdk_client = getattr(chat_model, "root_async_client", None) or getattr(
+        chat_model, "_async_client", None
+    )
+    return getattr(sdk_client, "_client", None) is http_client
+
+
+class LLMClient:
+    """
+    The configured chat model, created by start() at server startup rather than
+    at import, so only the selected provider's integration is loaded and
+    failures show in readiness instead of on the first request.
+
+    OPENAI and ANTHROPIC calls go through one pooled HTTP client (LLM_POOL_*),
+    and start() opens LLM_WARMUP_CONNECTIONS connections to the provider before
+    reporting ready, so the first requests do not pay for the TLS handshakes.
+    """
+
+    WARMUP_RETRY_SECONDS = 10.0
+
+    def __init__(self) -> None:
+        self.model: Optional[BaseChatModel] = None
+        self.http_client: Optional["httpx.AsyncClient"] = None
+        self.base_url = ""
+        self.ready = False
+        # Why the client is not ready, None once it is
+        self.error: Optional[str] = "Starting"
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def initialize(self) -> None:
+        if model_provider in POOLED_PROVIDERS:
+            import httpx
+
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=llm_pool_max_connections,
+                    max_keepalive_connections=llm_pool_max_keepalive,
+                    keepalive_expiry=llm_keepalive_seconds,
+                ),
+                timeout=timeout,
+            )
+        chat_model = initialize_llm(self.http_client)
+        if self.http_client is not None and not uses_http_client(chat_model, self.http_client):
+            # The integration changed how it creates its client
+            raise RuntimeError(
+                f"{model_provider} model does not use the pooled HTTP client"
+            )
+        self.model = chat_model
+        self.base_url = (
+            getattr(self.model, "openai_api_base", None)
+            or getattr(self.model, "anthropic_api_url", None)
+            or POOLED_PROVIDERS.get(model_provider, "")
+        )
+
+    async def warm_up(self) -> None:
+        if self.http_client is None or llm_warmup_connections <= 0:
+            return
+        # Any response will do; concurrent requests each open their own connection
+        await asyncio.gather(
+            *(self.http_client.head(self.base_url) for _ in range(llm_warmup_connections))
+        )
+
+    async def _run(self) -> None:
+        try:
+            await asyncio.to_thread(self.initialize)
+        except Exception as e:
+            self.error = f"Failed to initialize LLM: {e}"
+            logger.critical("Failed to initialize LLM", extra={"error": str(e)})
+            return
+
+        while True:
+            try:
+                started = time.perf_counter()
+                await self.warm_up()
+                break
+            except Exception as e:
+                self.error = f"Failed to connect to LLM provider: {e}"
+                logger.warning(
+                    "LLM warm-up failed, retrying",
+                    extra={
+                        "error": str(e),
+                        "retry_seconds": str(self.WARMUP_RETRY_SECONDS),
+                    },
+                )
+                await asyncio.sleep(self.WARMUP_RETRY_SECONDS)
+
+        self.ready = True
+        self.error = None
+        logger.info(
+            "LLM ready",
+            extra={
+                "warmup_seconds": f"{time.perf_counter() - started:.3f}",
+                "warmup_connections": str(llm_warmup_connections if self.http_client else 0),
+            },
+        )
+
+    def start(self) -> None:
+        """Create and warm up the model in the background. Must be called from the event loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def get(self) -> BaseChatModel:
+        if self.model is None:
+            raise RuntimeError(f"LLM is not available: {self.error}")
+        return self.model
+
 
+# Started by the server at startup
+llm_client = LLMClient()
 
-def get_token_count(
-    llm_response: BaseMessage,
-    p_sessionKey: str,
-    class_selection: str = "",
-    lesson: str = "",
-    action_plan: str = "",
-) -> Tuple[int, int]:
+
+def get_llm() -> BaseChatModel:
+    """The configured chat model; raises until the server has created it."""
+    return llm_client.get()
+
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a tutoring conversation. Combine the previous "
+    "summary with the new messages into one concise summary written in the third person. "
+    "Keep the topics covered, what the student understood or struggled with, answers "
+    "given, open questions and anything the tutor promised to follow up on. Reply with "
+    "the summary only."
+)
+
+
+async def summarize_conversation(
+    previous_summary: str, messages: List[Tuple[str, str]]
+) -> str:
+    """Default Summarizer for conversation compaction, using the configured LLM."""
+    transcript = "\n".join(f"{role.upper()}: {content}" for role, content in messages)
+    prompt = [
+        ("system", SUMMARY_INSTRUCTIONS),
+        (
+            "user",
+            f"<PreviousSummary>{previous_summary}</PreviousSummary>\n"
+            f"<NewMessages>\n{transcript}\n</NewMessages>",
+        ),
+    ]
+    with start_span("conversation.summarize", messages=len(messages)):
+        async with llm_semaphore:
+            response = await get_llm().ainvoke(prompt)
+    return extract_message_content(response).strip()
+
+
+# Replaceable, e.g. with a deterministic fake in tests
+conversation_summarizer: "Summarizer" = summarize_conversation
+
+
+def get_token_count(llm_response: BaseMessage) -> Tuple[int, int]:
     input_tokens = output_tokens = 0
 
     # Safely access token usage metrics
     response_metadata = getattr(llm_response, "response_metadata", {})
     usage = response_metadata.get("usage", {})
 
+    if not usage:
+        # Streamed responses (and some providers) only report usage_metadata
+        usage = getattr(llm_response, "usage_metadata", None) or {}
+
     if usage:
         input_tokens = usage.get("input_tokens", 0)
         output_tokens = usage.get("output_tokens", 0)
@@ -375,323 +929,733 @@ def get_token_count(
         logger.info(
             f"Token usage Input {input_tokens}, Output {output_tokens}",
             extra={
-                "session_key": p_sessionKey,
                 "input_tokens": str(input_tokens),
                 "output_tokens": str(output_tokens),
                 "total_tokens": str(input_tokens + output_tokens),
-                "class_selection": class_selection,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
 
     return input_tokens, output_tokens
 
 
-def invoke_llm_with_ssr(
+def get_cached_token_count(llm_response: BaseMessage) -> Tuple[int, int]:
+    """Return (cache read, cache creation) input tokens reported for a response."""
+    usage = getattr(llm_response, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    return details.get("cache_read", 0) or 0, details.get("cache_creation", 0) or 0
+
+
+async def stream_llm_response(
+    chat_model: BaseChatModel,
+    messages: List[Tuple[str, Any]],
+    metric_labels: Dict[str, str],
+    token_queue: "asyncio.Queue[Optional[str]]",
+    answer_filter: Optional[AnswerStreamFilter],
+    request_detector: Optional[SSRRequestDetector],
+    holdout: bool,
+) -> Tuple[Optional[BaseMessage], bool, float]:
+    """
+    Stream one LLM pass under the LLM semaphore, putting the answer text for
+    the client on token_queue and None when done. Stops early once the
+    request detector sees a complete content request, unless held out.
+
+    Returns (response, aborted, perf_counter time the request was seen or 0).
+    """
+    response: Optional[BaseMessage] = None
+    request_seen_at = 0.0
+    try:
+        async with llm_semaphore:
+            with LLM_INVOKE_SECONDS.time(**metric_labels):
+                async with aclosing(chat_model.astream(messages)) as response_stream:
+                    async for chunk in response_stream:
+                        response = chunk if response is None else response + chunk
+                        chunk_text = extract_message_content(chunk)
+                        if answer_filter is not None:
+                            answer_chunk = answer_filter.feed(chunk_text)
+                            if answer_chunk:
+                                token_queue.put_nowait(answer_chunk)
+                        if (
+                            request_detector is not None
+                            and request_detector.feed(chunk_text)
+                            and not request_seen_at
+                        ):
+                            request_seen_at = time.perf_counter()
+                            if not holdout and extract_ssr_content_request(
+                                request_detector.truncated_response()
+                            )[0]:
+                                # aclosing closes the stream as the loop is left,
+                                # which stops generation before the slot is freed
+                                return response, True, request_seen_at
+        return response, False, request_seen_at
+    finally:
+        token_queue.put_nowait(None)
+
+
+def estimate_prompt_tokens(messages: List[Tuple[str, Any]]) -> int:
+    """Tokens of a built prompt, text blocks included."""
+    total = 0
+    for _, content in messages:
+        if isinstance(content, str):
+            total += count_tokens(content)
+        else:
+            total += sum(
+                count_tokens(block.get("text", ""))
+                for block in content
+                if isinstance(block, dict)
+            )
+    return total
+
+
+def estimate_aborted_usage(
+    messages: List[Tuple[str, Any]],
+    truncated_response: str,
+    input_tokens: int,
+    output_tokens: int,
+) -> Tuple[int, int, bool]:
+    """
+    (input, output, estimated) token usage of an early aborted pass. Counts the
+    provider did not report, or reported only in part, are estimated from the
+    prompt and the truncated response.
+    """
+    estimated = False
+    if not input_tokens:
+        input_tokens = estimate_prompt_tokens(messages)
+        estimated = True
+    truncated_tokens = count_tokens(truncated_response)
+    if output_tokens < truncated_tokens:
+        output_tokens = truncated_tokens
+        estimated = True
+    return input_tokens, output_tokens, estimated
+
+
+def record_early_abort(span, metric_labels: Dict[str, str]) -> None:
+    """Count a retrieval pass stopped early and what the baseline says it saved."""
+    SSR_EARLY_ABORTS.inc(**metric_labels)
+    span.set_attribute("early_abort", True)
+
+    if early_abort_baseline.tail_tokens is None:
+        return
+    SSR_EARLY_ABORT_SAVED_TOKENS.inc(early_abort_baseline.tail_tokens, **metric_labels)
+    SSR_EARLY_ABORT_SAVED_SECONDS.inc(early_abort_baseline.tail_seconds, **metric_labels)
+    span.set_attribute("estimated_saved_output_tokens", round(early_abort_baseline.tail_tokens, 1))
+    span.set_attribute("estimated_saved_seconds", round(early_abort_baseline.tail_seconds, 3))
+
+
+def record_retrieval_tail(
+    span,
+    metric_labels: Dict[str, str],
+    request_detector: SSRRequestDetector,
+    output_tokens: int,
+    tail_seconds: float,
+) -> None:
+    """Measure what a holdout retrieval pass generated after its content request."""
+    tail_chars = len(request_detector.text) - request_detector.request_end
+    if output_tokens and request_detector.text:
+        tail_tokens = output_tokens * tail_chars / len(request_detector.text)
+    else:
+        tail_tokens = count_tokens(request_detector.text[request_detector.request_end:])
+
+    early_abort_baseline.observe(tail_tokens, tail_seconds)
+    SSR_RETRIEVAL_TAIL_TOKENS.observe(tail_tokens, **metric_labels)
+    SSR_RETRIEVAL_TAIL_SECONDS.observe(tail_seconds, **metric_labels)
+    span.set_attribute("retrieval_tail_output_tokens", round(tail_tokens, 1))
+    span.set_attribute("retrieval_tail_seconds", round(tail_seconds, 3))
+
+
+async def load_prompt_pack(key: PromptPackKey) -> PromptPack:
+    """Read scenario, conundrum and action plan for a class/lesson/action plan."""
+    class_selection, lesson, action_plan_name = key
+    scenario, conundrum, action_plan = await asyncio.gather(
+        get_llm_file_async(class_selection, "", "scenario.txt"),
+        get_llm_file_async(class_selection, "conundrums", lesson),
+        get_llm_file_async(class_selection, "actionplans", action_plan_name),
+    )
+    scenario = scenario or ""
+
+    sizes = {}
+    for name, text in (
+        ("scenario", scenario),
+        ("conundrum", conundrum),
+        ("action_plan", action_plan),
+    ):
+        sizes[f"{name}_bytes"] = len((text or "").encode("utf-8"))
+        sizes[f"{name}_tokens"] = count_tokens(text)
+
+    return PromptPack(
+        key=key,
+        scenario=scenario,
+        conundrum=conundrum,
+        action_plan=action_plan,
+        system_prefix=PromptBuilder.build_system_prefix(scenario, conundrum, action_plan),
+        version=prompt_pack_version(scenario, conundrum or "", action_plan or ""),
+        sizes=sizes,
+        loaded_at=time.monotonic(),
+    )
+
+
+prompt_pack_cache = PromptPackCache(
+    load_prompt_pack, ttl=prompt_pack_ttl, max_entries=prompt_pack_max_entries
+)
+
+
+def record_prefetch_result(
+    metric_labels: Dict[str, str],
+    prefetched_keys: List[str],
+    holdout: bool,
+    has_ssr_request: bool,
+    requested_keys: List[str],
+) -> None:
+    """Count what the first pass did with (or, for holdouts, without) prefetched content."""
+    if not holdout:
+        result = "requested" if has_ssr_request else "answered"
+    elif not has_ssr_request:
+        result = "holdout_answered"
+    elif set(requested_keys) & set(prefetched_keys):
+        result = "holdout_match"
+    else:
+        result = "holdout_no_match"
+    SSR_PREFETCHES.inc(result=result, **metric_labels)
+
+
+response_cache = ResponseCache(
+    response_cache_classes, ttl=response_cache_ttl, max_entries=response_cache_max_entries
+)
+
+
+async def invoke_llm_with_ssr(
     p_SessionCache: "SessionCache", p_Request: PyMessage, p_sessionKey: str
 ) -> str:
-    global LastResponse
+    LLMMessage = ""
+    async for event, data in run_ssr_loop(p_SessionCache, p_Request):
+        if event in ("final", "error"):
+            LLMMessage = data["text"]
+    return LLMMessage
+
+
+async def run_ssr_loop(
+    p_SessionCache: "SessionCache", p_Request: PyMessage, stream: bool = False
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Run the SSR loop for one user request, yielding (event, data) pairs:
+      - progress: an LLM pass is starting or SSR content is being loaded
+      - token:    answer text as it is generated (stream=True only)
+      - reset:    discard streamed text, the pass turned out to request content
+      - final:    the response text, as returned by /chatbot/, and token usage
+      - error:    the error text returned to the user
+    """
+    cache_key: Optional[str] = None
     try:
         PreviouslyRequested: List[str] = []
+        # Every key the model requested this turn, for the co-request statistics
+        turn_requested_keys: List[str] = []
+        companions_loaded = False
+        # Turns held out load no companions, so the statistics keep measuring what
+        # the model asks for on its own
+        corequest_holdout = random.random() < ssr_corequest_holdout
 
         # start by getting the various prompt components.
         # The p_Request contains the Lesson, Conundrum (Lesson), ActionPlan,
-        scenario = (
-            get_llm_file(
-                p_Request.classSelection,
-                "",
-                "scenario.txt",
-                p_sessionKey,
-                p_Request.classSelection or "",
-                p_Request.lesson or "",
-                p_Request.actionPlan or "",
+        with start_span("prompt.components") as components_span:
+            pack = await prompt_pack_cache.get(
+                p_Request.classSelection, p_Request.lesson, p_Request.actionPlan
             )
-            or ""
-        )
+            components_span.set_attribute("version", pack.version)
+            components_span.set_attribute("sizes", pack.sizes)
+            scenario, conundrum, action_plan = pack.scenario, pack.conundrum, pack.action_plan
 
-        conundrum = get_llm_file(
-            p_Request.classSelection,
-            "conundrums",
-            p_Request.lesson,
-            p_sessionKey,
-            p_Request.classSelection or "",
-            p_Request.lesson or "",
-            p_Request.actionPlan or "",
-        )
-        if conundrum is None:
-            raise HTTPException(status_code=404, detail="Conundrum file not found")
-
-        action_plan = get_llm_file(
-            p_Request.classSelection,
-            "actionplans",
-            p_Request.actionPlan,
-            p_sessionKey,
-            p_Request.classSelection or "",
-            p_Request.lesson or "",
-            p_Request.actionPlan or "",
-        )
-        if action_plan is None:
-            raise HTTPException(status_code=404, detail="action_plan file not found")
+            if conundrum is None:
+                raise HTTPException(status_code=404, detail="Conundrum file not found")
+
+            if action_plan is None:
+                raise HTTPException(status_code=404, detail="action_plan file not found")
 
         actionPlan = action_plan  # + get_result_formatting()  Disabled for now. Not sure why this is here.
 
-        conversation_history = (
-            p_SessionCache.m_simpleCounterLLMConversation.get_all_previous_messages()
-        )
         content_loader = SSRContentLoader()
         ssr_state = SSRIterationState()
 
+        # None until the manifest is built; empty when the class has no ssrcontent,
+        # in which case the SSR scaffolding is left out of the prompt
+        ssr_catalog = ssr_manifest.catalog(p_Request.classSelection)
+        ssr_enabled = ssr_manifest.entries(p_Request.classSelection) != {}
+        catalog_content = (
+            f"<AvailableContent>{', '.join(ssr_catalog)}</AvailableContent>\n"
+            if ssr_catalog
+            else ""
+        )
+
+        # Send only the newest messages that fit the history budget
+        conversation = p_SessionCache.m_simpleCounterLLMConversation
+        previously_dropped = conversation.history_window_dropped
+        conversation_history = conversation.get_history_window(history_token_budget)
+        if conversation.history_window_dropped > previously_dropped:
+            ssr_state.conversation_truncated = True
+            logger.info(
+                "Conversation exceeded history budget",
+                extra={
+                    "history_messages": str(len(conversation_history)),
+                    "dropped_messages": str(conversation.history_window_dropped),
+                },
+            )
+        metric_labels = {
+            "provider": model_provider,
+            "model": model,
+            "class_selection": p_Request.classSelection or "",
+        }
+
+        turn_start = len(conversation.conversation)
+        if response_cache.enabled_for(p_Request.classSelection):
+            with start_span("response_cache.lookup") as cache_span:
+                key = response_cache_key(
+                    p_Request.classSelection,
+                    p_Request.lesson,
+                    p_Request.actionPlan,
+                    conversation_history,
+                    p_Request.text,
+                )
+                cached = await response_cache.lookup(key)
+                cache_span.set_attribute("hit", cached is not None)
+
+            if cached is not None:
+                for role, content, conv_content in cached.messages:
+                    conversation.add_message(role, content, conv_content)
+                if conversation_compaction:
+                    conversation.compact(
+                        conversation_summarizer,
+                        compaction_trigger_tokens,
+                        compaction_keep_tokens,
+                    )
+                LLMMessage = cached.final["text"]
+                if ssr_state.conversation_truncated:
+                    LLMMessage = (
+                        "Old Conversations getting dropped.  Consider starting a new Conversation\n"
+                        + LLMMessage
+                    )
+                yield "final", {
+                    **cached.final,
+                    "text": LLMMessage,
+                    "usage": format_token_usage_message(0, 0, 0),
+                    "input_tokens": 0,
+                    "output_tokens": 0,
+                    "iterations": 0,
+                    "cached": True,
+                }
+                return
+
+            # This request runs the LLM; identical ones wait for it
+            cache_key = key
+
+        llm = get_llm()
+
+        # Load content up front so the first pass can often answer: the keys this
+        # question needed before (route cache), else the best BM25 matches
+        prefetched_keys: List[str] = []
+        prefetch_source = ""
+        prefetch_holdout = False
+        route = None
+        if ssr_route_cache_enabled and ssr_enabled:
+            route = ssr_route(
+                p_Request.classSelection, p_Request.lesson, p_Request.actionPlan, p_Request.text
+            )
+            route_result, route_keys = ssr_route_cache.lookup(route)
+            SSR_ROUTE_LOOKUPS.inc(result=route_result, **metric_labels)
+            if route_keys:
+                prefetched_keys = route_keys
+                prefetch_source = "route"
+                # Held out passes run without the keys, to keep checking they are needed
+                prefetch_holdout = random.random() < ssr_route_holdout
+
+        if not prefetched_keys and ssr_prefetch and ssr_enabled:
+            matches = ssr_retriever.search(
+                p_Request.classSelection,
+                p_Request.text,
+                ssr_prefetch_max_keys,
+                ssr_prefetch_min_score,
+            )
+            prefetched_keys = [key for key, _ in matches]
+            prefetch_source = "bm25"
+            prefetch_holdout = bool(prefetched_keys) and random.random() < ssr_prefetch_holdout
+            if not prefetched_keys:
+                SSR_PREFETCHES.inc(result="skipped", **metric_labels)
+
+        if prefetched_keys:
+            with start_span(
+                "ssr.prefetch", source=prefetch_source, keys=prefetched_keys
+            ) as prefetch_span:
+                prefetch_span.set_attribute("holdout", prefetch_holdout)
+                if not prefetch_holdout:
+                    loaded = await content_loader.load_content_files(
+                        p_Request, prefetched_keys
+                    )
+                    ssr_state.additional_content += loaded.xml
+                    ssr_state.loaded_content_message = loaded.status_message
+                    PreviouslyRequested.extend(loaded.loaded_keys)
+                    prefetch_span.set_attribute("deferred_keys", loaded.deferred_keys)
+
         logger.info(
             "Start LLM processing loop",
             extra={
-                "session_key": p_sessionKey,
                 "max_iterations": str(SSR_MAX_ITERATIONS),
-                "class_selection": p_Request.classSelection or "",
-                "lesson": p_Request.lesson or "",
-                "action_plan": p_Request.actionPlan or "",
+                "prefetched_keys": prefetched_keys,
             },
         )
 
         while True:
             ssr_state.increment_iteration()
 
-            import time
-            TempAdditionalContent = ssr_state.additional_content
-            current_time = time.strftime("%Y-%m-%d %H:%M:%S")
-            temp_additional_content = (
-                    f"<CURRENT_DATE_TIME>{current_time}</CURRENT_DATE_TIME>\n"
-                    + TempAdditionalContent
-                    + "<PreviouslyRequested>"
-                    + ", ".join(PreviouslyRequested)
-                    + "</PreviouslyRequested>\n"
-            )
-
-            messages = PromptBuilder.build_prompt(
-                scenario,
-                conundrum,
-                temp_additional_content,
-                conversation_history,
-                p_Request.text,
-                actionPlan,
-                ssr_state.loaded_content_message,
-            )
+            yield "progress", {
+                "stage": "llm",
+                "iteration": ssr_state.iteration_count,
+                "message": f"SSR pass {ssr_state.iteration_count}",
+            }
+
+            with start_span(
+                "ssr.iteration", iteration=ssr_state.iteration_count
+            ) as iteration_span:
+                TempAdditionalContent = ssr_state.additional_content
+                current_time = time.strftime("%Y-%m-%d %H:%M:%S")
+                temp_additional_content = (
+                        f"<CURRENT_DATE_TIME>{current_time}</CURRENT_DATE_TIME>\n"
+                        + TempAdditionalContent
+                )
+                if ssr_enabled:
+                    temp_additional_content += (
+                        catalog_content
+                        + "<PreviouslyRequested>"
+                        + ", ".join(PreviouslyRequested)
+                        + "</PreviouslyRequested>\n"
+                    )
 
+                with start_span("prompt.build"):
+                    messages = PromptBuilder.build_prompt(
+                        scenario,
+                        conundrum,
+                        temp_additional_content,
+                        conversation_history,
+                        p_Request.text,
+                        actionPlan,
+                        ssr_state.loaded_content_message,
+                        system_prefix=pack.system_prefix,
+                    )
 
-            # transform tuples into json and dump as string
-            parsed_messages = (
-                p_SessionCache.m_simpleCounterLLMConversation.get_serializable_conversation()
-            )
+                    prompt_audit.log_prompt(
+                        ssr_state.iteration_count,
+                        p_Request.text,
+                        messages,
+                        p_SessionCache.m_simpleCounterLLMConversation,
+                        {
+                            "scenario": scenario,
+                            "conundrum": conundrum,
+                            "action_plan": actionPlan,
+                            "ssr_content": ssr_state.additional_content,
+                        },
+                    )
 
-            # Turn list of tuples into a readable string
-            messages_str = "\n".join([f"{role.upper()}: {content}" for role, content in messages])
+                with start_span("llm.invoke", provider=model_provider, model=model) as llm_span:
+                    answer_filter = AnswerStreamFilter() if stream else None
+                    request_detector = SSRRequestDetector() if ssr_early_abort and ssr_enabled else None
+                    holdout = request_detector is not None and random.random() < ssr_early_abort_holdout
+                    request_seen_at = 0.0
+                    aborted = False
+                    if answer_filter is None and request_detector is None:
+                        async with llm_semaphore:
+                            with LLM_INVOKE_SECONDS.time(**metric_labels):
+                                LLMResponse = await llm.ainvoke(messages)
+                    else:
+                        # The stream is read in its own task so a slow client reading the
+                        # tokens does not hold an LLM slot
+                        token_queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+                        stream_task = asyncio.create_task(
+                            stream_llm_response(
+                                llm,
+                                messages,
+                                metric_labels,
+                                token_queue,
+                                answer_filter,
+                                request_detector,
+                                holdout,
+                            )
+                        )
+                        try:
+                            while (answer_chunk := await token_queue.get()) is not None:
+                                yield "token", {"text": answer_chunk}
+                            LLMResponse, aborted, request_seen_at = await stream_task
+                        finally:
+                            # The client went away mid-stream
+                            stream_task.cancel()
+                    if aborted:
+                        LLMResponse = AIMessage(
+                            content=request_detector.truncated_response(),
+                            response_metadata=getattr(LLMResponse, "response_metadata", {}),
+                            usage_metadata=getattr(LLMResponse, "usage_metadata", None),
+                        )
+                    LLMMessage = extract_message_content(LLMResponse)
+                    request_token_count, response_token_count = get_token_count(LLMResponse)
+                    if aborted:
+                        # Usage arrives with the last chunk, which an aborted stream never gets
+                        request_token_count, response_token_count, estimated = estimate_aborted_usage(
+                            messages, LLMMessage, request_token_count, response_token_count
+                        )
+                        llm_span.set_attribute("usage_estimated", estimated)
+                    llm_span.set_attribute("input_tokens", request_token_count)
+                    llm_span.set_attribute("output_tokens", response_token_count)
+                    cache_read_tokens, cache_creation_tokens = get_cached_token_count(LLMResponse)
+                    if cache_read_tokens or cache_creation_tokens:
+                        LLM_CACHE_READ_TOKENS.inc(cache_read_tokens, **metric_labels)
+                        LLM_CACHE_CREATION_TOKENS.inc(cache_creation_tokens, **metric_labels)
+                        llm_span.set_attribute("cache_read_tokens", cache_read_tokens)
+                        llm_span.set_attribute("cache_creation_tokens", cache_creation_tokens)
+
+                    if aborted:
+                        record_early_abort(llm_span, metric_labels)
+                    elif holdout and request_seen_at:
+                        record_retrieval_tail(
+                            llm_span,
+                            metric_labels,
+                            request_detector,
+                            response_token_count,
+                            time.perf_counter() - request_seen_at,
+                        )
+
+                ssr_state.add_tokens(request_token_count, response_token_count)
+
+                # Process the LLM response for SSR content requests
+                with start_span("response.parse"):
+                    response_content = extract_message_content(LLMResponse)
+                    has_ssr_request, requested_keys, answer_text = extract_ssr_content_request(
+                        response_content
+                    )
+                iteration_span.set_attribute("requested_keys", requested_keys)
+
+                if has_ssr_request and answer_filter is not None and answer_filter.emitted:
+                    yield "reset", {}
+
+                if prefetch_source == "bm25" and ssr_state.iteration_count == 1:
+                    record_prefetch_result(
+                        metric_labels,
+                        prefetched_keys,
+                        prefetch_holdout,
+                        has_ssr_request,
+                        requested_keys,
+                    )
 
-            # Enforce 2 MB limit
-            MAX_LOG_SIZE = 2 * 1024 * 1024  # 2 MB
-            if len(messages_str) > MAX_LOG_SIZE:
-                messages_str = messages_str[:MAX_LOG_SIZE] + "... [TRUNCATED]"
+                if route is not None and ssr_state.iteration_count == 1:
+                    first_pass_keys = requested_keys if has_ssr_request else []
+                    if prefetch_source == "route":
+                        if prefetch_holdout:
+                            route_preload_result = "holdout"
+                        else:
+                            route_preload_result = "requested" if has_ssr_request else "answered"
+                        SSR_ROUTE_PRELOADS.inc(result=route_preload_result, **metric_labels)
+                    # Only passes without preloaded content show what the question needs;
+                    # a pass with it would only confirm the preload
+                    if not prefetched_keys or prefetch_holdout:
+                        ssr_route_cache.record(route, first_pass_keys)
+
+                if requested_keys:
+                    PreviouslyRequested.extend(requested_keys)
+                    turn_requested_keys.extend(requested_keys)
 
-            if ssr_state.iteration_count == 1:
                 logger.info(
-                    f"USER REQUEST :({p_Request.text}).  LLM REQUEST : \n{messages_str}",
+                    f"LLM RESPONSE :\n{LLMMessage}",
                     extra={
-                        "session_key": p_sessionKey,
-                        "messages": parsed_messages,
-                        "class_selection": p_Request.classSelection or "",
-                        "lesson": p_Request.lesson or "",
-                        "action_plan": p_Request.actionPlan or "",
-                    },
-                )
-            else:
-                logger.info(
-                    f"SSR REQUEST : ({p_Request.text})\nLLM REQUEST :({messages_str})",
-                    extra={
-                        "session_key": p_sessionKey,
-                        "messages": parsed_messages,
-                        "class_selection": p_Request.classSelection or "",
-                        "lesson": p_Request.lesson or "",
-                        "action_plan": p_Request.actionPlan or "",
+                        "total_input_tokens": str(ssr_state.total_input_tokens),
+                        "total_output_tokens": str(ssr_state.total_output_tokens),
+                        "llm_response": extract_message_content(LLMResponse),
                     },
                 )
 
-            LLMResponse = llm.invoke(messages)
-            LLMMessage = extract_message_content(LLMResponse)
-            request_token_count, response_token_count = get_token_count(
-                LLMResponse,
-                p_sessionKey,
-                p_Request.classSelection or "",
-                p_Request.lesson or "",
-                p_Request.actionPlan or "",
-            )
-
-            ssr_state.add_tokens(request_token_count, response_token_count)
-
-            # Process the LLM response for SSR content requests
-            response_content = extract_message_content(LLMResponse)
-            has_ssr_request, requested_keys, answer_text = extract_ssr_content_request(
-                response_content
-            )
-
-            if requested_keys:
-                PreviouslyRequested.extend(requested_keys)
+                if not has_ssr_request:
+                    if answer_text:
+                        # SSR  response without content request - return final answer
+                        LLMMessage = format_token_usage_message(
+                            ssr_state.total_input_tokens,
+                            ssr_state.total_output_tokens,
+                            ssr_state.iteration_count,
+                        )
+                        LLMMessage += answer_text
+                        logger.info(
+                            f"SSR USER RESPONSE : ({LLMMessage})",
+                            extra={
+                                "total_input_tokens": str(ssr_state.total_input_tokens),
+                                "total_output_tokens": str(ssr_state.total_output_tokens),
+                                "llm_response": extract_message_content(LLMResponse),
+                            },
+                        )
+                    else:
+                        logger.info(
+                            f"USER RESPONSE :\n{LLMMessage}",
+                            extra={
+                                "total_input_tokens": str(ssr_state.total_input_tokens),
+                                "total_output_tokens": str(ssr_state.total_output_tokens),
+                                "llm_response": extract_message_content(LLMResponse),
+                            },
+                        )
+                    # No SSR processing needed - break out of loop
+                    break
+                # if more content is being requested and exceeded max iterations, use what you have.
+                if ssr_state.has_exceeded_max_iterations():
 
-            logger.info(
-                f"LLM RESPONSE :\n{LLMMessage}",
-                extra={
-                    "session_key": p_sessionKey,
-                    "total_input_tokens": str(ssr_state.total_input_tokens),
-                    "total_output_tokens": str(ssr_state.total_output_tokens),
-                    "llm_response": extract_message_content(LLMResponse),
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
-            )
-
-            if not has_ssr_request:
-                if answer_text:
-                    # SSR  response without content request - return final answer
                     LLMMessage = format_token_usage_message(
                         ssr_state.total_input_tokens,
                         ssr_state.total_output_tokens,
                         ssr_state.iteration_count,
                     )
-                    LLMMessage += answer_text
-                    logger.info(
-                        f"SSR USER RESPONSE : ({LLMMessage})",
-                        extra={
-                            "session_key": p_sessionKey,
-                            "total_input_tokens": str(ssr_state.total_input_tokens),
-                            "total_output_tokens": str(ssr_state.total_output_tokens),
-                            "llm_response": extract_message_content(LLMResponse),
-                            "class_selection": p_Request.classSelection or "",
-                            "lesson": p_Request.lesson or "",
-                            "action_plan": p_Request.actionPlan or "",
-                        },
-                    )
-                else:
-                    logger.info(
-                        f"USER RESPONSE :\n{LLMMessage}",
+                    LLMMessage += answer_text + "\n"
+                    LLMMessage += "**SSR exceeded loop count.  Answer may not have considered all information**"
+
+                    logger.warning(
+                        "SSR Loop exceeded maximum iterations",
                         extra={
-                            "session_key": p_sessionKey,
+                            "max_iterations": str(SSR_MAX_ITERATIONS),
+                            "iteration_count": str(ssr_state.iteration_count),
+                            "reason": "iteration_count > SSR_MAX_ITERATIONS",
+                            "requested_keys": requested_keys,
+                            "answer_text": answer_text,
                             "total_input_tokens": str(ssr_state.total_input_tokens),
                             "total_output_tokens": str(ssr_state.total_output_tokens),
-                            "llm_response": extract_message_content(LLMResponse),
-                            "class_selection": p_Request.classSelection or "",
-                            "lesson": p_Request.lesson or "",
-                            "action_plan": p_Request.actionPlan or "",
+                            "llm_message": LLMMessage,
                         },
                     )
-                # No SSR processing needed - break out of loop
-                break
-            # if more content is being requested and exceeded max iterations, use what you have.
-            if ssr_state.has_exceeded_max_iterations():
+                    break
 
-                LLMMessage = format_token_usage_message(
-                    ssr_state.total_input_tokens,
-                    ssr_state.total_output_tokens,
-                    ssr_state.iteration_count,
-                )
-                LLMMessage += answer_text + "\n"
-                LLMMessage += "**SSR exceeded loop count.  Answer may not have considered all information**"
-
-                logger.warning(
-                    "SSR Loop exceeded maximum iterations",
+                # Log the reason the loop is continuing
+                logger.info(
+                    f"SSR loop continuing because content ({requested_keys}) requested",
                     extra={
-                        "session_key": p_sessionKey,
-                        "max_iterations": str(SSR_MAX_ITERATIONS),
                         "iteration_count": str(ssr_state.iteration_count),
-                        "reason": "iteration_count > SSR_MAX_ITERATIONS",
+                        "reason": "has_ssr_request is True and within max iterations",
                         "requested_keys": requested_keys,
-                        "answer_text": answer_text,
-                        "total_input_tokens": str(ssr_state.total_input_tokens),
-                        "total_output_tokens": str(ssr_state.total_output_tokens),
-                        "llm_message": LLMMessage,
-                        "class_selection": p_Request.classSelection or "",
-                        "lesson": p_Request.lesson or "",
-                        "action_plan": p_Request.actionPlan or "",
+                        "max_iterations": str(SSR_MAX_ITERATIONS),
                     },
                 )
-                break
 
-            # Log the reason the loop is continuing
-            logger.info(
-                f"SSR loop continuing because content ({requested_keys}) requested",
-                extra={
-                    "session_key": p_sessionKey,
-                    "iteration_count": str(ssr_state.iteration_count),
-                    "reason": "has_ssr_request is True and within max iterations",
-                    "requested_keys": requested_keys,
-                    "max_iterations": str(SSR_MAX_ITERATIONS),
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
-            )
+                # We are adding in a new user request acknowledging file content added and its response
+                p_SessionCache.m_simpleCounterLLMConversation.add_message(
+                    "user", p_Request.text, None
+                )
+                p_SessionCache.m_simpleCounterLLMConversation.add_message(
+                    "assistant", extract_message_content(LLMResponse), None
+                )
 
-            # We are adding in a new user request acknowledging file content added and its response
-            p_SessionCache.m_simpleCounterLLMConversation.add_message(
-                "user", p_Request.text, None
-            )
-            p_SessionCache.m_simpleCounterLLMConversation.add_message(
-                "assistant", extract_message_content(LLMResponse), None
-            )
+                yield "progress", {
+                    "stage": "loading_content",
+                    "iteration": ssr_state.iteration_count,
+                    "keys": requested_keys,
+                    "message": f"Loading content {', '.join(requested_keys)}",
+                }
+
+                with start_span("ssr.load_content", keys=requested_keys) as load_span:
+                    # Also load the keys usually requested along with these, so the
+                    # model does not need another pass to ask for them
+                    companion_keys: List[str] = []
+                    if ssr_corequests_enabled:
+                        companion_keys = [
+                            key
+                            for key in ssr_corequests.associated(
+                                p_Request.classSelection, requested_keys, ssr_corequest_max_keys
+                            )
+                            if key not in PreviouslyRequested
+                        ]
+                        if companion_keys and corequest_holdout:
+                            SSR_COMPANION_KEYS.inc(
+                                len(companion_keys), result="holdout", **metric_labels
+                            )
+                            companion_keys = []
+
+                    loaded = await content_loader.load_content_files(
+                        p_Request, requested_keys, companion_keys
+                    )
+                    load_span.set_attribute("deferred_keys", loaded.deferred_keys)
 
-            content_loaded, loaded_status = content_loader.load_content_files(
-                p_Request, p_sessionKey, requested_keys
-            )
+                    loaded_companions = [key for key in loaded.loaded_keys if key in companion_keys]
+                    load_span.set_attribute("companion_keys", loaded_companions)
+                    if loaded_companions:
+                        companions_loaded = True
+                        PreviouslyRequested.extend(loaded_companions)
+                        SSR_COMPANION_KEYS.inc(
+                            len(loaded_companions), result="loaded", **metric_labels
+                        )
 
-            ssr_state.additional_content += content_loaded
-            ssr_state.loaded_content_message = loaded_status
+                ssr_state.additional_content += loaded.xml
+                ssr_state.loaded_content_message = loaded.status_message
 
             # End of while loop
 
-        # Logging and adding messages to cache.  We did not
-        p_SessionCache.m_simpleCounterLLMConversation.add_message(
-            "user", p_Request.text, p_Request.text
-        )
-        p_SessionCache.m_simpleCounterLLMConversation.add_message(
-            "assistant", extract_message_content(LLMResponse), LLMMessage
-        )
+        SSR_ITERATIONS.observe(ssr_state.iteration_count, **metric_labels)
 
-        # Check if conversation size management is needed
-        user_conversation_size = (
-            p_SessionCache.m_simpleCounterLLMConversation.get_total_conv_content_bytes()
-        )
-        if calculate_conversation_size_exceeds_limit(
-            user_conversation_size, max_conversation_tokens
-        ):
-            ssr_state.conversation_truncated = True
-            logger.info(
-                "Conversation exceeded maximum size",
-                extra={
-                    "session_key": p_sessionKey,
-                    "user_conversation_size": str(user_conversation_size),
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
+        # Loaded companions change what the model goes on to request, so only turns
+        # without them are counted
+        if ssr_corequests_enabled and not companions_loaded:
+            ssr_corequests.record(
+                p_Request.classSelection,
+                [key for key in turn_requested_keys if key in ssr_catalog],
             )
-            p_SessionCache.m_simpleCounterLLMConversation.prune_oldest_pair()
+        LLM_INPUT_TOKENS.observe(ssr_state.total_input_tokens, **metric_labels)
+        LLM_OUTPUT_TOKENS.observe(ssr_state.total_output_tokens, **metric_labels)
 
-        if ssr_state.conversation_truncated:
-            LLMMessage = (
-                "Old Conversations getting dropped.  Consider starting a new Conversation\n"
-                + LLMMessage
+        with start_span("response.postprocess"):
+            # Logging and adding messages to cache.  We did not
+            p_SessionCache.m_simpleCounterLLMConversation.add_message(
+                "user", p_Request.text, p_Request.text
+            )
+            p_SessionCache.m_simpleCounterLLMConversation.add_message(
+                "assistant", extract_message_content(LLMResponse), LLMMessage
             )
 
-        return LLMMessage
+            if conversation_compaction:
+                # Runs in the background; later turns use the summary once it is ready
+                conversation.compact(
+                    conversation_summarizer,
+                    compaction_trigger_tokens,
+                    compaction_keep_tokens,
+                )
+
+            final = {
+                "text": LLMMessage,
+                "usage": format_token_usage_message(
+                    ssr_state.total_input_tokens,
+                    ssr_state.total_output_tokens,
+                    ssr_state.iteration_count,
+                ),
+                "input_tokens": ssr_state.total_input_tokens,
+                "output_tokens": ssr_state.total_output_tokens,
+                "iterations": ssr_state.iteration_count,
+            }
+            if cache_key is not None and not ssr_state.has_exceeded_max_iterations():
+                # Answers cut short by the iteration limit are not worth sharing
+                response_cache.finish(
+                    cache_key,
+                    CachedResponse(
+                        [
+                            (message["role"], message["content"], message["conv_content"])
+                            for message in conversation.conversation[turn_start:]
+                        ],
+                        dict(final),
+                    ),
+                )
+                cache_key = None
+
+            if ssr_state.conversation_truncated:
+                final["text"] = (
+                    "Old Conversations getting dropped.  Consider starting a new Conversation\n"
+                    + LLMMessage
+                )
+
+        yield "final", final
 
     except Exception as e:
         logger.error(
             "Exception occurred while calling LLM",
             exc_info=True,
             extra={
-                "session_key": p_sessionKey,
                 "error": str(e),
-                "class_selection": p_Request.classSelection if p_Request else "",
-                "lesson": p_Request.lesson if p_Request else "",
-                "action_plan": p_Request.actionPlan if p_Request else "",
             },
         )
-        return f"An error ({e}) occurred processing your request. Please try again."
+        yield "error", {
+            "text": f"An error ({e}) occurred processing your request. Please try again."
+        }
+    finally:
+        if cache_key is not None:
+            # Failed or abandoned; let waiting identical requests run on their own
+            response_cache.finish(cache_key, None)
@@ -1,6 +1,13 @@
+import asyncio
 from datetime import datetime, timedelta
 import json
-from typing import Dict, List, Tuple, Optional, Iterator, TypedDict
+from typing import Dict, List, Tuple, Optional, Iterator, Protocol, TypedDict
+
+from utils.logger import get_logger
+from utils.metrics import CONVERSATION_COMPACTIONS
+from utils.tokens import count_tokens
+
+logger = get_logger()
 
 
 # Type definitions for messages
@@ -10,6 +17,9 @@ class Message(TypedDict):
     role: str  # 'user' or 'assistant'
     content: str
     conv_content: Optional[str]
+    # Token counts of content and conv_content, computed once when added
+    tokens: int
+    conv_tokens: int
 
 
 class SessionData(TypedDict, total=False):
@@ -37,6 +47,17 @@ class ConversationSummaryDict(TypedDict):
 ConversationHistory = List[Message]
 RoleContentTuple = Tuple[str, str]
 
+# Question the rolling summary is presented as the answer to in the history window
+SUMMARY_QUESTION = "Summarize our conversation so far."
+
+
+class Summarizer(Protocol):
+    async def __call__(
+        self, previous_summary: str, messages: List[RoleContentTuple]
+    ) -> str:
+        """Return a summary covering previous_summary followed by messages."""
+        ...
+
 
 class SessionCache:
     def __init__(self, session_key: str, data: SessionData) -> None:
@@ -71,6 +92,13 @@ class SessionCacheManager:
         if session_key in self.sessions:
             del self.sessions[session_key]
 
+    def get_total_conversation_bytes(self) -> int:
+        """Total UTF-8 bytes of message content held across all sessions."""
+        return sum(
+            session.m_simpleCounterLLMConversation.content_bytes
+            for session in list(self.sessions.values())
+        )
+
     def cleanup_idle_sessions(self) -> None:
         now = datetime.utcnow()
         idle_sessions: List[str] = [
@@ -89,6 +117,18 @@ class SimpleCounterLLMConversation:
     def __init__(self) -> None:
         self.conversation: ConversationHistory = []
         self.message_id_counter: int = 1  # Initialize message ID counter
+        # UTF-8 bytes of content and conv_content of all messages, kept for metrics
+        self.content_bytes: int = 0
+        # Messages left out of the last history window, see get_history_window
+        self.history_window_dropped: int = 0
+        # Rolling summary of conversation[:summarized_through], see compact
+        self.summary: str = ""
+        self.summary_tokens: int = 0
+        self.summarized_through: int = 0
+        self.unsummarized_tokens: int = 0
+        self._compaction_task: Optional["asyncio.Task[None]"] = None
+        # Changed whenever messages are removed, so a running compaction is discarded
+        self._generation: int = 0
 
     def add_message(self, role: str, content: str, conv_content: Optional[str]) -> None:
         """
@@ -103,8 +143,14 @@ class SimpleCounterLLMConversation:
             "role": role,
             "content": content,
             "conv_content": conv_content,
+            "tokens": count_tokens(content),
+            "conv_tokens": count_tokens(conv_content),
         }
         self.conversation.append(message)
+        self.unsummarized_tokens += message["tokens"]
+        self.content_bytes += len(content.encode("utf-8")) + len(
+            (conv_content or "").encode("utf-8")
+        )
         self.message_id_counter += 1  # Increment the counter for the next message
         # Reset counter if it's too high; adjust this limit as needed
         if self.message_id_counter > 1e9:
@@ -115,7 +161,17 @@ class SimpleCounterLLMConversation:
         Clears the conversation and resets the message ID counter.
         """
         self.conversation.clear()
+        self.content_bytes = 0
         self.message_id_counter = 1  # Reset counter
+        self.history_window_dropped = 0
+        self._reset_summary()
+
+    def _reset_summary(self) -> None:
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized_through = 0
+        self.unsummarized_tokens = sum(message["tokens"] for message in self.conversation)
+        self._generation += 1
 
     def to_string(self) -> str:
         """
@@ -166,6 +222,113 @@ class SimpleCounterLLMConversation:
         """
         return [(message["role"], message["content"]) for message in self.conversation]
 
+    def get_history_window(self, max_tokens: int) -> List[RoleContentTuple]:
+        """
+        Retrieves the newest messages whose content fits within max_tokens, oldest first.
+        The window starts at a user message so question and answer pairs stay together.
+        Only the selected messages are visited, using the token counts stored on each
+        message; older messages stay in the conversation for export.
+        Messages already folded into the rolling summary are replaced by the summary,
+        presented as the answer to SUMMARY_QUESTION.
+        Args:
+            max_tokens: Token budget for the returned messages.
+        Returns:
+            A list of (role, content) tuples, like get_all_previous_messages.
+        """
+        window: List[RoleContentTuple] = []
+        used_tokens = self.summary_tokens
+        for index in range(len(self.conversation) - 1, self.summarized_through - 1, -1):
+            message = self.conversation[index]
+            if used_tokens + message["tokens"] > max_tokens:
+                break
+            used_tokens += message["tokens"]
+            window.append((message["role"], message["content"]))
+
+        while window and window[-1][0] != "user":
+            window.pop()
+        window.reverse()
+
+        self.history_window_dropped = (
+            len(self.conversation) - self.summarized_through - len(window)
+        )
+        if self.summary:
+            window[:0] = [("user", SUMMARY_QUESTION), ("assistant", self.summary)]
+        return window
+
+    def compact(
+        self, summarizer: Summarizer, trigger_tokens: int, keep_tokens: int
+    ) -> Optional["asyncio.Task[None]"]:
+        """
+        Folds the oldest unsummarized turns into the rolling summary in the background
+        once the unsummarized history exceeds trigger_tokens. The newest turns, up to
+        keep_tokens, are left as they are. Does nothing while a compaction is running.
+        Must be called from the event loop.
+        Returns:
+            The background task, or None if no compaction was started.
+        """
+        if self.unsummarized_tokens <= trigger_tokens:
+            return None
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return None
+
+        # Keep the newest turns within keep_tokens, starting at a user message
+        boundary = len(self.conversation)
+        kept_tokens = 0
+        for index in range(len(self.conversation) - 1, self.summarized_through - 1, -1):
+            message = self.conversation[index]
+            if kept_tokens + message["tokens"] > keep_tokens:
+                break
+            kept_tokens += message["tokens"]
+            if message["role"] == "user":
+                boundary = index
+        if boundary <= self.summarized_through:
+            return None
+
+        messages = [
+            (message["role"], message["content"])
+            for message in self.conversation[self.summarized_through:boundary]
+        ]
+        self._compaction_task = asyncio.get_running_loop().create_task(
+            self._run_compaction(summarizer, messages, boundary, self._generation)
+        )
+        return self._compaction_task
+
+    async def _run_compaction(
+        self,
+        summarizer: Summarizer,
+        messages: List[RoleContentTuple],
+        boundary: int,
+        generation: int,
+    ) -> None:
+        try:
+            summary = await summarizer(self.summary, messages)
+        except Exception:
+            CONVERSATION_COMPACTIONS.inc(result="error")
+            logger.warning("Conversation compaction failed", exc_info=True)
+            return
+
+        if generation != self._generation or not summary:
+            CONVERSATION_COMPACTIONS.inc(result="discarded")
+            return
+
+        folded_tokens = sum(
+            message["tokens"]
+            for message in self.conversation[self.summarized_through:boundary]
+        )
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary) + count_tokens(SUMMARY_QUESTION)
+        self.summarized_through = boundary
+        self.unsummarized_tokens -= folded_tokens
+        CONVERSATION_COMPACTIONS.inc(result="ok")
+        logger.info(
+            "Conversation compacted",
+            extra={
+                "summarized_messages": str(boundary),
+                "summary_tokens": str(self.summary_tokens),
+                "unsummarized_tokens": str(self.unsummarized_tokens),
+            },
+        )
+
     def get_user_conversation_messages(self) -> List[Tuple[str, Optional[str]]]:
         """
         Retrieves all messages from the conversation where conv_content is not None.
@@ -224,34 +387,6 @@ class SimpleCounterLLMConversation:
                 ]  # Return only the content of the last assistant message
         return None  # Return None if no 'assistant' messages are found
 
-    def prune_oldest_pair(self) -> None:
-        """
-        Removes the oldest pair of user and assistant messages from the conversation.
-        This helps conserve space while keeping the conversation balanced.
-        """
-        user_index: Optional[int] = None
-        assistant_index: Optional[int] = None
-
-        # Find the indices of the oldest 'user' and 'assistant' messages
-        for i, message in enumerate(self.conversation):
-            if message["role"] == "user" and user_index is None:
-                user_index = i
-            elif message["role"] == "assistant" and assistant_index is None:
-                assistant_index = i
-            # Stop the loop if both indices are found
-            if user_index is not None and assistant_index is not None:
-                break
-
-        # Remove the oldest pair if both exist
-        if user_index is not None and assistant_index is not None:
-            # Remove the assistant message first if it comes before the user in the list
-            if assistant_index < user_index:
-                self.conversation.pop(assistant_index)
-                self.conversation.pop(user_index - 1)  # Adjust for shifted index
-            else:
-                self.conversation.pop(user_index)
-                self.conversation.pop(assistant_index - 1)  # Adjust for shifted index
-
     def get_serializable_conversation(self) -> List[Message]:
         """
         Returns the entire conversation in a JSON-friendly format.
@@ -1,30 +1,54 @@
+import asyncio
+import json
 import re
+import time
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Response, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, Header
 from fastapi.responses import (
     HTMLResponse,
     FileResponse,
     JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
 )
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
 import uuid
 import uvicorn
+from typing import Optional, Tuple
 
 from utils.types import PyMessage
 
 # Load environmental variables file from .env
 load_dotenv()
 
-from utils.logger import setup_logger  # noqa: E402
+from utils.logger import LOKI_RECORD_RESULTS, get_loki_handler, setup_logger  # noqa: E402
+from utils.log_context import (  # noqa: E402
+    bind_log_context,
+    reset_log_context,
+    set_log_context,
+)
 from constants import (  # noqa: E402
     cloud_mode_enabled,
     env,
+    loki_async,
+    loki_batch_size,
+    loki_compression,
+    loki_drop_policy,
+    loki_flush_interval,
     loki_labels,
     loki_org_id,
     loki_password,
+    loki_pool_maxsize,
+    loki_push_format,
+    loki_queue_size,
+    loki_spool_dir,
+    loki_spool_max_bytes,
+    loki_spool_segment_bytes,
     loki_url,
     loki_user,
+    log_sampling_rules,
+    log_sampling_summary_interval,
     mailgun_enabled,
     port,
     model,
@@ -34,6 +58,9 @@ from constants import (  # noqa: E402
     temperature,
     frequency_penalty,
     presence_penalty,
+    ssr_corequests_enabled,
+    trace_export_dir,
+    tracing_enabled,
     validate_ssr_configuration,
 )
 
@@ -41,12 +68,32 @@ from constants import (  # noqa: E402
 from utils.html_export import HTMLConversationExporter  # noqa: E402
 from utils.email import send_email  # noqa: E402
 from utils.llm import validate_access_key  # noqa: E402
+from utils.metrics import (  # noqa: E402
+    CHATBOT_REQUEST_SECONDS,
+    CHATBOT_STREAM_FIRST_TOKEN_SECONDS,
+    CONVERSATION_BYTES,
+    LIVE_SESSIONS,
+    LOKI_BATCHES,
+    LOKI_BYTES,
+    LOKI_QUEUED_RECORDS,
+    LOKI_RECORDS,
+    LOKI_SPOOL_BYTES,
+    REGISTRY,
+)
 from utils.filesystem import (  # noqa: E402
     check_directory_exists,
     list_directory,
 )
-from SessionCache import SessionCacheManager, session_manager, SessionData  # noqa: E402
-from LLM_Handler import invoke_llm_with_ssr  # noqa: E402
+from utils.tokens import get_token_counter  # noqa: E402
+from utils.tracing import setup_tracing, shutdown_tracing, start_span  # noqa: E402
+from SessionCache import SessionCache, SessionCacheManager, session_manager, SessionData  # noqa: E402
+from LLM_Handler import (  # noqa: E402
+    invoke_llm_with_ssr,
+    llm_client,
+    run_ssr_loop,
+    ssr_corequests,
+    ssr_manifest,
+)
 
 
 def get_session_manager() -> SessionCacheManager:
@@ -66,8 +113,43 @@ logger = setup_logger(
     loki_password=loki_password,
     loki_org_id=loki_org_id,
     loki_labels=loki_labels,
+    loki_async=loki_async,
+    loki_batch_size=loki_batch_size,
+    loki_flush_interval=loki_flush_interval,
+    loki_queue_size=loki_queue_size,
+    loki_drop_policy=loki_drop_policy,
+    loki_push_format=loki_push_format,
+    loki_compression=loki_compression,
+    loki_pool_maxsize=loki_pool_maxsize,
+    loki_spool_dir=loki_spool_dir,
+    loki_spool_max_bytes=loki_spool_max_bytes,
+    loki_spool_segment_bytes=loki_spool_segment_bytes,
+    sampling_rules=log_sampling_rules,
+    sampling_summary_interval=log_sampling_summary_interval,
 )
 
+setup_tracing(tracing_enabled, trace_export_dir)
+
+
+# Values computed when /metrics is scraped
+LIVE_SESSIONS.callback = lambda: len(session_manager.sessions)
+CONVERSATION_BYTES.callback = session_manager.get_total_conversation_bytes
+loki_handler = get_loki_handler()
+if loki_handler is not None:
+    LOKI_RECORDS.callback = lambda: {
+        (name,): value
+        for name, value in loki_handler.stats().items()
+        if name in LOKI_RECORD_RESULTS
+    }
+    LOKI_BATCHES.callback = lambda: loki_handler.stats()["batches"]
+    LOKI_BYTES.callback = lambda: {
+        (stage,): loki_handler.transport.stats()[f"bytes_{stage}"]
+        for stage in ("uncompressed", "sent")
+    }
+    LOKI_QUEUED_RECORDS.callback = lambda: loki_handler.stats()["queued"]
+    if loki_handler.spool is not None:
+        LOKI_SPOOL_BYTES.callback = lambda: loki_handler.spool.stats()["spool_bytes"]
+
 
 app = FastAPI(title="TutorBot", description="Your personal tutor", version="0.0.1")
 # Mount the static files directory
@@ -85,28 +167,17 @@ app.add_middleware(
 
 
 def startup_event():
-    logger.info(
-        "Application startup",
-        extra={"session_key": "", "class_selection": "", "lesson": "", "action_plan": ""},
-    )
+    logger.info("Application startup")
     logger.info(
         "Model configuration",
         extra={
             "model": model,
-            "session_key": "",
-            "class_selection": "",
-            "lesson": "",
-            "action_plan": "",
         },
     )
     logger.info(
         "Temperature configuration",
         extra={
             "temperature": str(temperature),
-            "session_key": "",
-            "class_selection": "",
-            "lesson": "",
-            "action_plan": "",
         },
     )
     if top_p:
@@ -114,10 +185,6 @@ def startup_event():
             "Top P configuration",
             extra={
                 "top_p": str(top_p),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
     if frequency_penalty:
@@ -125,10 +192,6 @@ def startup_event():
             "Frequency Penalty configuration",
             extra={
                 "frequency_penalty": str(frequency_penalty),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
     if presence_penalty:
@@ -136,19 +199,23 @@ def startup_event():
             "Presence Penalty configuration",
             extra={
                 "presence_penalty": str(presence_penalty),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
+    # Load the tokenizer now rather than on the first request
+    get_token_counter()
+    llm_client.start()
+    ssr_manifest.start()
+    if ssr_corequests_enabled:
+        ssr_corequests.start()
 
 
 def shutdown_event():
-    logger.info(
-        "Application shutdown",
-        extra={"session_key": "", "class_selection": "", "lesson": "", "action_plan": ""},
-    )
+    logger.info("Application shutdown")
+    llm_client.stop()
+    ssr_manifest.stop()
+    if ssr_corequests_enabled:
+        ssr_corequests.stop()
+    shutdown_tracing()
 
 
 app.add_event_handler("startup", lambda: startup_event())
@@ -186,32 +253,29 @@ async def check_session_key(request: Request, call_next):
             response.headers["Access-Control-Allow-Headers"] = "Content-Type"
         return response
 
-    if request.url.path not in ["/set-cookie/", "/favicon.ico", "/"]:
-        session_key = request.cookies.get("session_key")
-
-        logger.info(
-            "Session key in middleware",
-            extra={
-                "session_key": session_key or "undefined",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
-            },
-        )
-        if not session_key:
-            logger.info(
-                "Session key missing in request",
-                extra={
-                    "request_path": request.url.path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
-                },
-            )
-            raise HTTPException(status_code=401, detail="Session key is missing")
-    response = await call_next(request)
-    return response
+    session_key = request.cookies.get("session_key")
+    log_context_token = set_log_context(session_key=session_key or "")
+    try:
+        if request.url.path not in [
+            "/set-cookie/",
+            "/favicon.ico",
+            "/",
+            "/metrics",
+            "/ready",
+        ]:
+            logger.info("Session key in middleware")
+            if not session_key:
+                logger.info(
+                    "Session key missing in request",
+                    extra={
+                        "request_path": request.url.path,
+                    },
+                )
+                raise HTTPException(status_code=401, detail="Session key is missing")
+        response = await call_next(request)
+        return response
+    finally:
+        reset_log_context(log_context_token)
 
 
 @app.get("/set-cookie/")
@@ -226,116 +290,121 @@ async def set_cookie(
         )  # Use existing session key if available, otherwise set a default or generate a new one
         session_data = SessionData()  # Create a proper SessionData object
         manager.add_session(session_key, session_data)
+        bind_log_context(session_key=session_key)
         response.set_cookie(
             key="session_key",
             value=session_key,
             samesite="lax",
         )
-        logger.info(
-            "Cookie set and session created",
-            extra={
-                "session_key": session_key,
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
-            },
-        )
+        logger.info("Cookie set and session created")
         return {"message": "Cookie set and session created"}
     except Exception as e:
         logger.error(
             "Exception caught in set_cookie",
             extra={
-                "session_key": session_key or "undefined",
                 "error": str(e),
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         raise HTTPException(status_code=500, detail="Error in set_cookie")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    # 503 until the LLM client is created and warmed up, or when creating it failed
+    if not llm_client.ready:
+        return JSONResponse(
+            status_code=503, content={"ready": False, "error": llm_client.error}
+        )
+    return JSONResponse(content={"ready": True})
+
+
+@app.get("/ssr/corequests", include_in_schema=False)
+async def ssr_corequest_stats(
+    class_selection: Optional[str] = None,
+    access_key: Optional[str] = Header(None, alias="X-Access-Key"),
+):
+    # Counts of SSR content keys requested together, per class (see SSR_COREQUESTS).
+    # Names course content, so unlike /metrics it requires an access key, checked
+    # even when cloud mode is off; a session key alone can be had by anyone
+    is_valid_key = bool(access_key) and await asyncio.to_thread(
+        validate_access_key, access_key
+    )
+    if not is_valid_key:
+        raise HTTPException(status_code=403, detail="Invalid access key")
+    return JSONResponse(content=ssr_corequests.snapshot(class_selection))
+
+
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     return FileResponse("static/favicon.ico")
 
 
 # Define your chatbot logic
-def generate_response(p_session_key: str, p_Request: PyMessage) -> str:
+def get_chat_session(
+    p_session_key: str, p_Request: PyMessage
+) -> Tuple[Optional[SessionCache], str]:
+    """Return the session for a chat request, or the reply explaining why it cannot be answered."""
 
     sessionCache = session_manager.get_session(p_session_key)
 
     if sessionCache:
         if not p_Request.classSelection:
             # logger already initialized globally
-            logger.error(
-                "Session did not specify Conundrum",
-                extra={
-                    "session_key": p_session_key,
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
-            )
-            return "You must select a lesson to use this Bot"
+            logger.error("Session did not specify Conundrum")
+            return None, "You must select a lesson to use this Bot"
         if not p_Request.lesson:
             # logger already initialized globally
-            logger.error(
-                "Session did not specify Lesson",
-                extra={
-                    "session_key": p_session_key,
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
-            )
-            return "You must select a lesson to use this Bot"
+            logger.error("Session did not specify Lesson")
+            return None, "You must select a lesson to use this Bot"
         if not p_Request.actionPlan:
             # logger already initialized globally
-            logger.error(
-                "Session did not specify Action Plan",
-                extra={
-                    "session_key": p_session_key,
-                    "class_selection": p_Request.classSelection or "",
-                    "lesson": p_Request.lesson or "",
-                    "action_plan": p_Request.actionPlan or "",
-                },
-            )
-            return "You must select an action plan to use this Bot"
-        return invoke_llm_with_ssr(sessionCache, p_Request, p_session_key)
+            logger.error("Session did not specify Action Plan")
+            return None, "You must select an action plan to use this Bot"
+        return sessionCache, ""
     else:
         response = "Received unknown session key"
         logger.error(
             "Session key not found in generate_response",
             extra={
-                "session_key": p_session_key,
                 "response": response,
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
+        return None, response
+
+
+async def generate_response(p_session_key: str, p_Request: PyMessage) -> str:
+
+    sessionCache, response = get_chat_session(p_session_key, p_Request)
+
+    if sessionCache is None:
         return response
+    return await invoke_llm_with_ssr(sessionCache, p_Request, p_session_key)
 
 
-# Define an endpoint to handle incoming messages
-@app.post("/chatbot/")
-def chatbot_endpoint(request: Request, message: PyMessage) -> JSONResponse:
+async def authorize_chat_request(request: Request, message: PyMessage) -> str:
+    """Check the session cookie and access key of a chat request, returning the session key."""
     session_key = request.cookies.get("session_key")
 
     if not session_key:
         raise HTTPException(status_code=401, detail="Session key is missing")
 
+    bind_log_context(
+        class_selection=message.classSelection or "",
+        lesson=message.lesson or "",
+        action_plan=message.actionPlan or "",
+    )
+
     if cloud_mode_enabled:
         access_key = message.accessKey
 
-        is_valid_key = validate_access_key(
-            access_key,
-            session_key,
-            message.classSelection or "",
-            message.lesson or "",
-            message.actionPlan or "",
-        )
+        is_valid_key = await asyncio.to_thread(validate_access_key, access_key)
 
         if not is_valid_key:
             raise HTTPException(status_code=403, detail="Invalid access key")
@@ -344,17 +413,87 @@ def chatbot_endpoint(request: Request, message: PyMessage) -> JSONResponse:
             logger.info(
                 "Session validated access key",
                 extra={
-                    "session_key": session_key,
                     "access_key": access_key,
-                    "class_selection": message.classSelection or "",
-                    "lesson": message.lesson or "",
-                    "action_plan": message.actionPlan or "",
                 },
             )
 
-    response_text = generate_response(session_key, message)
+    return session_key
+
+
+def format_sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Define an endpoint to handle incoming messages
+@app.post("/chatbot/")
+async def chatbot_endpoint(request: Request, message: PyMessage) -> JSONResponse:
+    session_key = await authorize_chat_request(request, message)
+
+    with start_span(
+        "request",
+        path=request.url.path,
+        class_selection=message.classSelection or "",
+        lesson=message.lesson or "",
+        action_plan=message.actionPlan or "",
+    ) as request_span, CHATBOT_REQUEST_SECONDS.time(
+        provider=model_provider,
+        model=model,
+        class_selection=message.classSelection or "",
+    ):
+        response_text = await generate_response(session_key, message)
 
     response = JSONResponse(content={"text": response_text})
+    if request_span.trace_id:
+        response.headers["X-Trace-Id"] = request_span.trace_id
+    origin = request.headers.get("origin")
+    if origin in allowed_origins:
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+    return response
+
+
+# Streaming variant of /chatbot/ using Server-Sent Events. Emits progress events
+# during SSR passes, token events as the answer is generated and a final event
+# carrying the same text /chatbot/ returns plus the token usage summary.
+@app.post("/chatbot/stream")
+async def chatbot_stream_endpoint(request: Request, message: PyMessage) -> StreamingResponse:
+    session_key = await authorize_chat_request(request, message)
+    sessionCache, response_text = get_chat_session(session_key, message)
+
+    metric_labels = {
+        "provider": model_provider,
+        "model": model,
+        "class_selection": message.classSelection or "",
+    }
+
+    async def event_stream():
+        started = time.perf_counter()
+        first_token = True
+
+        with start_span(
+            "request",
+            path=request.url.path,
+            class_selection=message.classSelection or "",
+            lesson=message.lesson or "",
+            action_plan=message.actionPlan or "",
+        ), CHATBOT_REQUEST_SECONDS.time(**metric_labels):
+            if sessionCache is None:
+                yield format_sse_event("final", {"text": response_text})
+                return
+
+            async for event, data in run_ssr_loop(sessionCache, message, stream=True):
+                if event == "token" and first_token:
+                    first_token = False
+                    CHATBOT_STREAM_FIRST_TOKEN_SECONDS.observe(
+                        time.perf_counter() - started, **metric_labels
+                    )
+                yield format_sse_event(event, data)
+
+    response = StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
     origin = request.headers.get("origin")
     if origin in allowed_origins:
         response.headers["Access-Control-Allow-Origin"] = origin
@@ -386,11 +525,7 @@ async def list_class_directories(request: Request):
         logger.info(
             "Loaded classes from directory",
             extra={
-                "session_key": session_key,
                 "directories": str(directories),
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
 
@@ -399,11 +534,7 @@ async def list_class_directories(request: Request):
         logger.error(
             "Error listing class directories",
             extra={
-                "session_key": session_key or "unknown",
                 "error": str(e),
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         raise HTTPException(
@@ -422,6 +553,7 @@ async def get_class_configuration(class_directory: str, request: Request):
 
     session_key = request.cookies.get("session_key") or "unknown"
     session_cache = session_manager.get_session(session_key)
+    bind_log_context(class_selection=class_directory)
 
     if session_cache is None:
         raise HTTPException(status_code=404, detail="Could not locate Session Key")
@@ -442,11 +574,7 @@ async def get_class_configuration(class_directory: str, request: Request):
             logger.error(
                 "Directory does not exist in class configuration",
                 extra={
-                    "session_key": session_key,
                     "directory": non_existent_directory,
-                    "class_selection": class_directory,
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             raise HTTPException(status_code=404, detail=error_message)
@@ -470,13 +598,9 @@ async def get_class_configuration(class_directory: str, request: Request):
         logger.info(
             "Loaded available files for class directory",
             extra={
-                "session_key": session_key,
                 "class_directory": class_directory,
                 "lessons": str(lessons),
                 "action_plans": str(action_plans),
-                "class_selection": class_directory,
-                "lesson": "",
-                "action_plan": "",
             },
         )
 
@@ -487,12 +611,8 @@ async def get_class_configuration(class_directory: str, request: Request):
         logger.error(
             "Error listing files in class directory",
             extra={
-                "session_key": session_key,
                 "class_directory": class_directory,
                 "error": str(e),
-                "class_selection": class_directory,
-                "lesson": "",
-                "action_plan": "",
             },
         )
         raise HTTPException(status_code=500, detail="Error listing files in directory")
@@ -534,6 +654,7 @@ async def send_conversation(request: Request, payload: dict):
     class_name = payload.get("classSelection") or "Unknown"
     lesson = payload.get("lesson") or "Unknown"
     action_plan = payload.get("actionPlan") or "Unknown"
+    bind_log_context(class_selection=class_name, lesson=lesson, action_plan=action_plan)
 
     # Get session cache
     if session_key is None:
@@ -552,15 +673,7 @@ async def send_conversation(request: Request, payload: dict):
             session_key, class_name, lesson, action_plan, session_cache
         )
 
-        logger.info(
-            "HTML created successfully for conversation email",
-            extra={
-                "session_key": session_key,
-                "class_selection": class_name,
-                "lesson": lesson,
-                "action_plan": action_plan,
-            },
-        )
+        logger.info("HTML created successfully for conversation email")
 
         with open("static/conversation-email-template.html", "r") as file:
             email_template = file.read()
@@ -575,10 +688,6 @@ async def send_conversation(request: Request, payload: dict):
                 "Conversation with TutorBot",
                 email_template,
                 [(filename, html_content)],  # type: ignore
-                session_key,
-                class_name,
-                lesson,
-                action_plan,
             )
 
             return JSONResponse(content={"message": "HTML created successfully"})
@@ -586,11 +695,7 @@ async def send_conversation(request: Request, payload: dict):
         logger.error(
             "Error creating HTML for conversation email",
             extra={
-                "session_key": session_key,
                 "error": str(e),
-                "class_selection": class_name,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
         raise HTTPException(status_code=500, detail="Error creating HTML")
@@ -603,6 +708,9 @@ async def download_conversation(request: Request, payload: dict):
     class_name = payload.get("classSelection")
     lesson = payload.get("lesson")
     action_plan = payload.get("actionPlan")
+    bind_log_context(
+        class_selection=class_name or "", lesson=lesson or "", action_plan=action_plan or ""
+    )
 
     # Get session cache
     if session_key is None:
@@ -621,15 +729,7 @@ async def download_conversation(request: Request, payload: dict):
             session_key, class_name, lesson, action_plan, session_cache
         )
 
-        logger.info(
-            "HTML created successfully for conversation download",
-            extra={
-                "session_key": session_key,
-                "class_selection": class_name or "",
-                "lesson": lesson or "",
-                "action_plan": action_plan or "",
-            },
-        )
+        logger.info("HTML created successfully for conversation download")
 
         # Get filename
         filename = html_exporter.get_filename()
@@ -646,11 +746,7 @@ async def download_conversation(request: Request, payload: dict):
         logger.error(
             "Error creating HTML for conversation download",
             extra={
-                "session_key": session_key,
                 "error": str(e),
-                "class_selection": class_name or "",
-                "lesson": lesson or "",
-                "action_plan": action_plan or "",
             },
         )
         raise HTTPException(status_code=500, detail="Error creating HTML")
@@ -658,16 +754,10 @@ async def download_conversation(request: Request, payload: dict):
 
 if __name__ == "__main__":
     # Initialize logging system
-    logger.info(
-        "Logging setup configured and starting TutorBot_Server",
-        extra={"session_key": "", "class_selection": "", "lesson": "", "action_plan": ""},
-    )
+    logger.info("Logging setup configured and starting TutorBot_Server")
 
     # Validate SSR configuration
     validate_ssr_configuration()
-    logger.info(
-        "SSR configuration validation completed",
-        extra={"session_key": "", "class_selection": "", "lesson": "", "action_plan": ""},
-    )
+    logger.info("SSR configuration validation completed")
 
     uvicorn.run("TutorBot_Server:app", host="0.0.0.0", port=port)
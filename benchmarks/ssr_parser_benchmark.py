@@ -0,0 +1,178 @@
+"""
+Equivalence check and benchmark for utils/ssr_parser.py.
+
+Compares extract_ssr_content_request against the BeautifulSoup reference on
+a hand-written corpus plus seeded truncations and mutations of it, then
+times both on typical LLM responses. Exits with status 1 on any mismatch.
+
+Run from the repository root with the server's .env in place:
+
+    python benchmarks/ssr_parser_benchmark.py [--mutations N] [--seed S]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+load_dotenv()
+
+from utils.ssr_parser import (  # noqa: E402
+    extract_ssr_content_request,
+    extract_with_beautifulsoup,
+)
+
+MARKDOWN_ANSWER = "\n".join(
+    [
+        "## Adding fractions",
+        "",
+        "To add **1/2** and **1/3**, first find a *common denominator*:",
+        "",
+        "1. The least common multiple of 2 and 3 is 6.",
+        "2. Rewrite each fraction: 1/2 = 3/6 and 1/3 = 2/6.",
+        "3. Add the numerators: 3/6 + 2/6 = 5/6.",
+        "",
+        "| Step | Result |",
+        "|------|--------|",
+        "| LCM  | 6      |",
+        "| Sum  | 5/6    |",
+        "",
+        "Remember: `a/b + c/d = (ad + bc) / bd` when b, d &gt; 0.",
+        "",
+    ]
+    * 8
+)
+
+SSR_ANSWER = "<SSR_response><answer>" + MARKDOWN_ANSWER + "</answer></SSR_response>"
+SSR_CONTENT_REQUEST = "<SSR_response><SSR_requesting_content><PrimaryKeys>fractions, decimals ,percent</PrimaryKeys></SSR_requesting_content></SSR_response>"
+TEXT_BEFORE_ROOT = "Sure! <SSR_response><answer>text before root</answer></SSR_response>"
+
+CORPUS = [
+    # Plain answers
+    "",
+    "Just a plain answer.",
+    MARKDOWN_ANSWER,
+    "Compare a < b and c > d & more",
+    # Well formed SSR responses
+    "<SSR_response><answer>Hello</answer></SSR_response>",
+    SSR_ANSWER,
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>fractions</PrimaryKeys></SSR_requesting_content></SSR_response>",
+    SSR_CONTENT_REQUEST,
+    "<SSR_response>\n  <SSR_requesting_content>\n    <PrimaryKeys>\n a, b,\n</PrimaryKeys>\n  </SSR_requesting_content>\n</SSR_response>\n",
+    "  \n<SSR_response><answer>  padded  </answer></SSR_response>\n\n",
+    "<SSR_response><answer>A &amp; B &lt;tag&gt; &quot;q&quot; &apos;s&apos;</answer></SSR_response>",
+    "<SSR_response><answer>Use <b>bold</b> and <i>italic <u>nested</u></i> text</answer></SSR_response>",
+    "<SSR_response><answer>line one\r\nline two\rline three</answer></SSR_response>",
+    "<SSR_response><answer>Unicode: é ü 分数 🙂</answer></SSR_response>",
+    # Empty or missing parts
+    "<SSR_response></SSR_response>",
+    "<SSR_response><answer></answer></SSR_response>",
+    "<SSR_response><SSR_requesting_content></SSR_requesting_content><answer>fallback answer</answer></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys></PrimaryKeys></SSR_requesting_content><answer>empty keys</answer></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>   </PrimaryKeys></SSR_requesting_content></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>a,,b,</PrimaryKeys></SSR_requesting_content></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>a</PrimaryKeys></SSR_requesting_content><answer>both</answer></SSR_response>",
+    "<SSR_response><SSR_requesting_content><answer>inside request</answer></SSR_requesting_content></SSR_response>",
+    "<SSR_response><SSR_requesting_content><Keys>x</Keys></SSR_requesting_content></SSR_response>",
+    # Nesting and ordering
+    "<root><SSR_response><answer>nested root</answer></SSR_response></root>",
+    "<SSR_response><answer>first</answer><answer>second</answer></SSR_response>",
+    "<SSR_response><answer>outer<answer>inner</answer>tail</answer></SSR_response>",
+    "<SSR_response><SSR_response><answer>double</answer></SSR_response></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>a</PrimaryKeys></SSR_requesting_content><SSR_requesting_content><PrimaryKeys>b</PrimaryKeys></SSR_requesting_content></SSR_response>",
+    "<SSR_response><PrimaryKeys>outside request</PrimaryKeys><answer>x</answer></SSR_response>",
+    "<SSR_response><SSR_requesting_content><x><PrimaryKeys>deep, key</PrimaryKeys></x></SSR_requesting_content></SSR_response>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>k<b>1</b>, k2</PrimaryKeys></SSR_requesting_content></SSR_response>",
+    "<answer>no response element</answer>",
+    "<ssr_response><answer>wrong case</answer></ssr_response>",
+    # Malformed or unusual input (handled by the fallback)
+    TEXT_BEFORE_ROOT,
+    "<SSR_response><answer>text after root</answer></SSR_response> Thanks!",
+    "<SSR_response><answer>a</answer></SSR_response><SSR_response><answer>b</answer></SSR_response>",
+    "<SSR_response><answer>unclosed",
+    "<SSR_response><answer>mismatched</SSR_response></answer>",
+    "<SSR_response><SSR_requesting_content><PrimaryKeys>trunc, ated</PrimaryKeys>",
+    "<SSR_response><answer>1 < 2 is true</answer></SSR_response>",
+    "<SSR_response><answer>AT&T and R&D</answer></SSR_response>",
+    "<SSR_response><answer>&nbsp;&copy; entities</answer></SSR_response>",
+    "<SSR_response><answer>&#65;&#x42; char refs</answer></SSR_response>",
+    "<SSR_response><answer><![CDATA[<b>raw</b> & text]]></answer></SSR_response>",
+    "<SSR_response><!-- comment --><answer>after comment</answer></SSR_response>",
+    '<?xml version="1.0" encoding="UTF-8"?><SSR_response><answer>declared</answer></SSR_response>',
+    '<SSR_response version="1"><answer class="x">attributes</answer></SSR_response>',
+    "<SSR_response><answer/><answer>self closing</answer></SSR_response>",
+    "<SSR_response><answer>line<br>break</answer></SSR_response>",
+    "<SSR_response><ns:answer>namespaced</ns:answer></SSR_response>",
+    "<SSR_response ><answer >spaces in tags</answer ></SSR_response >",
+    "<SSR_response><answer>bad\x01char</answer></SSR_response>",
+    "\ufeff<SSR_response><answer>bom</answer></SSR_response>",
+    "```xml\n<SSR_response><answer>fenced</answer></SSR_response>\n```",
+    "<SSR_response><answer>]]> in text</answer></SSR_response>",
+]
+
+
+def mutations(corpus, count, seed):
+    """Seeded truncations and character-level edits of the corpus."""
+    rng = random.Random(seed)
+    fragments = ["<", ">", "&", "&amp;", "</answer>", "<answer>", "<PrimaryKeys>", ",", "\r\n", " ", "<b>", "]]>", "<!--"]
+    for _ in range(count):
+        document = rng.choice(corpus)
+        if not document:
+            continue
+        kind = rng.randrange(3)
+        position = rng.randrange(len(document) + 1)
+        if kind == 0:
+            yield document[:position]
+        elif kind == 1:
+            yield document[:position] + rng.choice(fragments) + document[position:]
+        else:
+            end = min(len(document), position + rng.randrange(1, 8))
+            yield document[:position] + document[end:]
+
+
+def check_equivalence(documents):
+    mismatches = 0
+    for document in documents:
+        expected = extract_with_beautifulsoup(document)
+        actual = extract_ssr_content_request(document)
+        if actual != expected:
+            mismatches += 1
+            print(f"MISMATCH {document!r}\n  expected {expected!r}\n  actual   {actual!r}")
+    return mismatches
+
+
+def benchmark(name, document, number):
+    reference = timeit.timeit(lambda: extract_with_beautifulsoup(document), number=number)
+    fast = timeit.timeit(lambda: extract_ssr_content_request(document), number=number)
+    print(
+        f"{name:<22} {len(document):>7} bytes  "
+        f"beautifulsoup {reference / number * 1e6:>9.1f} us  "
+        f"fast {fast / number * 1e6:>8.1f} us  "
+        f"x{reference / fast:>7.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mutations", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    documents = CORPUS + list(mutations(CORPUS, args.mutations, args.seed))
+    mismatches = check_equivalence(documents)
+    print(f"Equivalence: {len(documents) - mismatches}/{len(documents)} documents match")
+
+    benchmark("plain markdown", MARKDOWN_ANSWER, args.number)
+    benchmark("ssr answer", SSR_ANSWER, args.number)
+    benchmark("ssr content request", SSR_CONTENT_REQUEST, args.number)
+    benchmark("fallback (text first)", TEXT_BEFORE_ROOT, args.number)
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import json
 import os
 import platform
 import typing
@@ -250,6 +251,19 @@ max_tokens = int(os.getenv("MAX_TOKENS") or 10000)
 
 max_conversation_tokens = int(os.getenv("MAX_CONVERSATION_TOKENS") or 20000)
 
+# Tokens of conversation history sent with each request; the newest messages that
+# fit are sent, older ones are kept for export only
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET") or max_conversation_tokens)
+
+# Fold the oldest turns into a rolling summary, generated in the background, once the
+# history not yet summarized exceeds the trigger; the newest turns up to the keep
+# size stay verbatim
+conversation_compaction = os.getenv("CONVERSATION_COMPACTION", "false") == "true"
+compaction_trigger_tokens = int(
+    os.getenv("COMPACTION_TRIGGER_TOKENS") or history_token_budget * 3 // 4
+)
+compaction_keep_tokens = int(os.getenv("COMPACTION_KEEP_TOKENS") or history_token_budget // 4)
+
 # SSR (Structured Semantic Retrieval) Configuration Constants
 SSR_MAX_ITERATIONS = 4
 SSR_CONTENT_SIZE_LIMIT_TOKENS = 20000
@@ -258,12 +272,113 @@ SSR_CONTENT_DIRECTORY = "ssrcontent"
 SSR_XML_RESPONSE_TAG = "SSR_response"
 SSR_REQUEST_TAG = "SSR_requesting_content"
 
+# How conversation and SSR content sizes are counted: "auto" uses a local tokenizer
+# for the provider where one is available, "heuristic" always estimates
+token_counter = os.getenv("TOKEN_COUNTER") or "auto"
+if token_counter not in ("auto", "heuristic"):
+    error_message = f"Invalid TOKEN_COUNTER ({token_counter}), expected auto or heuristic"
+    logger.error(
+        "Token counter not valid",
+        extra={
+            "token_counter": str(token_counter),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+# Prompt layout: "default" keeps the provider-specific layouts, "cache_stable"
+# orders static content, history and volatile parts for provider prompt caching
+prompt_layout = os.getenv("PROMPT_LAYOUT") or "default"
+if prompt_layout not in ("default", "cache_stable"):
+    error_message = f"Invalid PROMPT_LAYOUT ({prompt_layout}), expected default or cache_stable"
+    logger.error(
+        "Prompt layout not valid",
+        extra={
+            "prompt_layout": str(prompt_layout),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+# Seconds a compiled prompt pack (scenario, conundrum, action plan) is reused
+# before its files are fetched again; 0 fetches them on every request
+prompt_pack_ttl = float(os.getenv("PROMPT_PACK_TTL") or "300")
+
+prompt_pack_max_entries = int(os.getenv("PROMPT_PACK_MAX_ENTRIES") or "256")
+
+# Classes whose responses are shared across sessions when the lesson, action plan,
+# conversation so far and question match ("*" for all); empty disables the cache
+response_cache_classes = [
+    class_name.strip()
+    for class_name in (os.getenv("RESPONSE_CACHE_CLASSES") or "").split(",")
+    if class_name.strip()
+]
+response_cache_ttl = float(os.getenv("RESPONSE_CACHE_TTL") or "3600")
+response_cache_max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES") or "1024")
+
+# Stop generating a retrieval pass as soon as its content request is complete
+ssr_early_abort = os.getenv("SSR_EARLY_ABORT", "false") == "true"
+
+# Fraction of retrieval passes still generated to completion, used as the
+# baseline for estimating the output tokens and seconds early abort saves
+ssr_early_abort_holdout = float(os.getenv("SSR_EARLY_ABORT_HOLDOUT") or "0.05")
+
+# Seconds between rebuilds of the SSR content manifest (every ssrcontent key with its
+# size and version); 0 disables the manifest and content keys are checked by fetching
+ssr_manifest_refresh_seconds = float(os.getenv("SSR_MANIFEST_REFRESH_SECONDS") or "300")
+
+# Load the ssrcontent that best matches the request (BM25 over each class's content,
+# built with the manifest) before the first pass, so fewer passes request content
+ssr_prefetch = os.getenv("SSR_PREFETCH", "false") == "true"
+ssr_prefetch_max_keys = int(os.getenv("SSR_PREFETCH_MAX_KEYS") or "3")
+ssr_prefetch_min_score = float(os.getenv("SSR_PREFETCH_MIN_SCORE") or "1.0")
+
+# Fraction of requests with matches that are not prefetched, used to measure whether
+# the matches are the keys the model goes on to request
+ssr_prefetch_holdout = float(os.getenv("SSR_PREFETCH_HOLDOUT") or "0.05")
+
+# Remember the content keys the first pass requested for a question (per class, lesson
+# and action plan) and load them up front once the same keys keep being requested
+ssr_route_cache_enabled = os.getenv("SSR_ROUTE_CACHE", "false") == "true"
+ssr_route_min_observations = int(os.getenv("SSR_ROUTE_MIN_OBSERVATIONS") or "3")
+ssr_route_min_confidence = float(os.getenv("SSR_ROUTE_MIN_CONFIDENCE") or "0.6")
+ssr_route_max_entries = int(os.getenv("SSR_ROUTE_MAX_ENTRIES") or "4096")
+# Fraction of route cache hits run without the preloaded keys; only these and passes
+# without preloaded content are recorded, so routes keep tracking what is requested
+ssr_route_holdout = float(os.getenv("SSR_ROUTE_HOLDOUT") or "0.1")
+
+# Count which content keys are requested together in a turn (per class) and load a
+# requested key's usual companions with it; counts are saved to SSR_COREQUEST_STATS_FILE
+ssr_corequests_enabled = os.getenv("SSR_COREQUESTS", "false") == "true"
+ssr_corequest_min_count = int(os.getenv("SSR_COREQUEST_MIN_COUNT") or "5")
+ssr_corequest_min_confidence = float(os.getenv("SSR_COREQUEST_MIN_CONFIDENCE") or "0.5")
+ssr_corequest_max_keys = int(os.getenv("SSR_COREQUEST_MAX_KEYS") or "2")
+ssr_corequest_holdout = float(os.getenv("SSR_COREQUEST_HOLDOUT") or "0.1")
+ssr_corequest_stats_file = os.getenv("SSR_COREQUEST_STATS_FILE") or os.path.join(
+    local_assets_path, "logs", "ssr_corequests.json"
+)
+ssr_corequest_save_seconds = float(os.getenv("SSR_COREQUEST_SAVE_SECONDS") or "300")
+
 
 def validate_ssr_configuration():
     """Validate SSR-related configuration on startup."""
     if max_conversation_tokens <= 0:
         raise ValueError("MAX_CONVERSATION_TOKENS must be positive")
 
+    if history_token_budget <= 0:
+        raise ValueError("HISTORY_TOKEN_BUDGET must be positive")
+
+    if conversation_compaction and not 0 < compaction_keep_tokens < compaction_trigger_tokens:
+        raise ValueError(
+            "COMPACTION_KEEP_TOKENS must be positive and less than COMPACTION_TRIGGER_TOKENS"
+        )
+
     if SSR_CONTENT_SIZE_LIMIT_TOKENS > max_conversation_tokens:
         logger.warning(
             "SSR content limit exceeds conversation limit",
@@ -283,11 +398,66 @@ def validate_ssr_configuration():
     if BYTES_PER_TOKEN_ESTIMATE <= 0:
         raise ValueError("BYTES_PER_TOKEN_ESTIMATE must be positive")
 
+    if not 0 <= ssr_early_abort_holdout <= 1:
+        raise ValueError("SSR_EARLY_ABORT_HOLDOUT must be between 0 and 1")
+
+    if not 0 <= ssr_prefetch_holdout <= 1:
+        raise ValueError("SSR_PREFETCH_HOLDOUT must be between 0 and 1")
+
+    if not 0 < ssr_route_min_confidence <= 1:
+        raise ValueError("SSR_ROUTE_MIN_CONFIDENCE must be greater than 0 and at most 1")
+
+    if not 0 <= ssr_route_holdout <= 1:
+        raise ValueError("SSR_ROUTE_HOLDOUT must be between 0 and 1")
+
+    if not 0 < ssr_corequest_min_confidence <= 1:
+        raise ValueError("SSR_COREQUEST_MIN_CONFIDENCE must be greater than 0 and at most 1")
+
+    if not 0 <= ssr_corequest_holdout <= 1:
+        raise ValueError("SSR_COREQUEST_HOLDOUT must be between 0 and 1")
+
+    if ssr_prefetch and ssr_manifest_refresh_seconds <= 0:
+        raise ValueError("SSR_PREFETCH requires SSR_MANIFEST_REFRESH_SECONDS to be positive")
+
+    if ssr_corequests_enabled and ssr_manifest_refresh_seconds <= 0:
+        raise ValueError("SSR_COREQUESTS requires SSR_MANIFEST_REFRESH_SECONDS to be positive")
+
 
 max_retries = int(os.getenv("MAX_RETRIES") or "2")
 
 timeout = int(os.getenv("TIMEOUT") or "60")
 
+# Upper bound on LLM calls in flight across all requests
+llm_max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY") or "32")
+
+# Connection pool for LLM provider calls (OPENAI and ANTHROPIC): size, idle connections
+# kept open and how long they are kept, so requests reuse warm TLS connections
+llm_pool_max_connections = int(os.getenv("LLM_POOL_MAX_CONNECTIONS") or llm_max_concurrency)
+llm_pool_max_keepalive = int(os.getenv("LLM_POOL_MAX_KEEPALIVE") or "20")
+llm_keepalive_seconds = float(os.getenv("LLM_KEEPALIVE_SECONDS") or "120")
+
+# Connections opened to the provider at startup before /ready reports ready; 0 skips it
+llm_warmup_connections = int(os.getenv("LLM_WARMUP_CONNECTIONS") or "2")
+
+if llm_pool_max_connections <= 0 or llm_pool_max_keepalive < 0 or llm_keepalive_seconds < 0:
+    error_message = "LLM_POOL_MAX_CONNECTIONS must be positive, LLM_POOL_MAX_KEEPALIVE and LLM_KEEPALIVE_SECONDS not negative"
+    logger.error(
+        error_message,
+        extra={
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+# Upper bound on concurrent class file reads (S3 or local) from chat requests
+file_io_concurrency = int(os.getenv("FILE_IO_CONCURRENCY") or "16")
+
+# Upper bound on concurrent SSR content file fetches for one request
+ssr_fetch_concurrency = int(os.getenv("SSR_FETCH_CONCURRENCY") or "8")
+
 temperature = float(os.getenv("TEMPERATURE") or "0.7")
 
 top_p = None
@@ -420,3 +590,119 @@ if loki_labels:
             "action_plan": "",
         },
     )
+
+# Loki shipping (optional)
+loki_async = os.getenv("LOKI_ASYNC", "true") != "false"
+
+loki_batch_size = int(os.getenv("LOKI_BATCH_SIZE") or "100")
+
+loki_flush_interval = float(os.getenv("LOKI_FLUSH_INTERVAL") or "2.0")
+
+loki_queue_size = int(os.getenv("LOKI_QUEUE_SIZE") or "10000")
+
+loki_spool_enabled = os.getenv("LOKI_SPOOL_ENABLED", "true") != "false"
+
+loki_spool_dir = (
+    os.getenv("LOKI_SPOOL_DIR") or os.path.join(local_assets_path, "logs", "loki-spool")
+    if loki_spool_enabled
+    else ""
+)
+
+loki_spool_max_bytes = int(float(os.getenv("LOKI_SPOOL_MAX_MB") or "100") * 1024 * 1024)
+
+loki_spool_segment_bytes = int(float(os.getenv("LOKI_SPOOL_SEGMENT_MB") or "4") * 1024 * 1024)
+
+loki_drop_policy = os.getenv("LOKI_DROP_POLICY") or "drop_newest"
+if loki_drop_policy not in ("drop_newest", "drop_oldest", "spool") or (
+    loki_drop_policy == "spool" and not loki_spool_enabled
+):
+    error_message = f"Invalid LOKI_DROP_POLICY ({loki_drop_policy}), expected drop_newest, drop_oldest or spool (requires LOKI_SPOOL_ENABLED)"
+    logger.error(
+        "Loki drop policy not valid",
+        extra={
+            "loki_drop_policy": str(loki_drop_policy),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+loki_push_format = os.getenv("LOKI_PUSH_FORMAT") or "json"
+if loki_push_format not in ("json", "protobuf"):
+    error_message = f"Invalid LOKI_PUSH_FORMAT ({loki_push_format}), expected json or protobuf"
+    logger.error(
+        "Loki push format not valid",
+        extra={
+            "loki_push_format": str(loki_push_format),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+loki_compression = os.getenv("LOKI_COMPRESSION") or "gzip"
+if loki_compression not in ("none", "gzip"):
+    error_message = f"Invalid LOKI_COMPRESSION ({loki_compression}), expected none or gzip"
+    logger.error(
+        "Loki compression not valid",
+        extra={
+            "loki_compression": str(loki_compression),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+loki_pool_maxsize = int(os.getenv("LOKI_POOL_MAXSIZE") or "4")
+
+# Log sampling (optional)
+log_sampling_rules = {}
+if os.getenv("LOG_SAMPLING_RULES"):
+    try:
+        log_sampling_rules = json.loads(os.getenv("LOG_SAMPLING_RULES"))  # type: ignore
+        if not isinstance(log_sampling_rules, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
+        error_message = f"Invalid LOG_SAMPLING_RULES ({e})"
+        logger.error(
+            "Log sampling rules not valid",
+            extra={
+                "error": str(e),
+                "session_key": "",
+                "class_selection": "",
+                "lesson": "",
+                "action_plan": "",
+            },
+        )
+        raise ValueError(error_message)
+
+log_sampling_summary_interval = float(os.getenv("LOG_SAMPLING_SUMMARY_INTERVAL") or "60")
+
+# Prompt audit logging (optional)
+prompt_log_mode = os.getenv("PROMPT_LOG_MODE") or "full"
+if prompt_log_mode not in ("off", "hash", "delta", "full"):
+    error_message = f"Invalid PROMPT_LOG_MODE ({prompt_log_mode}), expected off, hash, delta or full"
+    logger.error(
+        "Prompt log mode not valid",
+        extra={
+            "prompt_log_mode": str(prompt_log_mode),
+            "session_key": "",
+            "class_selection": "",
+            "lesson": "",
+            "action_plan": "",
+        },
+    )
+    raise ValueError(error_message)
+
+# Span tracing (optional)
+tracing_enabled = os.getenv("TRACING_ENABLED", "false") == "true"
+
+trace_export_dir = os.getenv("TRACE_EXPORT_DIR") or os.path.join(
+    local_assets_path, "logs", "traces"
+)
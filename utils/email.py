@@ -15,10 +15,6 @@ def send_email(
     subject: str,
     html: str,
     attachments: list[tuple[str, str]] = [],
-    session_key: str = "",
-    class_selection: str = "",
-    lesson: str = "",
-    action_plan: str = "",
 ):
     try:
         files = files = [("attachment", attachment) for attachment in attachments]
@@ -41,10 +37,6 @@ def send_email(
                 "Successfully sent email via Mailgun API",
                 extra={
                     "to_address": to_address,
-                    "session_key": session_key,
-                    "class_selection": class_selection,
-                    "lesson": lesson,
-                    "action_plan": action_plan,
                 },
             )
         else:
@@ -54,10 +46,6 @@ def send_email(
                 extra={
                     "reason": response.text,
                     "status_code": str(response.status_code),
-                    "session_key": session_key,
-                    "class_selection": class_selection,
-                    "lesson": lesson,
-                    "action_plan": action_plan,
                 },
             )
     except Exception as ex:
@@ -65,9 +53,5 @@ def send_email(
             "Mailgun error",
             extra={
                 "error": str(ex),
-                "session_key": session_key,
-                "class_selection": class_selection,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
@@ -1,10 +1,12 @@
 import os
-from typing import Optional
+import time
+from typing import List, NamedTuple, Optional
 from xmlrpc.client import Boolean
 from fastapi import HTTPException
 
 from utils.s3 import s3_client
 from utils.logger import get_logger
+from utils.metrics import OPEN_TEXT_FILE_SECONDS
 
 logger = get_logger()
 
@@ -42,10 +44,6 @@ def check_bucket_file_exists(file_path: str) -> bool:
             "S3 object head retrieved",
             extra={
                 "object_head": str(object_head),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
 
@@ -56,10 +54,6 @@ def check_bucket_file_exists(file_path: str) -> bool:
             extra={
                 "error": str(e),
                 "file_path": file_path,
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         return False
@@ -105,10 +99,6 @@ def check_bucket_directory_exists(directory_path: str) -> bool:
             extra={
                 "error": str(e),
                 "directory_path": directory_path,
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         return False
@@ -125,6 +115,17 @@ def check_directory_exists(directory_path: str) -> bool:
 
 
 def open_text_file(file_path: str) -> Optional[str]:
+    started = time.perf_counter()
+    try:
+        return _open_text_file(file_path)
+    finally:
+        OPEN_TEXT_FILE_SECONDS.observe(
+            time.perf_counter() - started,
+            backend="s3" if cloud_mode_enabled else "local",
+        )
+
+
+def _open_text_file(file_path: str) -> Optional[str]:
 
     if cloud_mode_enabled:
         if not s3_client:
@@ -133,10 +134,6 @@ def open_text_file(file_path: str) -> Optional[str]:
                 "S3 client not initialized",
                 extra={
                     "file_path": file_path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             raise HTTPException(status_code=500, detail=error_message)
@@ -172,10 +169,6 @@ def save_file(file_path: str, content: bytes) -> Boolean:
                 "S3 client not initialized",
                 extra={
                     "file_path": file_path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             raise HTTPException(status_code=500, detail=error_message)
@@ -192,10 +185,6 @@ def save_file(file_path: str, content: bytes) -> Boolean:
                 extra={
                     "error": str(e),
                     "file_path": file_path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             return False
@@ -211,10 +200,6 @@ def delete_file(file_path: str) -> Boolean:
                 "S3 client not initialized",
                 extra={
                     "file_path": file_path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             raise HTTPException(status_code=500, detail=error_message)
@@ -234,10 +219,6 @@ def delete_file(file_path: str) -> Boolean:
                 extra={
                     "error": str(e),
                     "file_path": file_path,
-                    "session_key": "",
-                    "class_selection": "",
-                    "lesson": "",
-                    "action_plan": "",
                 },
             )
             return False
@@ -281,10 +262,6 @@ def list_bucket_directory(directory_path: Optional[str], type: str) -> list:
             "S3 client not initialized",
             extra={
                 "directory_path": str(directory_path),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         raise HTTPException(status_code=500, detail=error_message)
@@ -319,10 +296,6 @@ def list_bucket_directory(directory_path: Optional[str], type: str) -> list:
             extra={
                 "error": str(e),
                 "directory_path": str(directory_path),
-                "session_key": "",
-                "class_selection": "",
-                "lesson": "",
-                "action_plan": "",
             },
         )
         return []
@@ -336,3 +309,75 @@ def list_directory(directory_path: Optional[str], type: str) -> list:
     )
 
     return files
+
+
+class FileMetadata(NamedTuple):
+    # Path relative to the listed directory, with "/" separators
+    path: str
+    size: int
+    # ETag in cloud mode, modification time and size locally
+    version: str
+
+
+def list_local_files_with_metadata(directory_path: str) -> List[FileMetadata]:
+
+    joined_path = os.path.join(assets_path, directory_path)
+    normalized_directory_path = os.path.normpath(joined_path)
+
+    files = []
+    for root, _, file_names in os.walk(normalized_directory_path):
+        for file_name in file_names:
+            full_path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                continue
+            relative_path = os.path.relpath(full_path, normalized_directory_path)
+            files.append(
+                FileMetadata(
+                    relative_path.replace(os.sep, "/"),
+                    stat.st_size,
+                    f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+                )
+            )
+
+    return files
+
+
+def list_bucket_files_with_metadata(directory_path: str) -> List[FileMetadata]:
+    if not s3_client:
+        error_message = "S3 client not initialized, cannot list directory"
+        logger.error(
+            "S3 client not initialized",
+            extra={
+                "directory_path": str(directory_path),
+            },
+        )
+        raise HTTPException(status_code=500, detail=error_message)
+
+    joined_path = f"{assets_path}/{directory_path}/"
+
+    files = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=joined_path):
+        for content in page.get("Contents", []):
+            files.append(
+                FileMetadata(
+                    content["Key"][len(joined_path):],
+                    content["Size"],
+                    content.get("ETag", "").strip('"'),
+                )
+            )
+
+    return files
+
+
+def list_files_with_metadata(directory_path: str) -> List[FileMetadata]:
+    """All files below directory_path, recursively, with size and version."""
+    files = (
+        list_bucket_files_with_metadata(directory_path)
+        if cloud_mode_enabled
+        else list_local_files_with_metadata(directory_path)
+    )
+
+    return files
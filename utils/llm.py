@@ -1,45 +1,30 @@
+import asyncio
 import markdown
 import nh3
 from copy import deepcopy
 from typing import List, Tuple
 
+from constants import file_io_concurrency
 from utils.filesystem import open_text_file
 from utils.logger import get_logger
+from utils.tracing import start_span
 
 logger = get_logger()
 
 
-def validate_access_key(
-    access_key: str,
-    session_key: str,
-    class_selection: str = "",
-    lesson: str = "",
-    action_plan: str = "",
-) -> bool:
+def validate_access_key(access_key: str) -> bool:
 
     available_keys = open_text_file("config/access_keys.txt")
 
     if available_keys is None:
-        logger.error(
-            "Access key file not found",
-            extra={
-                "session_key": session_key,
-                "class_selection": class_selection,
-                "lesson": lesson,
-                "action_plan": action_plan,
-            },
-        )
+        logger.error("Access key file not found")
         return False
 
     if access_key not in available_keys.splitlines():
         logger.warning(
             "Invalid access key",
             extra={
-                "session_key": session_key,
                 "access_key": access_key,
-                "class_selection": class_selection,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
         return False
@@ -47,34 +32,24 @@ def validate_access_key(
     return True
 
 
-def get_llm_file(
-    class_directory: str,
-    type: str,
-    file_name: str,
-    session_key: str,
-    class_selection: str = "",
-    lesson: str = "",
-    action_plan: str = "",
-) -> str:
+def get_llm_file(class_directory: str, type: str, file_name: str) -> str:
 
     temp_name = ""
 
     if type:
-        content = open_text_file(f"classes/{class_directory}/{type}/{file_name}")
         temp_name              = f"classes/{class_directory}/{type}/{file_name}"
     else:
-        content = open_text_file(f"classes/{class_directory}/{file_name}")
         temp_name              = f"classes/{class_directory}/{file_name}"
 
+    with start_span("content.fetch", path=temp_name) as span:
+        content = open_text_file(temp_name)
+        span.set_attribute("bytes", len(content) if content else 0)
+
     if content is None:
         logger.warning(
             f"Failed to locate file ({temp_name})",
             extra={
-                "session_key": session_key,
                 "file_name": file_name,
-                "class_selection": class_selection or class_directory,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
         return ""
@@ -83,30 +58,31 @@ def get_llm_file(
         logger.warning(
             f"File ({temp_name}) is empty",
             extra={
-                "session_key": session_key,
                 "type": type,
                 "file_name": file_name,
-                "class_selection": class_selection or class_directory,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
     else:
         logger.info(
             f"Loaded file ({temp_name})",
             extra={
-                "session_key": session_key,
                 "type": type,
                 "file_name": file_name,
-                "class_selection": class_selection or class_directory,
-                "lesson": lesson,
-                "action_plan": action_plan,
             },
         )
 
     return content
 
 
+_file_io_semaphore = asyncio.Semaphore(max(1, file_io_concurrency))
+
+
+async def get_llm_file_async(class_directory: str, type: str, file_name: str) -> str:
+    """get_llm_file on a worker thread, bounded by FILE_IO_CONCURRENCY."""
+    async with _file_io_semaphore:
+        return await asyncio.to_thread(get_llm_file, class_directory, type, file_name)
+
+
 def format_conversation(conversation: List[Tuple[str, str]]) -> List[str]:
     user_message = """<div class="user-message"><h2 class="message-text">User: </h2><p>{user_input}</p></div>"""
     assistant_message = """<div class="bot-message"><h2 class="message-text">Bot:</h2>{assistant_response}</div>"""
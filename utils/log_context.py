@@ -0,0 +1,79 @@
+import logging
+from contextvars import ContextVar, Token
+from typing import Tuple
+
+# Record fields that become Loki stream labels
+LABEL_FIELDS = ("class_selection", "lesson", "action_plan")
+CONTEXT_FIELDS = ("session_key",) + LABEL_FIELDS
+
+MAX_LABEL_LENGTH = 1024
+
+
+class LogContext:
+    """Immutable per-request logging fields.
+
+    The Loki label values are computed once when the context is created, so
+    handlers do not have to re-derive them for every record.
+    """
+
+    __slots__ = ("session_key", "class_selection", "lesson", "action_plan", "label_values")
+
+    def __init__(
+        self,
+        session_key: str = "",
+        class_selection: str = "",
+        lesson: str = "",
+        action_plan: str = "",
+    ) -> None:
+        self.session_key = session_key or ""
+        self.class_selection = class_selection or ""
+        self.lesson = lesson or ""
+        self.action_plan = action_plan or ""
+        self.label_values: Tuple[str, ...] = label_values(
+            self.class_selection, self.lesson, self.action_plan
+        )
+
+    def replace(self, **fields: str) -> "LogContext":
+        values = {name: getattr(self, name) for name in CONTEXT_FIELDS}
+        values.update(fields)
+        return LogContext(**values)
+
+
+def label_values(*values) -> Tuple[str, ...]:
+    """Normalize label values to strings no longer than MAX_LABEL_LENGTH."""
+    return tuple(str(value)[:MAX_LABEL_LENGTH] if value else "" for value in values)
+
+
+_EMPTY_CONTEXT = LogContext()
+_log_context: ContextVar[LogContext] = ContextVar("log_context", default=_EMPTY_CONTEXT)
+
+
+def get_log_context() -> LogContext:
+    return _log_context.get()
+
+
+def set_log_context(**fields: str) -> Token:
+    """Start a fresh context for the current request. Returns a token for reset_log_context."""
+    return _log_context.set(LogContext(**fields))
+
+
+def bind_log_context(**fields: str) -> Token:
+    """Update fields of the current context (e.g. once the request body is parsed)."""
+    return _log_context.set(_log_context.get().replace(**fields))
+
+
+def reset_log_context(token: Token) -> None:
+    _log_context.reset(token)
+
+
+class LogContextFilter(logging.Filter):
+    """Inject the current request context into records that did not set the fields in ``extra``."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _log_context.get()
+        fields = record.__dict__
+        for name in CONTEXT_FIELDS:
+            if name not in fields:
+                fields[name] = getattr(context, name)
+        fields["_log_context"] = context
+        return True
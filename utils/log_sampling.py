@@ -0,0 +1,158 @@
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+# Bound on the message template -> rule lookup cache
+_RULE_CACHE_LIMIT = 1024
+
+
+@dataclass
+class SamplingRule:
+    """How records whose message starts with ``key`` are sampled.
+
+    The first ``first`` records always pass, after that 1 in ``every`` records
+    pass, each with probability ``rate``. When ``per_second`` is set, a token
+    bucket holding up to ``burst`` tokens caps what remains.
+    """
+
+    key: str
+    rate: float = 1.0
+    first: int = 0
+    every: int = 1
+    per_second: float = 0.0
+    burst: float = 0.0
+
+    @classmethod
+    def from_config(cls, key: str, config: dict) -> "SamplingRule":
+        rule = cls(
+            key=key,
+            rate=float(config.get("rate", 1.0)),
+            first=int(config.get("first", 0)),
+            every=int(config.get("every", 1)),
+            per_second=float(config.get("per_second", 0.0)),
+            burst=float(config.get("burst", 0.0)),
+        )
+        if not 0.0 <= rule.rate <= 1.0:
+            raise ValueError(f"Sampling rate for ({key}) must be between 0 and 1")
+        if rule.first < 0 or rule.every < 1 or rule.per_second < 0 or rule.burst < 0:
+            raise ValueError(f"Sampling rule for ({key}) has a negative or zero setting")
+        if rule.per_second and not rule.burst:
+            rule.burst = max(1.0, rule.per_second)
+        return rule
+
+
+@dataclass
+class _RuleState:
+    seen: int = 0
+    suppressed: int = 0
+    tokens: float = 0.0
+    refilled_at: float = field(default_factory=time.monotonic)
+
+
+class LogSampler(logging.Filter):
+    """Sample high-volume INFO/DEBUG records per message key.
+
+    Records at WARNING and above always pass. Suppressed counts are reported
+    through ``logger`` in a summary record at most every ``summary_interval``
+    seconds.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        rules: Dict[str, dict],
+        summary_interval: float = 60.0,
+    ) -> None:
+        super().__init__()
+        self._logger = logger
+        self.rules = {key: SamplingRule.from_config(key, cfg) for key, cfg in rules.items()}
+        self.summary_interval = summary_interval
+
+        self._lock = threading.Lock()
+        self._states = {
+            key: _RuleState(tokens=rule.burst) for key, rule in self.rules.items()
+        }
+        self._rule_cache: Dict[str, Optional[str]] = {}
+        self._last_summary = time.monotonic()
+
+    def _resolve(self, record: logging.LogRecord) -> Optional[str]:
+        sample_key = getattr(record, "sample_key", None)
+        if sample_key:
+            return sample_key if sample_key in self.rules else None
+
+        template = str(record.msg)
+        try:
+            return self._rule_cache[template]
+        except KeyError:
+            pass
+
+        resolved = next((key for key in self.rules if template.startswith(key)), None)
+        if len(self._rule_cache) >= _RULE_CACHE_LIMIT:
+            self._rule_cache.clear()
+        self._rule_cache[template] = resolved
+        return resolved
+
+    def _allow(self, rule: SamplingRule, state: _RuleState) -> bool:
+        state.seen += 1
+        allowed = True
+
+        if state.seen > rule.first:
+            if rule.every > 1:
+                allowed = (state.seen - rule.first - 1) % rule.every == 0
+            if allowed and rule.rate < 1.0:
+                allowed = random.random() < rule.rate
+
+        if allowed and rule.per_second:
+            now = time.monotonic()
+            state.tokens = min(
+                rule.burst, state.tokens + (now - state.refilled_at) * rule.per_second
+            )
+            state.refilled_at = now
+            if state.tokens >= 1.0:
+                state.tokens -= 1.0
+            else:
+                allowed = False
+
+        if not allowed:
+            state.suppressed += 1
+        return allowed
+
+    def _emit_summary(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_summary < self.summary_interval:
+                return
+            self._last_summary = now
+            suppressed = {
+                key: state.suppressed
+                for key, state in self._states.items()
+                if state.suppressed
+            }
+            for state in self._states.values():
+                state.suppressed = 0
+
+        if suppressed:
+            self._logger.info(
+                "Log sampling summary",
+                extra={
+                    "sampling_summary": True,
+                    "suppressed": suppressed,
+                    "suppressed_total": str(sum(suppressed.values())),
+                    "interval_seconds": str(self.summary_interval),
+                },
+            )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or getattr(record, "sampling_summary", False):
+            return True
+
+        with self._lock:
+            key = self._resolve(record)
+            allowed = key is None or self._allow(self.rules[key], self._states[key])
+
+        if time.monotonic() - self._last_summary >= self.summary_interval:
+            self._emit_summary()
+        return allowed
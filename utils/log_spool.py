@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+
+
+class LogSpool:
+    """Write-ahead spool of Loki batches kept in rotating segment files.
+
+    Each line of a segment is one batch: ``{"records": n, "streams": [...]}``.
+    Segments are replayed oldest first and removed once fully pushed. When the
+    spool would exceed ``max_bytes`` the oldest segments are discarded.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 100 * 1024 * 1024,
+        segment_bytes: int = 4 * 1024 * 1024,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max(1, max_bytes)
+        self.segment_bytes = max(1, min(segment_bytes, self.max_bytes))
+
+        self._lock = threading.Lock()
+        self._active_file = None
+        self._active_path: Optional[str] = None
+        self._active_size = 0
+        # Byte offset already replayed in the oldest segment
+        self._replay_offset = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._segments: List[str] = sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        self._total_bytes = sum(os.path.getsize(path) for path in self._segments)
+        self._next_seq = (
+            self._segment_seq(self._segments[-1]) + 1 if self._segments else 1
+        )
+
+        self.counters: Dict[str, int] = {
+            "spooled": 0,
+            "replayed": 0,
+            "spool_rejected": 0,
+            "spool_dropped": 0,
+        }
+
+    # ---------- helpers --------------------------------------------------
+
+    @staticmethod
+    def _segment_seq(path: str) -> int:
+        name = os.path.basename(path)
+        return int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+
+    @staticmethod
+    def _count_records(path: str, offset: int = 0) -> int:
+        try:
+            with open(path, "r", encoding="utf-8") as segment:
+                segment.seek(offset)
+                return sum(json.loads(line).get("records", 0) for line in segment if line.strip())
+        except (OSError, ValueError):
+            return 0
+
+    def _close_active(self) -> None:
+        if self._active_file is not None:
+            self._active_file.close()
+        self._active_file = None
+        self._active_path = None
+        self._active_size = 0
+
+    def _open_active(self) -> None:
+        path = os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{self._next_seq:010d}{SEGMENT_SUFFIX}"
+        )
+        self._next_seq += 1
+        self._active_file = open(path, "a", encoding="utf-8")
+        self._active_path = path
+        self._active_size = 0
+        self._segments.append(path)
+
+    def _discard_oldest(self) -> bool:
+        """Delete the oldest closed segment to make room. Returns False if none."""
+        if not self._segments or self._segments[0] == self._active_path:
+            return False
+        path = self._segments.pop(0)
+        offset, self._replay_offset = self._replay_offset, 0
+        self.counters["spool_dropped"] += self._count_records(path, offset)
+        try:
+            self._total_bytes -= os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            pass
+        return True
+
+    # ---------- public API -----------------------------------------------
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            return bool(self._segments)
+
+    def append(self, streams: List[dict], records: int) -> bool:
+        """Append a batch. Returns False if it had to be dropped for lack of room."""
+        line = json.dumps({"records": records, "streams": streams}) + "\n"
+        size = len(line.encode("utf-8"))
+
+        with self._lock:
+            while self._total_bytes + size > self.max_bytes:
+                if not self._discard_oldest():
+                    self.counters["spool_dropped"] += records
+                    return False
+
+            if self._active_file is None or self._active_size + size > self.segment_bytes:
+                self._close_active()
+                self._open_active()
+
+            assert self._active_file is not None
+            self._active_file.write(line)
+            self._active_file.flush()
+            self._active_size += size
+            self._total_bytes += size
+            self.counters["spooled"] += records
+            return True
+
+    def replay(self, push: Callable[[List[dict]], bool]) -> int:
+        """Push spooled batches oldest first until the spool is empty or a push fails.
+
+        ``push`` returns False when Loki rejected a batch for good; it is skipped
+        and counted as rejected. Returns the number of records replayed. Other
+        push failures propagate so the caller can back off.
+        """
+        replayed = 0
+        while True:
+            with self._lock:
+                if not self._segments:
+                    return replayed
+                if self._segments[0] == self._active_path:
+                    # Seal the segment being written so it can be drained
+                    self._close_active()
+                path = self._segments[0]
+                offset = self._replay_offset
+
+            with open(path, "r", encoding="utf-8") as segment:
+                segment.seek(offset)
+                while True:
+                    line = segment.readline()
+                    if not line:
+                        break
+                    batch = None
+                    if line.strip():
+                        try:
+                            batch = json.loads(line)
+                        except ValueError:
+                            # Torn write from a crash; nothing to recover
+                            pass
+                        if batch is not None:
+                            accepted = push(batch["streams"])
+                            if accepted:
+                                replayed += batch.get("records", 0)
+                    with self._lock:
+                        if not self._segments or self._segments[0] != path:
+                            # Discarded by the size cap while replaying
+                            break
+                        if batch is not None:
+                            counter = "replayed" if accepted else "spool_rejected"
+                            self.counters[counter] += batch.get("records", 0)
+                        self._replay_offset = segment.tell()
+
+            with self._lock:
+                if self._segments and self._segments[0] == path:
+                    self._segments.pop(0)
+                    self._replay_offset = 0
+                    try:
+                        self._total_bytes -= os.path.getsize(path)
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot["spool_bytes"] = self._total_bytes
+            snapshot["spool_segments"] = len(self._segments)
+        return snapshot
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_active()
@@ -1,13 +1,72 @@
 import json
 import logging
 import os
+import queue
+import sys
+import threading
 import time
-import requests
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from utils.log_context import LABEL_FIELDS, LogContextFilter, label_values
+from utils.log_sampling import LogSampler
+from utils.log_spool import LogSpool
+from utils.loki_transport import LokiTransport, is_permanent_failure
+
+# Policies applied when the in-memory Loki queue is full
+LOKI_DROP_POLICIES = ("drop_newest", "drop_oldest", "spool")
+# stats() counters of records, by what the handler (and its spool) did with them
+LOKI_RECORD_RESULTS = (
+    "enqueued",
+    "dropped",
+    "sent",
+    "failed",
+    "spooled",
+    "replayed",
+    "spool_rejected",
+    "spool_dropped",
+)
+
+LokiEntry = Tuple[Tuple[Tuple[str, str], ...], str, str]
+
+# Control message that stops the Loki worker thread
+_STOP = object()
+
+# Wakes the Loki worker to read the control queue; never counted as a record
+_WAKE = object()
+
+# Record attributes never copied into the JSON details
+_DETAIL_IGNORED = frozenset(
+    (
+        "msg",
+        "args",
+        "exc_info",
+        "exc_text",
+        "stack_info",
+        "levelname",
+        "levelno",
+        "name",
+        "taskName",
+        # Exclude fields that are now labels
+        *LABEL_FIELDS,
+    )
+)
+
+# Bound on distinct label sets cached by a handler
+_STREAM_LABEL_CACHE_LIMIT = 1024
 
 
 class LokiHandler(logging.Handler):
-    """Push to Loki /loki/api/v1/push with authentication."""
+    """Push to Loki /loki/api/v1/push with authentication.
+
+    When ``async_mode`` is enabled records are enqueued in O(1) and a
+    background worker ships them in batches, so request threads never wait
+    on Loki. With a ``spool`` attached, batches that fail to push (and, with
+    the ``spool`` drop policy, records that overflow the queue) are written
+    to disk and replayed once Loki accepts pushes again. While the spool has
+    batches, new ones are spooled behind them so Loki receives entries in
+    order. Batches Loki rejects (4xx other than 429) are counted as failed
+    and never spooled or retried.
+    """
 
     def __init__(
         self,
@@ -20,15 +79,77 @@ class LokiHandler(logging.Handler):
         auth: Optional[Tuple[str, str]] = None,
         org_id: Optional[str] = None,
         timeout: float = 3.0,
+        async_mode: bool = True,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        queue_size: int = 10000,
+        drop_policy: str = "drop_newest",
+        push_format: str = "json",
+        compression: str = "gzip",
+        pool_maxsize: int = 4,
+        spool: Optional[LogSpool] = None,
+        replay_interval: float = 5.0,
     ):
         super().__init__()
+        if drop_policy not in LOKI_DROP_POLICIES:
+            raise ValueError(f"Invalid Loki drop policy: {drop_policy}")
+        if drop_policy == "spool" and spool is None:
+            raise ValueError("Loki drop policy 'spool' requires a spool")
+
         self.endpoint = url.rstrip("/") + "/loki/api/v1/push"
         self.timeout = timeout
-        self.auth = auth
-        self.org_id = org_id
+        self.transport = LokiTransport(
+            self.endpoint,
+            auth=auth,
+            org_id=org_id,
+            timeout=timeout,
+            push_format=push_format,
+            compression=compression,
+            pool_maxsize=pool_maxsize,
+        )
         self.labels = self._get_labels(
             service_name, model_provider, model, env, loki_labels
         )
+        self._stream_label_cache: Dict[Tuple[str, ...], Tuple[Tuple[str, str], ...]] = {}
+
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_interval)
+        self.drop_policy = drop_policy
+        self.spool = spool
+        self.replay_interval = max(0.1, replay_interval)
+        self._next_replay = 0.0
+        # Held by whoever is replaying the spool; others skip rather than wait
+        self._replay_lock = threading.Lock()
+        # Wakes the sync mode replay thread
+        self._replay_wakeup = threading.Event()
+        self._closing = False
+
+        self._counters_lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "enqueued": 0,
+            "dropped": 0,
+            "sent": 0,
+            "failed": 0,
+            "batches": 0,
+        }
+
+        self._queue: Optional["queue.Queue"] = None
+        # Flush events and _STOP, kept out of the bounded record queue so the
+        # drop_oldest policy can never evict them
+        self._control: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._worker: Optional[threading.Thread] = None
+        if async_mode:
+            self._queue = queue.Queue(maxsize=max(1, queue_size))
+            self._worker = threading.Thread(
+                target=self._run_worker, name="loki-shipper", daemon=True
+            )
+            self._worker.start()
+        elif spool is not None:
+            # Request threads push their own records but never replay the spool
+            self._worker = threading.Thread(
+                target=self._run_replayer, name="loki-replayer", daemon=True
+            )
+            self._worker.start()
 
     # ---------- helpers --------------------------------------------------
 
@@ -63,91 +184,326 @@ class LokiHandler(logging.Handler):
         return lbl
 
     @staticmethod
-    def _now_ns() -> str:
-        return str(int(time.time() * 1_000_000_000))
+    def _record_ns(record: logging.LogRecord) -> str:
+        return str(int(record.created * 1_000_000_000))
+
+    def _count(self, counter: str, amount: int = 1) -> None:
+        with self._counters_lock:
+            self.counters[counter] += amount
+
+    def stats(self) -> Dict[str, float]:
+        """Return a snapshot of the shipping and transport counters."""
+        with self._counters_lock:
+            snapshot: Dict[str, float] = dict(self.counters)
+        snapshot["queued"] = self._queue.qsize() if self._queue else 0
+        snapshot.update(self.transport.stats())
+        if self.spool is not None:
+            snapshot.update(self.spool.stats())
+        return snapshot
+
+    def _stream_labels(self, values: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+        """Merge dynamic label values into the static labels, cached per label set."""
+        try:
+            return self._stream_label_cache[values]
+        except KeyError:
+            pass
+
+        stream_labels = self.labels.copy()
+        stream_labels.update(zip(LABEL_FIELDS, values))
+        merged = tuple(stream_labels.items())
+        if len(self._stream_label_cache) >= _STREAM_LABEL_CACHE_LIMIT:
+            self._stream_label_cache.clear()
+        self._stream_label_cache[values] = merged
+        return merged
+
+    def _build_entry(self, record: logging.LogRecord) -> LokiEntry:
+        """Split a record into its stream labels, timestamp and JSON details.
+
+        Details are serialized here, at emit time, so a record that cannot be
+        serialized fails on its own and later changes to mutable extras are
+        not picked up.
+        """
+        fields = record.__dict__
+
+        # 1) Extract fields that should be labels. Records carrying the
+        # request context reuse its precomputed label values unless the
+        # caller overrode them through ``extra``.
+        context = fields.get("_log_context")
+        if context is not None and all(
+            fields.get(name) is getattr(context, name) for name in LABEL_FIELDS
+        ):
+            values = context.label_values
+        else:
+            values = label_values(*(fields.get(name, "") for name in LABEL_FIELDS))
+
+        # 2) Build details dictionary for JSON log message
+        detail = {
+            k: v
+            for k, v in fields.items()
+            if v is not None and k not in _DETAIL_IGNORED and not k.startswith("_")
+        }
 
-    def emit(self, record: logging.LogRecord) -> None:
+        # 3) automatically add metadata fields
+        detail["level"] = record.levelname.lower()
+        detail["message"] = record.getMessage()
+
+        # 4) ensure session_key is always present
+        if "session_key" not in detail:
+            detail["session_key"] = ""
+
+        return (
+            self._stream_labels(values),
+            self._record_ns(record),
+            json.dumps(detail, default=str),
+        )
+
+    @staticmethod
+    def _build_streams(entries: List[LokiEntry]) -> List[dict]:
+        """Group entries into Loki streams by label set, keeping entry order."""
+        streams: Dict[Tuple[Tuple[str, str], ...], list] = {}
+        for labels, timestamp, line in entries:
+            # Loki value format: [timestamp, log_message]
+            streams.setdefault(labels, []).append([timestamp, line])
+        return [
+            {"stream": dict(labels), "values": values}
+            for labels, values in streams.items()
+        ]
+
+    def _push(self, streams: List[dict]) -> None:
+        self.transport.push(streams)
+
+    def _push_spooled(self, streams: List[dict]) -> bool:
+        """Push for spool replay: False when Loki rejected the batch for good."""
+        try:
+            self._push(streams)
+            return True
+        except Exception as e:
+            if not is_permanent_failure(e):
+                raise
+            self._count("failed", sum(len(stream["values"]) for stream in streams))
+            return False
+
+    def _ship(self, streams: List[dict], records: int) -> Optional[Exception]:
+        """
+        Push streams, or spool them when they must wait or could not be pushed.
+        Returns the error when the records were lost (counted as failed).
+        """
+        if self.spool is not None and self.spool.has_pending():
+            # Older entries are still spooled; queue behind them to keep order
+            if self._spool_streams(streams, records):
+                return None
+        try:
+            self._push(streams)
+            self._count("sent", records)
+            self._count("batches")
+            return None
+        except Exception as e:
+            if not is_permanent_failure(e) and self._spool_streams(streams, records):
+                self._next_replay = time.monotonic() + self.replay_interval
+                return None
+            self._count("failed", records)
+            return e
+
+    def _spool_streams(self, streams: List[dict], records: int) -> bool:
+        """Write streams to the disk spool. Returns False if they were not kept."""
+        if self.spool is None:
+            return False
+        try:
+            return self.spool.append(streams, records)
+        except OSError:
+            return False
+
+    def _replay_due(self) -> bool:
+        return (
+            self.spool is not None
+            and time.monotonic() >= self._next_replay
+            and self.spool.has_pending()
+        )
+
+    def _replay_spool(self) -> None:
+        """Drain spooled batches, backing off for replay_interval after a failure."""
+        if not self._replay_due() or not self._replay_lock.acquire(blocking=False):
+            return
+        assert self.spool is not None
+        try:
+            self.spool.replay(self._push_spooled)
+        except Exception:
+            self._next_replay = time.monotonic() + self.replay_interval
+        finally:
+            self._replay_lock.release()
+
+    # ---------- synchronous mode -----------------------------------------
+
+    def _emit_sync(self, record: logging.LogRecord) -> None:
+        try:
+            error = self._ship(self._build_streams([self._build_entry(record)]), 1)
+        except Exception:
+            # swallow failures: logging must never crash the app
+            self._count("failed")
+            self.handleError(record)
+            return
+        if error is not None:
+            self.handleError(record)
+        elif self.spool is not None and self.spool.has_pending():
+            self._replay_wakeup.set()
+
+    def _run_replayer(self) -> None:
+        """Sync mode: replay the spool off the request threads."""
+        while not self._closing:
+            self._replay_wakeup.wait(self.replay_interval)
+            self._replay_wakeup.clear()
+            if not self._closing:
+                self._replay_spool()
+
+    # ---------- queued mode ----------------------------------------------
+
+    def _enqueue(self, entry: LokiEntry) -> None:
+        assert self._queue is not None
         try:
-            # 1) Extract fields that should be labels
-            label_fields = ["class_selection", "lesson", "action_plan"]
-            stream_labels = self.labels.copy()
-            
-            # Add dynamic labels from record
-            for field in label_fields:
-                value = getattr(record, field, "")
-                # Ensure value is a string
-                if value:
-                    # Convert to string and limit length
-                    str_value = str(value)
-                    stream_labels[field] = str_value[:1024] if len(str_value) > 1024 else str_value
+            self._queue.put_nowait(entry)
+            self._count("enqueued")
+            return
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "drop_oldest":
+            try:
+                if self._queue.get_nowait() is not _WAKE:
+                    self._count("dropped")
+                self._queue.put_nowait(entry)
+                self._count("enqueued")
+                return
+            except (queue.Empty, queue.Full):
+                pass
+
+        if self.drop_policy == "spool" and self._spool_streams(
+            self._build_streams([entry]), 1
+        ):
+            return
+
+        self._count("dropped")
+
+    def _flush_batch(self, batch: List[LokiEntry]) -> None:
+        if not batch:
+            return
+        # Older spooled entries go first
+        self._replay_spool()
+        try:
+            error = self._ship(self._build_streams(batch), len(batch))
+        except Exception as e:
+            self._count("failed", len(batch))
+            error = e
+        if error is not None and logging.raiseExceptions:
+            sys.stderr.write(
+                f"LokiHandler failed to push {len(batch)} records: {error}\n"
+            )
+        batch.clear()
+
+    def _drain_queue(self, batch: List[LokiEntry]) -> None:
+        """Ship everything queued so far, for flush and stop requests."""
+        assert self._queue is not None
+        for _ in range(self._queue.qsize()):
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _WAKE:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._flush_batch(batch)
+        self._flush_batch(batch)
+
+    def _handle_control(self, batch: List[LokiEntry]) -> bool:
+        """Answer pending flush and stop requests. Returns True to stop the worker."""
+        stop = False
+        while True:
+            try:
+                item = self._control.get_nowait()
+            except queue.Empty:
+                return stop
+            self._drain_queue(batch)
+            if item is _STOP:
+                stop = True
+            else:
+                item.set()
+
+    def _send_control(self, item: object) -> None:
+        assert self._queue is not None
+        self._control.put(item)
+        try:
+            self._queue.put_nowait(_WAKE)
+        except queue.Full:
+            # The worker has records to read and checks the control queue after each
+            pass
+
+    def _run_worker(self) -> None:
+        assert self._queue is not None
+        batch: List[LokiEntry] = []
+        batch_started = 0.0
+
+        while True:
+            if batch:
+                wait = max(0.0, batch_started + self.flush_interval - time.monotonic())
+            elif self.spool is not None and self.spool.has_pending():
+                wait = max(0.0, self._next_replay - time.monotonic())
+            else:
+                wait = None
+
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                # Oldest record in the batch reached flush_interval, or a
+                # spool replay is due
+                if batch:
+                    self._flush_batch(batch)
                 else:
-                    stream_labels[field] = ""  # Empty string for missing values
-            
-            # 2) Build details dictionary for JSON log message
-            ignored = {
-                "msg",
-                "args",
-                "exc_info",
-                "exc_text",
-                "stack_info",
-                "levelname",
-                "levelno",
-                "name",
-                "taskName",
-                # Exclude fields that are now labels
-                "class_selection",
-                "lesson", 
-                "action_plan",
-            }
-            detail = {}
-            for k, v in record.__dict__.items():
-                if k not in ignored and not k.startswith("_"):
-                    if v is None:
-                        continue
-                    
-                    # Keep original field names and values for JSON
-                    if isinstance(v, (str, int, float, bool)):
-                        # Keep primitive types as-is for JSON
-                        detail[k] = v
-                    else:
-                        # Complex objects remain as-is for JSON serialization
-                        detail[k] = v
-
-            # 3) automatically add metadata fields
-            detail["level"] = record.levelname.lower()
-            detail["message"] = record.getMessage()
-            
-            # 4) ensure session_key is always present
-            if "session_key" not in detail:
-                detail["session_key"] = ""
-
-            # 5) Create JSON log message with all details
-            log_json = json.dumps(detail)
-            
-            # 6) Loki value format: [timestamp, log_message]
-            value = [self._now_ns(), log_json]
-
-            payload = {"streams": [{"stream": stream_labels, "values": [value]}]}
-
-
-            # Prepare request parameters
-            kwargs = {"json": payload, "timeout": self.timeout}
-
-            # Add authentication if provided
-            if self.auth:
-                kwargs["auth"] = self.auth
-
-            # Add headers if org_id is provided
-            if self.org_id:
-                kwargs["headers"] = {"X-Scope-OrgID": self.org_id}
-
-            response = requests.post(self.endpoint, **kwargs)
-            response.raise_for_status()
+                    self._replay_spool()
+                item = _WAKE
+
+            if item is not _WAKE:
+                if not batch:
+                    batch_started = time.monotonic()
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._flush_batch(batch)
 
+            if not self._control.empty() and self._handle_control(batch):
+                return
+
+    # ---------- logging.Handler API --------------------------------------
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._queue is None:
+            self._emit_sync(record)
+            return
+
+        try:
+            self._enqueue(self._build_entry(record))
         except Exception:
             # swallow failures: logging must never crash the app
             self.handleError(record)
 
+    def flush(self) -> None:
+        """Block until everything queued so far has been pushed (bounded by timeout)."""
+        if self._queue is None or self._worker is None or not self._worker.is_alive():
+            return
+        done = threading.Event()
+        self._send_control(done)
+        done.wait(self.timeout + self.flush_interval)
+
+    def close(self) -> None:
+        if self._queue is None and self._worker is not None:
+            self._closing = True
+            self._replay_wakeup.set()
+            self._worker.join(self.timeout)
+        elif self._worker is not None and self._worker.is_alive():
+            self._send_control(_STOP)
+            self._worker.join(self.timeout + self.flush_interval)
+        if self.spool is not None:
+            self.spool.close()
+        self.transport.close()
+        super().close()
+
 
 _logger_instance = None
 
@@ -163,6 +519,19 @@ def setup_logger(
     loki_password="",
     loki_org_id="",
     loki_labels="",
+    loki_async=True,
+    loki_batch_size=100,
+    loki_flush_interval=2.0,
+    loki_queue_size=10000,
+    loki_drop_policy="drop_newest",
+    loki_push_format="json",
+    loki_compression="gzip",
+    loki_pool_maxsize=4,
+    loki_spool_dir="",
+    loki_spool_max_bytes=100 * 1024 * 1024,
+    loki_spool_segment_bytes=4 * 1024 * 1024,
+    sampling_rules=None,
+    sampling_summary_interval=60.0,
 ) -> logging.Logger:
     """Set up and return the centralized logger instance."""
     global _logger_instance
@@ -174,9 +543,25 @@ def setup_logger(
     lg.setLevel(level)
     lg.handlers.clear()  # Clear any existing handlers
 
+    # Fill in session and lesson fields from the current request context
+    lg.addFilter(LogContextFilter())
+
+    # Sample high-volume records before any handler pays for them
+    if sampling_rules:
+        lg.addFilter(LogSampler(lg, sampling_rules, sampling_summary_interval))
+
     # Set up Loki handler if URL is provided
     if loki_url:
         auth = (loki_user, loki_password) if loki_user and loki_password else None
+        spool = (
+            LogSpool(
+                loki_spool_dir,
+                max_bytes=loki_spool_max_bytes,
+                segment_bytes=loki_spool_segment_bytes,
+            )
+            if loki_spool_dir
+            else None
+        )
 
         h = LokiHandler(
             service_name=name,
@@ -187,6 +572,15 @@ def setup_logger(
             loki_labels=loki_labels,
             auth=auth,
             org_id=loki_org_id,
+            async_mode=loki_async,
+            batch_size=loki_batch_size,
+            flush_interval=loki_flush_interval,
+            queue_size=loki_queue_size,
+            drop_policy=loki_drop_policy,
+            push_format=loki_push_format,
+            compression=loki_compression,
+            pool_maxsize=loki_pool_maxsize,
+            spool=spool,
         )
         h.setFormatter(logging.Formatter("%(levelname)s — %(message)s"))
         lg.addHandler(h)
@@ -212,3 +606,11 @@ def get_logger() -> logging.Logger:
         return logging.getLogger("tutorbot-server")
 
     return _logger_instance
+
+
+def get_loki_handler() -> Optional[LokiHandler]:
+    """Return the Loki handler attached to the centralized logger, if any."""
+    for handler in get_logger().handlers:
+        if isinstance(handler, LokiHandler):
+            return handler
+    return None
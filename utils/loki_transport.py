@@ -0,0 +1,181 @@
+import gzip
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import LOKI_FLUSH_SECONDS
+
+LOKI_PUSH_FORMATS = ("json", "protobuf")
+LOKI_COMPRESSIONS = ("none", "gzip")
+
+
+def _load_snappy() -> Callable[[bytes], bytes]:
+    """Return a raw (block format) snappy compressor, as Loki expects."""
+    try:
+        import snappy  # python-snappy
+
+        return snappy.compress
+    except ImportError:
+        pass
+
+    try:
+        import cramjam
+
+        return lambda data: bytes(cramjam.snappy.compress_raw(data))
+    except ImportError:
+        raise ValueError(
+            "LOKI_PUSH_FORMAT=protobuf requires the python-snappy or cramjam package"
+        )
+
+
+# ---------- protobuf encoding ---------------------------------------------
+#
+# Minimal encoder for Loki's logproto.PushRequest:
+#
+#   PushRequest { repeated Stream streams = 1; }
+#   Stream      { string labels = 1; repeated Entry entries = 2; }
+#   Entry       { Timestamp timestamp = 1; string line = 2; }
+#   Timestamp   { int64 seconds = 1; int32 nanos = 2; }
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field_bytes(field: int, data: bytes) -> bytes:
+    return _varint((field << 3) | 2) + _varint(len(data)) + data
+
+
+def _field_varint(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(value)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """Render a label set in Prometheus selector syntax: {k="v", ...}."""
+    pairs = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ", ".join(pairs) + "}"
+
+
+def encode_push_request(streams: List[dict]) -> bytes:
+    """Encode JSON-style Loki streams as a logproto.PushRequest message."""
+    body = bytearray()
+    for stream in streams:
+        stream_msg = bytearray(_field_bytes(1, _format_labels(stream["stream"]).encode("utf-8")))
+        for timestamp, line in stream["values"]:
+            seconds, nanos = divmod(int(timestamp), 1_000_000_000)
+            ts_msg = _field_varint(1, seconds)
+            if nanos:
+                ts_msg += _field_varint(2, nanos)
+            entry_msg = _field_bytes(1, ts_msg) + _field_bytes(2, line.encode("utf-8"))
+            stream_msg += _field_bytes(2, entry_msg)
+        body += _field_bytes(1, bytes(stream_msg))
+    return bytes(body)
+
+
+def is_permanent_failure(error: Exception) -> bool:
+    """True when Loki rejected the push itself (4xx other than 429), so retrying cannot help."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return (
+        isinstance(error, requests.HTTPError)
+        and status is not None
+        and 400 <= status < 500
+        and status != 429
+    )
+
+
+class LokiTransport:
+    """Pooled keep-alive HTTP transport for Loki pushes with compressed bodies."""
+
+    def __init__(
+        self,
+        endpoint: str,
+        auth: Optional[Tuple[str, str]] = None,
+        org_id: Optional[str] = None,
+        timeout: float = 3.0,
+        push_format: str = "json",
+        compression: str = "gzip",
+        pool_maxsize: int = 4,
+    ):
+        if push_format not in LOKI_PUSH_FORMATS:
+            raise ValueError(f"Invalid Loki push format: {push_format}")
+        if compression not in LOKI_COMPRESSIONS:
+            raise ValueError(f"Invalid Loki compression: {compression}")
+
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.push_format = push_format
+        self.compression = compression
+        self._snappy = _load_snappy() if push_format == "protobuf" else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_maxsize))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if auth:
+            self.session.auth = auth
+        if org_id:
+            self.session.headers["X-Scope-OrgID"] = org_id
+
+        self._counters_lock = threading.Lock()
+        self.counters: Dict[str, float] = {
+            "flushes": 0,
+            "flush_seconds_total": 0.0,
+            "last_flush_seconds": 0.0,
+            "bytes_uncompressed": 0,
+            "bytes_sent": 0,
+        }
+
+    def _encode(self, streams: List[dict]) -> Tuple[bytes, int, Dict[str, str]]:
+        """Return (wire body, uncompressed size, headers) for a push."""
+        if self._snappy is not None:
+            raw = encode_push_request(streams)
+            return self._snappy(raw), len(raw), {"Content-Type": "application/x-protobuf"}
+
+        raw = json.dumps({"streams": streams}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.compression == "gzip":
+            headers["Content-Encoding"] = "gzip"
+            return gzip.compress(raw, compresslevel=6), len(raw), headers
+        return raw, len(raw), headers
+
+    def push(self, streams: List[dict]) -> None:
+        body, raw_size, headers = self._encode(streams)
+
+        started = time.perf_counter()
+        response = self.session.post(
+            self.endpoint, data=body, headers=headers, timeout=self.timeout
+        )
+        elapsed = time.perf_counter() - started
+
+        with self._counters_lock:
+            self.counters["flushes"] += 1
+            self.counters["flush_seconds_total"] += elapsed
+            self.counters["last_flush_seconds"] = elapsed
+            self.counters["bytes_uncompressed"] += raw_size
+            self.counters["bytes_sent"] += len(body)
+        LOKI_FLUSH_SECONDS.observe(elapsed)
+
+        response.raise_for_status()
+
+    def stats(self) -> Dict[str, float]:
+        """Return a snapshot of the transport counters."""
+        with self._counters_lock:
+            return dict(self.counters)
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,436 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Label value used once a metric has reached its label-set limit
+OVERFLOW_LABEL_VALUE = "__other__"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 20000, 50000, 100000, 200000)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _callback_values(callback: Callable[[], object]) -> List[Tuple[LabelKey, float]]:
+    """Samples from a scrape-time callback; none when it fails."""
+    try:
+        result = callback()
+    except Exception:
+        return []
+    if isinstance(result, dict):
+        return [(tuple(key), value) for key, value in result.items()]
+    return [((), result)]
+
+
+class Metric:
+    """Base class for a labelled metric family with bounded label cardinality."""
+
+    type_name = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        max_label_sets: int = 100,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.max_label_sets = max_label_sets
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str], known: Dict[LabelKey, object]) -> LabelKey:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        if key not in known and len(known) >= self.max_label_sets:
+            return tuple(OVERFLOW_LABEL_VALUE for _ in self.label_names)
+        return key
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ] + self.samples()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Counter incremented directly, or read at scrape time from ``callback``.
+
+    A callback returns either a single value or a mapping of label values to
+    values, and must only ever grow (like the running totals it exports).
+    """
+
+    type_name = "counter"
+
+    def __init__(
+        self,
+        *args,
+        callback: Optional[Callable[[], object]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelKey, float] = {}
+        self.callback = callback
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        with self._lock:
+            key = self._key(labels, self._values)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        if self.callback is not None:
+            values = _callback_values(self.callback)
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """Gauge set directly, or computed at scrape time by ``callback``.
+
+    A callback returns either a single value or a mapping of label values to
+    values.
+    """
+
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        *args,
+        callback: Optional[Callable[[], object]] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelKey, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels, self._values)] = value
+
+    def samples(self) -> List[str]:
+        if self.callback is not None:
+            values = _callback_values(self.callback)
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label key -> [bucket counts..., sum, count]
+        self._values: Dict[LabelKey, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        with self._lock:
+            key = self._key(labels, self._values)
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+
+        lines = []
+        for key, state in values:
+            cumulative = 0.0
+            for index, bound in enumerate(self.buckets):
+                cumulative += state[index]
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {_format_value(cumulative)}"
+                )
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(state[-1])}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Labels for per-request LLM metrics. provider and model are fixed per
+# process; class_selection is bounded by max_label_sets.
+LLM_LABELS = ("provider", "model", "class_selection")
+
+CHATBOT_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_chatbot_request_seconds",
+        "End-to-end /chatbot/ latency in seconds",
+        LLM_LABELS,
+    )
+)
+CHATBOT_STREAM_FIRST_TOKEN_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_chatbot_stream_first_token_seconds",
+        "Time from /chatbot/stream request to the first streamed answer token in seconds",
+        LLM_LABELS,
+    )
+)
+LLM_INVOKE_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_llm_invoke_seconds",
+        "Latency of a single LLM call in seconds",
+        LLM_LABELS,
+    )
+)
+SSR_ITERATIONS = REGISTRY.register(
+    Histogram(
+        "tutorbot_ssr_iterations",
+        "SSR passes per chat request",
+        LLM_LABELS,
+        buckets=(1, 2, 3, 4, 5, 6, 8),
+    )
+)
+LLM_INPUT_TOKENS = REGISTRY.register(
+    Histogram(
+        "tutorbot_llm_input_tokens",
+        "Input tokens per chat request",
+        LLM_LABELS,
+        buckets=TOKEN_BUCKETS,
+    )
+)
+LLM_OUTPUT_TOKENS = REGISTRY.register(
+    Histogram(
+        "tutorbot_llm_output_tokens",
+        "Output tokens per chat request",
+        LLM_LABELS,
+        buckets=TOKEN_BUCKETS,
+    )
+)
+LLM_CACHE_READ_TOKENS = REGISTRY.register(
+    Counter(
+        "tutorbot_llm_cache_read_tokens_total",
+        "Input tokens served from the provider's prompt cache",
+        LLM_LABELS,
+    )
+)
+LLM_CACHE_CREATION_TOKENS = REGISTRY.register(
+    Counter(
+        "tutorbot_llm_cache_creation_tokens_total",
+        "Input tokens written to the provider's prompt cache",
+        LLM_LABELS,
+    )
+)
+SSR_EARLY_ABORTS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_early_aborts_total",
+        "Retrieval passes stopped once their content request was complete",
+        LLM_LABELS,
+    )
+)
+SSR_EARLY_ABORT_SAVED_TOKENS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_early_abort_saved_output_tokens_total",
+        "Estimated output tokens not generated because of early abort",
+        LLM_LABELS,
+    )
+)
+SSR_EARLY_ABORT_SAVED_SECONDS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_early_abort_saved_seconds_total",
+        "Estimated generation seconds saved by early abort",
+        LLM_LABELS,
+    )
+)
+SSR_RETRIEVAL_TAIL_TOKENS = REGISTRY.register(
+    Histogram(
+        "tutorbot_ssr_retrieval_tail_output_tokens",
+        "Output tokens generated after a complete content request on passes run to completion",
+        LLM_LABELS,
+        buckets=(0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+    )
+)
+SSR_RETRIEVAL_TAIL_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_ssr_retrieval_tail_seconds",
+        "Seconds spent generating after a complete content request on passes run to completion",
+        LLM_LABELS,
+    )
+)
+SSR_PARSER_FALLBACKS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_parser_fallbacks_total",
+        "SSR responses parsed with BeautifulSoup because the fast scanner could not handle them",
+    )
+)
+PROMPT_PACK_LOOKUPS = REGISTRY.register(
+    Counter(
+        "tutorbot_prompt_pack_lookups_total",
+        "Prompt pack cache lookups by result (hit, miss, refresh, coalesced, disabled)",
+        ("result",),
+    )
+)
+RESPONSE_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "tutorbot_response_cache_lookups_total",
+        "Cross-session response cache lookups by result (hit, miss, coalesced)",
+        ("result",),
+    )
+)
+CONVERSATION_COMPACTIONS = REGISTRY.register(
+    Counter(
+        "tutorbot_conversation_compactions_total",
+        "Background conversation summary compactions by result (ok, error, discarded)",
+        ("result",),
+    )
+)
+SSR_MANIFEST_REFRESH_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_ssr_manifest_refresh_seconds",
+        "Time to list the class tree and rebuild the SSR content manifest in seconds",
+    )
+)
+SSR_MISSING_KEYS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_missing_keys_total",
+        "Requested SSR content keys rejected because the manifest has no such file",
+        LLM_LABELS,
+    )
+)
+SSR_ROUTE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_route_lookups_total",
+        "SSR route cache lookups by result (hit, miss, low_confidence)",
+        LLM_LABELS + ("result",),
+    )
+)
+SSR_ROUTE_PRELOADS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_route_preloads_total",
+        "First passes with route cache content by result (answered saves a pass, "
+        "requested still asked for content, holdout ran without it)",
+        LLM_LABELS + ("result",),
+    )
+)
+SSR_COMPANION_KEYS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_companion_keys_total",
+        "SSR content keys loaded because they are usually requested with the requested "
+        "keys, by result (loaded, holdout)",
+        LLM_LABELS + ("result",),
+    )
+)
+SSR_DEFERRED_KEYS = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_deferred_keys_total",
+        "Requested SSR content keys left out of a pass because of the content size limit",
+        LLM_LABELS,
+    )
+)
+SSR_PREFETCHES = REGISTRY.register(
+    Counter(
+        "tutorbot_ssr_prefetches_total",
+        "SSR prefetch outcomes on the first pass (skipped, answered, requested, "
+        "holdout_answered, holdout_match, holdout_no_match)",
+        LLM_LABELS + ("result",),
+    )
+)
+OPEN_TEXT_FILE_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_open_text_file_seconds",
+        "Latency of open_text_file in seconds",
+        ("backend",),
+    )
+)
+LOKI_FLUSH_SECONDS = REGISTRY.register(
+    Histogram(
+        "tutorbot_loki_flush_seconds",
+        "Latency of a Loki push in seconds",
+    )
+)
+LIVE_SESSIONS = REGISTRY.register(
+    Gauge("tutorbot_live_sessions", "Sessions held by the session manager")
+)
+CONVERSATION_BYTES = REGISTRY.register(
+    Gauge(
+        "tutorbot_conversation_bytes",
+        "Total conversation content bytes held by the session manager",
+    )
+)
+LOKI_RECORDS = REGISTRY.register(
+    Counter(
+        "tutorbot_loki_records_total",
+        "Log records by what the Loki handler did with them",
+        ("result",),
+    )
+)
+LOKI_BATCHES = REGISTRY.register(
+    Counter("tutorbot_loki_batches_total", "Batches of log records pushed to Loki")
+)
+LOKI_BYTES = REGISTRY.register(
+    Counter(
+        "tutorbot_loki_bytes_total",
+        "Bytes of Loki pushes before (uncompressed) and after (sent) compression",
+        ("stage",),
+    )
+)
+LOKI_QUEUED_RECORDS = REGISTRY.register(
+    Gauge("tutorbot_loki_queued_records", "Log records waiting in the Loki handler queue")
+)
+LOKI_SPOOL_BYTES = REGISTRY.register(
+    Gauge("tutorbot_loki_spool_bytes", "Size of the Loki spool on disk")
+)
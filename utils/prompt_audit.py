@@ -0,0 +1,166 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from utils.logger import get_logger
+
+if TYPE_CHECKING:
+    from SessionCache import SimpleCounterLLMConversation
+
+logger = get_logger()
+
+PROMPT_LOG_MODES = ("off", "hash", "delta", "full")
+
+# Enforce 2 MB limit on logged prompt text
+MAX_LOG_SIZE = 2 * 1024 * 1024
+
+
+def content_hash(text: str) -> str:
+    """Short, stable content address for prompt text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _truncate(text: str) -> str:
+    if len(text) > MAX_LOG_SIZE:
+        return text[:MAX_LOG_SIZE] + "... [TRUNCATED]"
+    return text
+
+
+class PromptAuditLogger:
+    """Log the prompt sent on each SSR iteration according to PROMPT_LOG_MODE.
+
+    - off:   nothing is logged
+    - hash:  only content hashes and sizes of the prompt parts
+    - delta: conversation messages added since the last logged prompt, with
+             static components (scenario, conundrum, action plan, SSR content)
+             logged in full once per content hash and referenced afterwards
+    - full:  the whole joined prompt and conversation on every iteration
+    """
+
+    def __init__(self, mode: str = "full", known_components: int = 4096) -> None:
+        if mode not in PROMPT_LOG_MODES:
+            raise ValueError(f"Invalid prompt log mode: {mode}")
+        self.mode = mode
+        self._known_components = known_components
+
+        self._lock = threading.Lock()
+        self._logged_hashes: "OrderedDict[str, None]" = OrderedDict()
+        # conversation -> (last logged message id, message id counter at that time)
+        self._positions: "weakref.WeakKeyDictionary[SimpleCounterLLMConversation, Tuple[int, int]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _component_ref(self, name: str, text: str) -> str:
+        digest = content_hash(text)
+        if self.mode != "delta":
+            return digest
+
+        with self._lock:
+            seen = digest in self._logged_hashes
+            if seen:
+                self._logged_hashes.move_to_end(digest)
+            else:
+                self._logged_hashes[digest] = None
+                if len(self._logged_hashes) > self._known_components:
+                    self._logged_hashes.popitem(last=False)
+
+        if not seen:
+            logger.info(
+                f"PROMPT COMPONENT ({name}) {digest}",
+                extra={
+                    "component": name,
+                    "content_hash": digest,
+                    "content_bytes": str(len(text.encode("utf-8"))),
+                    "content": _truncate(text),
+                },
+            )
+        return digest
+
+    def _new_messages(self, conversation: "SimpleCounterLLMConversation") -> List[dict]:
+        with self._lock:
+            last_id, counter_seen = self._positions.get(conversation, (0, 0))
+            if conversation.message_id_counter < counter_seen:
+                # Conversation was cleared (ids restart) since the last prompt
+                last_id = 0
+            self._positions[conversation] = (
+                conversation.message_id_counter - 1,
+                conversation.message_id_counter,
+            )
+
+        return [
+            {"id": message["id"], "role": message["role"], "content": message["content"]}
+            for message in conversation.conversation
+            if message["id"] > last_id
+        ]
+
+    def log_prompt(
+        self,
+        iteration: int,
+        user_text: str,
+        messages: List[Tuple[str, str]],
+        conversation: "SimpleCounterLLMConversation",
+        components: Dict[str, str],
+    ) -> None:
+        if self.mode == "off":
+            return
+
+        title = "USER REQUEST" if iteration == 1 else "SSR REQUEST"
+
+        if self.mode == "full":
+            # Turn list of tuples into a readable string
+            messages_str = _truncate(
+                "\n".join([f"{role.upper()}: {content}" for role, content in messages])
+            )
+            if iteration == 1:
+                message = f"{title} :({user_text}).  LLM REQUEST : \n{messages_str}"
+            else:
+                message = f"{title} : ({user_text})\nLLM REQUEST :({messages_str})"
+            logger.info(
+                message,
+                extra={
+                    "messages": conversation.get_serializable_conversation(),
+                },
+            )
+            return
+
+        prompt_digest = hashlib.sha256()
+        prompt_bytes = 0
+        for role, content in messages:
+            encoded = f"{role}\n{content}".encode("utf-8")
+            prompt_digest.update(encoded)
+            prompt_bytes += len(encoded)
+
+        refs = {
+            name: self._component_ref(name, text)
+            for name, text in components.items()
+            if text
+        }
+        new_messages = self._new_messages(conversation)
+
+        if self.mode == "hash":
+            user_ref = content_hash(user_text)
+            new_messages = [
+                {
+                    "id": message["id"],
+                    "role": message["role"],
+                    "content_hash": content_hash(message["content"]),
+                }
+                for message in new_messages
+            ]
+            message = f"{title} :(hash {user_ref})"
+        else:
+            message = f"{title} :({user_text})"
+
+        logger.info(
+            message,
+            extra={
+                "prompt_log_mode": self.mode,
+                "iteration": str(iteration),
+                "prompt_hash": prompt_digest.hexdigest()[:16],
+                "prompt_bytes": str(prompt_bytes),
+                "components": refs,
+                "new_messages": new_messages,
+            },
+        )
@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.logger import get_logger
+from utils.metrics import PROMPT_PACK_LOOKUPS
+
+logger = get_logger()
+
+# (classSelection, lesson, actionPlan)
+PromptPackKey = Tuple[str, str, str]
+
+
+@dataclass(frozen=True)
+class PromptPack:
+    """Static prompt components for one class/lesson/action plan, compiled once."""
+
+    key: PromptPackKey
+    scenario: str
+    conundrum: str
+    action_plan: str
+    # Pre-concatenated system text for the configured provider and layout
+    system_prefix: str
+    # Content hash of the three components, changes when any file changes
+    version: str
+    sizes: Dict[str, int] = field(default_factory=dict)
+    loaded_at: float = 0.0
+
+    @property
+    def complete(self) -> bool:
+        """False when the conundrum or action plan could not be loaded."""
+        return bool(self.conundrum) and bool(self.action_plan)
+
+
+def prompt_pack_version(scenario: str, conundrum: str, action_plan: str) -> str:
+    digest = hashlib.sha256()
+    for text in (scenario, conundrum, action_plan):
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+PromptPackLoader = Callable[[PromptPackKey], Awaitable[PromptPack]]
+
+
+class PromptPackCache:
+    """LRU cache of prompt packs with TTL expiry and coalesced loads.
+
+    Concurrent requests for a pack that is missing or expired share one load.
+    When an expired pack reloads with the same version, the cached pack is
+    kept. Incomplete packs (missing conundrum or action plan, e.g. after a
+    transient S3 error) are returned but not cached. A ttl of 0 disables
+    caching.
+    """
+
+    def __init__(
+        self, loader: PromptPackLoader, ttl: float = 300.0, max_entries: int = 256
+    ) -> None:
+        self.loader = loader
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._packs: "OrderedDict[PromptPackKey, PromptPack]" = OrderedDict()
+        self._loading: Dict[PromptPackKey, "asyncio.Future[PromptPack]"] = {}
+
+    async def get(self, class_selection: str, lesson: str, action_plan: str) -> PromptPack:
+        key = (class_selection or "", lesson or "", action_plan or "")
+        if self.ttl <= 0:
+            PROMPT_PACK_LOOKUPS.inc(result="disabled")
+            return await self.loader(key)
+
+        cached = self._packs.get(key)
+        if cached is not None and time.monotonic() - cached.loaded_at < self.ttl:
+            self._packs.move_to_end(key)
+            PROMPT_PACK_LOOKUPS.inc(result="hit")
+            return cached
+
+        loading = self._loading.get(key)
+        if loading is not None:
+            PROMPT_PACK_LOOKUPS.inc(result="coalesced")
+        else:
+            PROMPT_PACK_LOOKUPS.inc(result="refresh" if cached is not None else "miss")
+            # Load in a separate task so a cancelled request does not fail the others waiting
+            loading = asyncio.ensure_future(self._load(key, cached))
+            self._loading[key] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, key: PromptPackKey, cached: Optional[PromptPack]) -> PromptPack:
+        pack = await self.loader(key)
+        if not pack.complete:
+            return pack
+
+        if cached is not None and cached.version == pack.version:
+            # Unchanged since the last load; keep the compiled pack
+            pack = replace(cached, loaded_at=pack.loaded_at)
+        elif cached is not None:
+            logger.info(
+                "Prompt pack changed",
+                extra={
+                    "previous_version": cached.version,
+                    "version": pack.version,
+                },
+            )
+
+        self._packs[key] = pack
+        self._packs.move_to_end(key)
+        while len(self._packs) > self.max_entries:
+            self._packs.popitem(last=False)
+        return pack
+
+    def invalidate(self, class_selection: Optional[str] = None) -> None:
+        """Drop cached packs, for one class or all of them."""
+        if class_selection is None:
+            self._packs.clear()
+            return
+        for key in [key for key in self._packs if key[0] == class_selection]:
+            del self._packs[key]
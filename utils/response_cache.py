@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from utils.metrics import RESPONSE_CACHE_LOOKUPS
+
+_WHITESPACE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.!?,;:"
+
+
+def normalize_text(text: str) -> str:
+    """Case, whitespace and trailing punctuation do not change the answer."""
+    return _WHITESPACE.sub(" ", text.casefold()).strip(_EDGE_PUNCTUATION)
+
+
+def response_cache_key(
+    class_selection: str,
+    lesson: str,
+    action_plan: str,
+    history: Sequence[Tuple[str, str]],
+    text: str,
+) -> str:
+    digest = hashlib.sha256()
+    for part in (class_selection, lesson, action_plan):
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    for role, content in history:
+        digest.update(f"{role}\0{normalize_text(content)}\0".encode("utf-8"))
+    digest.update(b"\1")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    # (role, content, conv_content) of every message the turn added to the conversation
+    messages: List[Tuple[str, str, Optional[str]]]
+    # Data of the "final" event, see run_ssr_loop
+    final: Dict[str, Any]
+    stored_at: float = field(default_factory=time.monotonic)
+
+
+class ResponseCache:
+    """
+    LRU cache of whole responses shared across sessions, with TTL expiry.
+
+    A request that misses becomes the leader for its key: identical requests
+    arriving while it runs wait for its result instead of calling the LLM.
+    The leader must call finish(), with None when it produced nothing worth
+    caching, which sends the waiters off to run on their own.
+    """
+
+    def __init__(self, classes: Sequence[str], ttl: float = 3600.0, max_entries: int = 1024) -> None:
+        self.classes = frozenset(classes)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._responses: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._in_flight: Dict[str, "asyncio.Future[Optional[CachedResponse]]"] = {}
+
+    def enabled_for(self, class_selection: str) -> bool:
+        return self.ttl > 0 and ("*" in self.classes or class_selection in self.classes)
+
+    async def lookup(self, key: str) -> Optional[CachedResponse]:
+        """A cached or in-flight response for key; None makes the caller the leader."""
+        cached = self._responses.get(key)
+        if cached is not None:
+            if time.monotonic() - cached.stored_at < self.ttl:
+                self._responses.move_to_end(key)
+                RESPONSE_CACHE_LOOKUPS.inc(result="hit")
+                return cached
+            del self._responses[key]
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            RESPONSE_CACHE_LOOKUPS.inc(result="coalesced")
+            response = await asyncio.shield(in_flight)
+            if response is not None:
+                return response
+            # The leader failed; the first waiter to get here takes over
+            return await self.lookup(key)
+
+        RESPONSE_CACHE_LOOKUPS.inc(result="miss")
+        self._in_flight[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def finish(self, key: str, response: Optional[CachedResponse]) -> None:
+        """Store the leader's response (if any) and release the waiters."""
+        in_flight = self._in_flight.pop(key, None)
+        if in_flight is not None and not in_flight.done():
+            in_flight.set_result(response)
+
+        if response is None:
+            return
+        self._responses[key] = response
+        self._responses.move_to_end(key)
+        while len(self._responses) > self.max_entries:
+            self._responses.popitem(last=False)
+
+    def clear(self) -> None:
+        self._responses.clear()
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+from collections import Counter
+from itertools import combinations
+from typing import Any, Dict, Iterable, List, Optional
+
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class SSRCoRequestStats:
+    """
+    Per-class counts of the content keys requested together in a turn, across
+    all of its SSR passes, used to load a requested key's usual companions
+    along with it.
+
+    A key B is associated with A once A has been requested in at least
+    min_count turns and B was also requested in at least min_confidence of
+    them. Counts are written to ``path`` every ``save_interval`` seconds when
+    they changed, and on stop(); they are read back at start(). A save_interval
+    of 0 keeps them in memory only.
+    """
+
+    def __init__(
+        self,
+        path: str = "",
+        save_interval: float = 300.0,
+        min_count: int = 5,
+        min_confidence: float = 0.5,
+    ) -> None:
+        self.path = path
+        self.save_interval = save_interval
+        self.min_count = min_count
+        self.min_confidence = min_confidence
+        # classSelection -> turns with at least one request
+        self._turns: Counter[str] = Counter()
+        # classSelection -> key -> turns it was requested in
+        self._keys: Dict[str, Counter[str]] = {}
+        # classSelection -> key -> other key -> turns both were requested in
+        self._pairs: Dict[str, Dict[str, Counter[str]]] = {}
+        self._dirty = False
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    @property
+    def persistent(self) -> bool:
+        return bool(self.path) and self.save_interval > 0
+
+    def record(self, class_selection: str, requested_keys: Iterable[str]) -> None:
+        """Count the keys requested over one turn."""
+        keys = sorted(set(key for key in requested_keys if key))
+        if not keys:
+            return
+        self._turns[class_selection] += 1
+        key_counts = self._keys.setdefault(class_selection, Counter())
+        pairs = self._pairs.setdefault(class_selection, {})
+        key_counts.update(keys)
+        for first, second in combinations(keys, 2):
+            pairs.setdefault(first, Counter())[second] += 1
+            pairs.setdefault(second, Counter())[first] += 1
+        self._dirty = True
+
+    def associated(
+        self, class_selection: str, requested_keys: List[str], limit: int
+    ) -> List[str]:
+        """Keys strongly associated with requested_keys, most confident first."""
+        key_counts = self._keys.get(class_selection, Counter())
+        pairs = self._pairs.get(class_selection, {})
+        confidences: Dict[str, float] = {}
+        for key in requested_keys:
+            count = key_counts[key]
+            if count < self.min_count:
+                continue
+            for other, together in pairs.get(key, {}).items():
+                confidence = together / count
+                if confidence >= self.min_confidence and other not in requested_keys:
+                    confidences[other] = max(confidences.get(other, 0.0), confidence)
+
+        ranked = sorted(confidences.items(), key=lambda item: (-item[1], item[0]))
+        return [key for key, _ in ranked[:limit]]
+
+    def snapshot(self, class_selection: Optional[str] = None) -> Dict[str, Any]:
+        """Counts per class, as served by /ssr/corequests and saved to path."""
+        classes = [class_selection] if class_selection else sorted(self._turns)
+        return {
+            name: {
+                "turns": self._turns[name],
+                "keys": dict(self._keys.get(name, {})),
+                "pairs": {
+                    key: dict(others) for key, others in self._pairs.get(name, {}).items()
+                },
+            }
+            for name in classes
+            if name in self._turns
+        }
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        for name, stats in snapshot.items():
+            self._turns[name] = int(stats["turns"])
+            self._keys[name] = Counter(
+                {key: int(count) for key, count in stats["keys"].items()}
+            )
+            self._pairs[name] = {
+                key: Counter({other: int(count) for other, count in others.items()})
+                for key, others in stats["pairs"].items()
+            }
+
+    def load(self) -> None:
+        if not self.persistent or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.restore(json.load(file))
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.error(
+                "Failed to read SSR co-request statistics",
+                extra={
+                    "path": self.path,
+                    "error": str(e),
+                },
+            )
+            return
+        logger.info(
+            "SSR co-request statistics loaded",
+            extra={
+                "path": self.path,
+                "classes": str(len(self._turns)),
+            },
+        )
+
+    def _write(self, snapshot: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(snapshot, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            self._dirty = True
+            logger.error(
+                "Failed to save SSR co-request statistics",
+                extra={
+                    "path": self.path,
+                    "error": str(e),
+                },
+            )
+
+    def save(self) -> None:
+        if self.persistent and self._dirty:
+            self._dirty = False
+            self._write(self.snapshot())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.save_interval)
+            if self._dirty:
+                # Snapshot on the event loop, write off it
+                self._dirty = False
+                await asyncio.to_thread(self._write, self.snapshot())
+
+    def start(self) -> None:
+        """Load saved counts and save periodically. Must be called from the event loop."""
+        if self._task is None:
+            self.load()
+            if self.persistent:
+                self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.save()
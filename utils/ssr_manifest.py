@@ -0,0 +1,163 @@
+import asyncio
+import json
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from constants import BYTES_PER_TOKEN_ESTIMATE, SSR_CONTENT_DIRECTORY
+from utils.filesystem import list_files_with_metadata, open_text_file
+from utils.logger import get_logger
+from utils.metrics import SSR_MANIFEST_REFRESH_SECONDS
+
+logger = get_logger()
+
+_CONTENT_SUFFIX = ".txt"
+# Optional {"key": priority} per class; higher priorities are loaded first when
+# requested content does not all fit
+_PRIORITIES_FILE = "priorities.json"
+
+
+@dataclass
+class ManifestEntry:
+    key: str
+    size_bytes: int
+    # Estimated from the size until the file has been loaded, exact afterwards
+    tokens: int
+    version: str
+    exact_tokens: bool = False
+    priority: float = 0.0
+
+
+# classSelection -> content key -> entry
+ManifestClasses = Dict[str, Dict[str, ManifestEntry]]
+
+
+class SSRContentManifest:
+    """
+    Every classes/<class>/ssrcontent/*.txt key with its size, token count and
+    version, so content requests can be checked and budgeted without I/O.
+
+    Built by listing the class tree (one paginated listing in cloud mode) at
+    startup and refreshed in the background every ``refresh_interval`` seconds.
+    Until the first build completes, entries() returns None and callers fall
+    back to fetching.
+    """
+
+    def __init__(self, refresh_interval: float = 300.0) -> None:
+        self.refresh_interval = refresh_interval
+        self._classes: Optional[ManifestClasses] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._listeners: List[Callable[[], Awaitable[None]]] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.refresh_interval > 0
+
+    def build(self) -> None:
+        """List the class tree and swap in the new manifest."""
+        previous = self._classes or {}
+        content_files = []
+        priorities: Dict[str, Dict[str, float]] = {}
+        for file in list_files_with_metadata("classes"):
+            parts = file.path.split("/")
+            if len(parts) != 3 or parts[1] != SSR_CONTENT_DIRECTORY:
+                continue
+            if parts[2] == _PRIORITIES_FILE:
+                priorities[parts[0]] = self._read_priorities(parts[0])
+            elif parts[2].endswith(_CONTENT_SUFFIX):
+                content_files.append((parts[0], parts[2][: -len(_CONTENT_SUFFIX)], file))
+
+        classes: ManifestClasses = {}
+        for class_selection, key, file in content_files:
+            priority = priorities.get(class_selection, {}).get(key, 0.0)
+            known = previous.get(class_selection, {}).get(key)
+            if known is not None and known.version == file.version:
+                # Unchanged, keep the exact token count if we have one
+                entry = replace(known, priority=priority)
+            else:
+                entry = ManifestEntry(
+                    key=key,
+                    size_bytes=file.size,
+                    tokens=max(1, file.size // BYTES_PER_TOKEN_ESTIMATE),
+                    version=file.version,
+                    priority=priority,
+                )
+            classes.setdefault(class_selection, {})[key] = entry
+
+        self._classes = classes
+        logger.info(
+            "SSR content manifest built",
+            extra={
+                "classes": str(len(classes)),
+                "keys": str(sum(len(keys) for keys in classes.values())),
+            },
+        )
+
+    def _read_priorities(self, class_selection: str) -> Dict[str, float]:
+        path = f"classes/{class_selection}/{SSR_CONTENT_DIRECTORY}/{_PRIORITIES_FILE}"
+        try:
+            priorities = json.loads(open_text_file(path) or "{}")
+            return {str(key): float(value) for key, value in priorities.items()}
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.error(
+                "Invalid SSR content priorities",
+                extra={
+                    "class_selection": class_selection,
+                    "error": str(e),
+                },
+            )
+            return {}
+
+    async def refresh(self) -> None:
+        with SSR_MANIFEST_REFRESH_SECONDS.time():
+            await asyncio.to_thread(self.build)
+
+    def add_listener(self, listener: Callable[[], Awaitable[None]]) -> None:
+        """Await listener() after every background refresh."""
+        self._listeners.append(listener)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+                for listener in self._listeners:
+                    await listener()
+            except Exception as e:
+                logger.error(
+                    "Failed to build SSR content manifest",
+                    extra={
+                        "error": str(e),
+                    },
+                )
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        """Build now and keep refreshing in the background. Must be called from the event loop."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def entries(self, class_selection: str) -> Optional[Dict[str, ManifestEntry]]:
+        """
+        Content keys of a class, empty when it has no ssrcontent, or None when
+        the manifest is disabled or not built yet.
+        """
+        if self._classes is None:
+            return None
+        return self._classes.get(class_selection, {})
+
+    def classes(self) -> ManifestClasses:
+        return dict(self._classes or {})
+
+    def catalog(self, class_selection: str) -> List[str]:
+        return sorted(self.entries(class_selection) or {})
+
+    def record_tokens(self, class_selection: str, key: str, tokens: int) -> None:
+        """Replace the estimate with the exact count once a file has been loaded."""
+        entry = (self.entries(class_selection) or {}).get(key)
+        if entry is not None:
+            entry.tokens = tokens
+            entry.exact_tokens = True
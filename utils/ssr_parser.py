@@ -0,0 +1,187 @@
+import re
+from typing import List, Optional, Tuple
+
+from bs4 import BeautifulSoup, Tag
+
+from constants import SSR_REQUEST_TAG, SSR_XML_RESPONSE_TAG
+from utils.metrics import SSR_PARSER_FALLBACKS
+
+# (has_ssr_request, requested_keys, answer_text)
+SSRParseResult = Tuple[bool, List[str], str]
+
+_ANSWER_TAG = "answer"
+_PRIMARY_KEYS_TAG = "PrimaryKeys"
+
+# Plain start or end tag without attributes, e.g. <answer> or </answer>
+_TAG_PATTERN = re.compile(r"<(/?)([A-Za-z_][A-Za-z0-9_.\-]*)>")
+_ENTITY_PATTERN = re.compile(r"&(amp|lt|gt|quot|apos);")
+_ENTITIES = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+_ASCII_SPACES = " \n\t\x0c\r"
+# Characters that are not allowed in XML 1.0 documents
+_INVALID_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufeff\ufffe\uffff]")
+
+
+class _Unsupported(Exception):
+    """Input the fast scanner does not handle; the BeautifulSoup parser decides."""
+
+
+def _decode_text(text: str) -> str:
+    if "&" not in text:
+        return text
+    if text.count("&") != len(_ENTITY_PATTERN.findall(text)):
+        # Character references or unknown entities
+        raise _Unsupported()
+    return _ENTITY_PATTERN.sub(lambda match: _ENTITIES[match.group(1)], text)
+
+
+def _scan(content: str) -> SSRParseResult:
+    """Single pass over a well-formed document made of plain tags and text."""
+    if "\r" in content:
+        # XML end-of-line normalization
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    if _INVALID_CHARS.search(content) or "]]>" in content:
+        raise _Unsupported()
+
+    stack: List[str] = []
+    root_closed = False
+
+    # Depth (len(stack)) of the first SSR_response, SSR_requesting_content
+    # inside it, PrimaryKeys inside that, and answer inside SSR_response.
+    # 0 while not open yet, -1 once closed.
+    response_depth = request_depth = keys_depth = answer_depth = 0
+    has_request = False
+    keys_parts: Optional[List[str]] = None
+    answer_parts: Optional[List[str]] = None
+
+    position = 0
+    length = len(content)
+    while position < length:
+        tag_start = content.find("<", position)
+        if tag_start < 0:
+            tag_start = length
+
+        if tag_start > position:
+            text = content[position:tag_start]
+            if not stack:
+                if text.strip():
+                    # Text outside the root element
+                    raise _Unsupported()
+            else:
+                text = _decode_text(text)
+                if not text.strip(_ASCII_SPACES):
+                    # BeautifulSoup collapses whitespace-only strings
+                    text = "\n" if "\n" in text else " "
+                if keys_depth > 0:
+                    keys_parts.append(text)
+                if answer_depth > 0:
+                    answer_parts.append(text)
+
+        if tag_start == length:
+            break
+
+        match = _TAG_PATTERN.match(content, tag_start)
+        if match is None:
+            # Comments, CDATA, processing instructions, attributes, empty
+            # element tags or a stray '<'
+            raise _Unsupported()
+        position = match.end()
+        closing, name = match.group(1), match.group(2)
+
+        if closing:
+            if not stack or stack[-1] != name:
+                raise _Unsupported()
+            depth = len(stack)
+            stack.pop()
+            if depth == keys_depth:
+                keys_depth = -1
+            if depth == answer_depth:
+                answer_depth = -1
+            if depth == request_depth:
+                request_depth = -1
+            if depth == response_depth:
+                response_depth = -1
+            if not stack:
+                root_closed = True
+            continue
+
+        if root_closed:
+            # A second root element
+            raise _Unsupported()
+        stack.append(name)
+        depth = len(stack)
+
+        if name == SSR_XML_RESPONSE_TAG and response_depth == 0:
+            response_depth = depth
+        elif response_depth > 0:
+            if name == SSR_REQUEST_TAG and request_depth == 0:
+                request_depth = depth
+                has_request = True
+            elif name == _PRIMARY_KEYS_TAG and request_depth > 0 and keys_depth == 0:
+                keys_depth = depth
+                keys_parts = []
+            if name == _ANSWER_TAG and answer_depth == 0:
+                answer_depth = depth
+                answer_parts = []
+
+    if stack:
+        # Unclosed elements
+        raise _Unsupported()
+
+    if response_depth == 0:
+        return False, [], ""
+
+    answer_text = "".join(answer_parts) if answer_parts is not None else ""
+    if not has_request or keys_parts is None:
+        return False, [], answer_text
+
+    primary_keys_text = "".join(keys_parts).strip()
+    if not primary_keys_text:
+        return False, [], answer_text
+
+    return True, [key.strip() for key in primary_keys_text.split(",")], ""
+
+
+def extract_with_beautifulsoup(llm_response_content: str) -> SSRParseResult:
+    """Reference implementation, used for anything the scanner does not handle."""
+    soup = BeautifulSoup(llm_response_content, "lxml-xml")
+    ssr_response = soup.find(SSR_XML_RESPONSE_TAG)
+
+    if not isinstance(ssr_response, Tag):
+        return False, [], ""
+
+    content_request = ssr_response.find(SSR_REQUEST_TAG)
+    if not isinstance(content_request, Tag):
+        answer = ssr_response.find(_ANSWER_TAG)
+        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
+        return False, [], answer_text
+
+    primary_keys = content_request.find(_PRIMARY_KEYS_TAG)
+    if not isinstance(primary_keys, Tag):
+        answer = ssr_response.find(_ANSWER_TAG)
+        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
+        return False, [], answer_text
+
+    primary_keys_text = primary_keys.get_text().strip()
+    if not primary_keys_text:
+        answer = ssr_response.find(_ANSWER_TAG)
+        answer_text = answer.get_text() if isinstance(answer, Tag) else ""
+        return False, [], answer_text
+
+    keys = [key.strip() for key in primary_keys_text.split(",")]
+    return True, keys, ""
+
+
+def extract_ssr_content_request(llm_response_content: str) -> SSRParseResult:
+    """
+    Extract SSR content request from LLM response.
+    Returns: (has_ssr_request, requested_keys, answer_text)
+    """
+    if SSR_XML_RESPONSE_TAG not in llm_response_content:
+        # Plain answer, there is no SSR_response element to find
+        return False, [], ""
+
+    try:
+        return _scan(llm_response_content)
+    except _Unsupported:
+        SSR_PARSER_FALLBACKS.inc()
+        return extract_with_beautifulsoup(llm_response_content)
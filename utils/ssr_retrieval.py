@@ -0,0 +1,143 @@
+import asyncio
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from constants import SSR_CONTENT_DIRECTORY
+from utils.filesystem import open_text_file
+from utils.logger import get_logger
+from utils.ssr_manifest import SSRContentManifest
+
+logger = get_logger()
+
+_WORD_PATTERN = re.compile(r"\w+")
+_KEY_SEPARATORS = re.compile(r"[_\-.\s]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from had has have how i if in into is it "
+    "its me my of on or so than that the their them then there these they this to was we "
+    "were what when where which who why will with you your".split()
+)
+
+
+def _stem(word: str) -> str:
+    """Fold common English plurals so "fraction" matches "fractions"."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        _stem(word)
+        for word in _WORD_PATTERN.findall(text.lower())
+        if len(word) > 1 and word not in _STOPWORDS
+    ]
+
+
+class BM25Index:
+    """Okapi BM25 over a small set of documents, held as an inverted index."""
+
+    def __init__(self, documents: Dict[str, str], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        # term -> [(document key, term frequency)]
+        self.postings: Dict[str, List[Tuple[str, int]]] = {}
+        self.lengths: Dict[str, int] = {}
+
+        for key, text in documents.items():
+            terms = tokenize(text)
+            self.lengths[key] = len(terms)
+            for term, frequency in Counter(terms).items():
+                self.postings.setdefault(term, []).append((key, frequency))
+
+        count = len(self.lengths)
+        self.average_length = sum(self.lengths.values()) / count if count else 0.0
+        self.idf = {
+            term: math.log((count - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+            for term, postings in self.postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def search(self, query: str, limit: int, min_score: float = 0.0) -> List[Tuple[str, float]]:
+        """Best matching document keys for query, highest score first."""
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for key, frequency in postings:
+                norm = 1 - self.b + self.b * self.lengths[key] / (self.average_length or 1)
+                scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / (
+                    frequency + self.k1 * norm
+                )
+
+        ranked = sorted(
+            (item for item in scores.items() if item[1] >= min_score),
+            key=lambda item: (-item[1], item[0]),
+        )
+        return ranked[:limit]
+
+
+class SSRContentRetriever:
+    """
+    Per-class BM25 indexes over ssrcontent, used to load likely content before
+    the first LLM pass. Rebuilt after each manifest refresh for the classes
+    whose content changed; a class is not searchable until its index is built.
+    """
+
+    def __init__(self, manifest: SSRContentManifest) -> None:
+        self.manifest = manifest
+        self._indexes: Dict[str, BM25Index] = {}
+        # classSelection -> {key: version} the index was built from
+        self._versions: Dict[str, Dict[str, str]] = {}
+
+    def _read_documents(self, class_selection: str, keys: List[str]) -> Dict[str, str]:
+        documents = {}
+        for key in keys:
+            content = open_text_file(
+                f"classes/{class_selection}/{SSR_CONTENT_DIRECTORY}/{key}.txt"
+            )
+            if content:
+                # Key names often say what the content is about; weigh them in
+                key_words = _KEY_SEPARATORS.sub(" ", key)
+                documents[key] = f"{key_words} {key_words}\n{content}"
+        return documents
+
+    def build(self) -> None:
+        classes = self.manifest.classes()
+        for class_selection, entries in classes.items():
+            versions = {key: entry.version for key, entry in entries.items()}
+            if self._versions.get(class_selection) == versions:
+                continue
+            documents = self._read_documents(class_selection, list(versions))
+            self._indexes[class_selection] = BM25Index(documents)
+            self._versions[class_selection] = versions
+            logger.info(
+                "SSR content index built",
+                extra={
+                    "class_selection": class_selection,
+                    "documents": str(len(documents)),
+                    "terms": str(len(self._indexes[class_selection].postings)),
+                },
+            )
+
+        for class_selection in set(self._indexes) - set(classes):
+            del self._indexes[class_selection]
+            del self._versions[class_selection]
+
+    async def refresh(self) -> None:
+        await asyncio.to_thread(self.build)
+
+    def search(
+        self, class_selection: str, query: str, limit: int, min_score: float
+    ) -> List[Tuple[str, float]]:
+        index = self._indexes.get(class_selection)
+        if index is None:
+            return []
+        return index.search(query, limit, min_score)
@@ -0,0 +1,63 @@
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+from utils.response_cache import normalize_text
+
+# (classSelection, lesson, actionPlan, normalized question)
+SSRRoute = Tuple[str, str, str, str]
+
+
+def ssr_route(class_selection: str, lesson: str, action_plan: str, text: str) -> SSRRoute:
+    return (class_selection or "", lesson or "", action_plan or "", normalize_text(text))
+
+
+class SSRRouteCache:
+    """
+    Remembers which content keys the first SSR pass requested for a question.
+
+    Each route keeps a count of the key sets observed for it (an empty set when
+    the first pass answered without requesting content). lookup() returns the
+    most common set once the route has min_observations and that set makes up
+    at least min_confidence of them. Routes are evicted least recently used.
+    """
+
+    def __init__(
+        self, min_observations: int = 3, min_confidence: float = 0.6, max_routes: int = 4096
+    ) -> None:
+        self.min_observations = min_observations
+        self.min_confidence = min_confidence
+        self.max_routes = max_routes
+        self._routes: "OrderedDict[SSRRoute, Counter[Tuple[str, ...]]]" = OrderedDict()
+
+    def lookup(self, route: SSRRoute) -> Tuple[str, Optional[List[str]]]:
+        """(result, keys): result is hit, miss (unknown route) or low_confidence."""
+        observations = self._routes.get(route)
+        if observations is None:
+            return "miss", None
+        self._routes.move_to_end(route)
+
+        keys, count = observations.most_common(1)[0]
+        total = sum(observations.values())
+        if total < self.min_observations or count / total < self.min_confidence or not keys:
+            return "low_confidence", None
+        return "hit", list(keys)
+
+    def record(self, route: SSRRoute, requested_keys: List[str]) -> None:
+        """Count the keys a first pass requested for route, in first-requested order.
+
+        Only passes run without preloaded content belong here: a pass given the keys
+        up front no longer shows whether it needed them.
+        """
+        keys = tuple(dict.fromkeys(key for key in requested_keys if key))
+        observations = self._routes.get(route)
+        if observations is None:
+            observations = self._routes[route] = Counter()
+        # Same keys in a different order are the same observation
+        for known in observations:
+            if set(known) == set(keys):
+                keys = known
+                break
+        observations[keys] += 1
+        self._routes.move_to_end(route)
+        while len(self._routes) > self.max_routes:
+            self._routes.popitem(last=False)
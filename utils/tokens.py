@@ -0,0 +1,150 @@
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from constants import BYTES_PER_TOKEN_ESTIMATE, model, model_provider, token_counter
+from utils.logger import get_logger
+
+logger = get_logger()
+
+# ASCII letter/digit runs, single non-ASCII characters, single ASCII symbols
+_PIECE_PATTERN = re.compile(r"[A-Za-z0-9]+|[^\x00-\x7f]|[^\sA-Za-z0-9]")
+
+
+class TokenCounter:
+    """Counts tokens locally, without calling the provider."""
+
+    name = "base"
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class HeuristicTokenCounter(TokenCounter):
+    """
+    Offline estimate for models without a local tokenizer.
+
+    Letter/digit runs count one token per BYTES_PER_TOKEN_ESTIMATE characters,
+    while symbols and non-ASCII characters count one token each, which keeps
+    code and non-English text from being badly undercounted.
+    """
+
+    name = "heuristic"
+
+    def __init__(self, chars_per_token: int = BYTES_PER_TOKEN_ESTIMATE) -> None:
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        tokens = 0
+        for piece in _PIECE_PATTERN.findall(text):
+            if len(piece) > 1:
+                tokens += max(1, len(piece) // self.chars_per_token)
+            else:
+                tokens += 1
+        return tokens
+
+
+class TiktokenCounter(TokenCounter):
+    """BPE token counts from tiktoken, exact for OpenAI models."""
+
+    name = "tiktoken"
+
+    def __init__(self, model_name: str, default_encoding: str = "o200k_base") -> None:
+        import tiktoken
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding(default_encoding)
+        self.name = f"tiktoken:{self.encoding.name}"
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+TokenCounterFactory = Callable[[str], TokenCounter]
+
+# Provider name -> factory taking the model name. Providers without an entry use
+# HeuristicTokenCounter.
+_factories: Dict[str, TokenCounterFactory] = {
+    "OPENAI": lambda model_name: TiktokenCounter(model_name),
+    # No offline tokenizer is published for these; cl100k is closer than the heuristic
+    "ANTHROPIC": lambda model_name: TiktokenCounter("", default_encoding="cl100k_base"),
+    "GOOGLE": lambda model_name: TiktokenCounter("", default_encoding="cl100k_base"),
+}
+
+
+def register_token_counter(provider: str, factory: TokenCounterFactory) -> None:
+    """Use ``factory(model)`` to build the token counter for ``provider``."""
+    global _counter
+
+    _factories[provider.upper()] = factory
+    _counter = None
+    _count_cache.clear()
+
+
+def create_token_counter(provider: str, model_name: str, mode: str = "auto") -> TokenCounter:
+    factory = _factories.get(provider.upper())
+    if mode == "heuristic" or factory is None:
+        return HeuristicTokenCounter()
+
+    try:
+        return factory(model_name)
+    except Exception as e:
+        # tiktoken missing, or its encoding file neither cached nor downloadable
+        logger.warning(
+            "Token counter unavailable, using heuristic",
+            extra={
+                "model_provider": provider,
+                "model": model_name,
+                "error": str(e),
+            },
+        )
+        return HeuristicTokenCounter()
+
+
+_counter: Optional[TokenCounter] = None
+
+
+def get_token_counter() -> TokenCounter:
+    """The token counter for the configured provider and model, created on first use."""
+    global _counter
+
+    if _counter is None:
+        _counter = create_token_counter(model_provider, model, token_counter)
+        logger.info("Token counter configured", extra={"token_counter": _counter.name})
+    return _counter
+
+
+class _TokenCountCache:
+    """LRU of token counts keyed by (length, hash), so large texts are not retained."""
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+
+    def clear(self) -> None:
+        self._counts.clear()
+
+    def count(self, text: str) -> int:
+        key = (len(text), hash(text))
+        tokens = self._counts.get(key)
+        if tokens is not None:
+            self._counts.move_to_end(key)
+            return tokens
+
+        tokens = get_token_counter().count(text)
+        self._counts[key] = tokens
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+        return tokens
+
+
+_count_cache = _TokenCountCache()
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """Token count of ``text`` with the configured counter, memoized per string."""
+    if not text:
+        return 0
+    return _count_cache.count(text)
@@ -0,0 +1,167 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+
+
+class Span:
+    """A timed operation within a trace. Serialized with OTLP/JSON field names."""
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "name",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "status",
+    )
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]) -> None:
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else ""
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = "OK"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1_000_000, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class _NoopSpan:
+    """Returned when tracing is disabled so call sites need no checks."""
+
+    trace_id = ""
+    span_id = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class JsonlSpanExporter:
+    """Append finished spans to daily JSONL files from a background thread."""
+
+    def __init__(self, directory: str, queue_size: int = 10000) -> None:
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.dropped = 0
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(
+            target=self._run_worker, name="trace-exporter", daemon=True
+        )
+        self._worker.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _path(self) -> str:
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        return os.path.join(self.directory, f"traces-{day}.jsonl")
+
+    def _run_worker(self) -> None:
+        while True:
+            span = self._queue.get()
+            if span is None:
+                return
+            lines = [span]
+            # Write whatever else is already waiting in one go
+            while len(lines) < 1000:
+                try:
+                    nxt = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    self._write(lines)
+                    return
+                lines.append(nxt)
+            self._write(lines)
+
+    def _write(self, spans) -> None:
+        try:
+            with open(self._path(), "a", encoding="utf-8") as trace_file:
+                for span in spans:
+                    trace_file.write(json.dumps(span.to_dict(), default=str) + "\n")
+        except OSError as e:
+            sys.stderr.write(f"Trace exporter failed to write {len(spans)} spans: {e}\n")
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._worker.join(timeout)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_exporter: Optional[JsonlSpanExporter] = None
+
+
+def setup_tracing(enabled: bool, directory: str) -> None:
+    """Enable tracing with a local JSONL exporter writing under ``directory``."""
+    global _exporter
+
+    if enabled and _exporter is None:
+        _exporter = JsonlSpanExporter(directory)
+
+
+def shutdown_tracing() -> None:
+    global _exporter
+
+    if _exporter is not None:
+        _exporter.shutdown()
+        _exporter = None
+
+
+def current_span():
+    return _current_span.get() or _NOOP_SPAN
+
+
+@contextmanager
+def start_span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Time a block as a span nested under the current one (or start a new trace)."""
+    exporter = _exporter
+    if exporter is None:
+        yield _NOOP_SPAN
+        return
+
+    span = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = "ERROR"
+        span.attributes["error"] = str(e)
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        exporter.export(span)